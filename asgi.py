@@ -0,0 +1,577 @@
+"""
+API de Biometría Facial - Seguros Bolívar (modo ASGI)
+Mismas rutas y respuestas que main.py, pero las llamadas a las APIs externas
+usan httpx asíncrono, así miles de esperas concurrentes caben en un solo proceso.
+
+Ejecutar con:  SERVER_MODE=asgi gunicorn --config gunicorn.conf.py
+          o:   uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+
+import os
+import copy
+import time
+import asyncio
+import contextlib
+from datetime import datetime
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import main
+from main import logger, seguros_api, _env_int, muestrear_payload, Recortado
+
+# Límites del cliente HTTP asíncrono compartido por todas las peticiones
+ASGI_HTTP_MAX_CONEXIONES = _env_int('ASGI_HTTP_MAX_CONEXIONES', 1000)
+ASGI_HTTP_KEEPALIVE = _env_int('ASGI_HTTP_KEEPALIVE', 100)
+
+# Opciones de main.py que este modo no implementa: (activa, nombre, qué pasa en su lugar)
+NO_SOPORTADO_ASGI = [
+    (main.AUDIO_BACKEND == 'nativo', 'AUDIO_BACKEND=nativo',
+     '/audio_base64 sigue usando Google Apps Script'),
+    (main.cache_audio.activa, 'AUDIO_CACHE_MAX_BYTES',
+     '/audio_base64 no usa la cache en disco'),
+    (main.HEDGE_BIOMETRIA, 'HEDGE_BIOMETRIA',
+     'las llamadas a biometría no se cubren con una segunda llamada'),
+    (main.diario.activo, 'DIARIO_PATH',
+     'las peticiones no se registran en el diario de transacciones'),
+]
+
+# Estado por proceso, creado al arrancar el event loop (lifespan)
+_http = None
+_semaforo_batch = None
+_en_curso = {}
+
+
+async def obtener_token():
+    """Token vigente del gestor compartido con main.py.
+
+    El token casi siempre está vigente (el gestor lo renueva en segundo plano,
+    con el hilo que arranca lifespan); solo cuando hay que pedirlo se ejecuta
+    el gestor en un hilo aparte.
+    """
+    gestor = seguros_api.gestor_token
+    if gestor.token_valido():
+        return gestor.access_token
+    return await asyncio.to_thread(gestor.obtener)
+
+
+def calentar_token():
+    """Obtiene el token antes de abrir el puerto (gunicorn on_starting) para que los workers lo hereden.
+
+    Es el mismo gestor que usa obtener_token; main.calentar_token además
+    registra la duración en los tiempos de arranque.
+    """
+    return main.calentar_token()
+
+
+async def _enviar(url, destino, **kwargs):
+    """Un intento de POST, medido en las métricas del upstream (como PoolHTTP._enviar)"""
+    en_curso = main.metrica_upstream_en_curso.labels(destino)
+    en_curso.inc()
+    inicio = time.perf_counter()
+    status = 'error'
+    try:
+        with main.medir_fase(f'upstream_{destino}'):
+            response = await _http.post(url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        en_curso.dec()
+        main.metrica_upstream.labels(destino, status).observe(time.perf_counter() - inicio)
+
+
+async def _ocupar_compartimento(compartimento):
+    """Compartimento.adquirir sin bloquear el event loop: la espera en la cola va en un hilo aparte"""
+    if compartimento.adquirir(esperar=False):
+        return
+    espera = asyncio.ensure_future(asyncio.to_thread(compartimento.adquirir))
+    try:
+        await asyncio.shield(espera)
+    except asyncio.CancelledError:
+        # El hilo sigue esperando: si al final obtiene el cupo, nadie más lo liberaría
+        espera.add_done_callback(lambda f: f.cancelled() or f.exception() or compartimento.liberar())
+        raise
+
+
+async def _post_upstream(pool, url, destino=None, **kwargs):
+    """POST con el bulkhead, el circuit breaker y la política de reintentos del PoolHTTP de main.py"""
+    if pool.compartimento is None:
+        return await _post_con_circuito(pool, url, destino, **kwargs)
+    await _ocupar_compartimento(pool.compartimento)
+    try:
+        return await _post_con_circuito(pool, url, destino, **kwargs)
+    finally:
+        pool.compartimento.liberar()
+
+
+async def _post_con_circuito(pool, url, destino=None, **kwargs):
+    destino = destino or pool.nombre
+    circuito = pool.circuito
+    main.presupuesto_reintentos.registrar_llamada()
+    intento = 0
+    limitador = pool.limitadores.get(destino)
+    while True:
+        if limitador is not None:
+            with main.medir_fase('limite_tasa'):
+                espera = limitador.reservar()
+                if espera > 0:
+                    await asyncio.sleep(espera)
+        circuito.permitir()
+        inicio = time.monotonic()
+        try:
+            response = await _enviar(url, destino, **kwargs)
+        except httpx.UnsupportedProtocol:
+            circuito.liberar()
+            raise
+        except httpx.TransportError as e:
+            circuito.registrar(False, time.monotonic() - inicio)
+            # Solo un error al abrir la conexión garantiza que la petición no se procesó: httpx
+            # separa ConnectError/ConnectTimeout de RemoteProtocolError/ReadError (ya enviada)
+            if not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or not await _reintentar(pool, intento, e):
+                raise
+        except BaseException:
+            # Error local (p. ej. un header que no es str, URL inválida): no dice nada del upstream
+            circuito.liberar()
+            raise
+        else:
+            circuito.registrar(main.respuesta_exitosa(response.status_code), time.monotonic() - inicio)
+            retry_after = pool._atender_429(response, destino)
+            if (response.status_code not in main.STATUS_REINTENTABLES or
+                    not await _reintentar(pool, intento, response.status_code, retry_after)):
+                return response
+        intento += 1
+
+
+async def _reintentar(pool, intento, motivo, retry_after=None):
+    if intento >= pool.reintentos:
+        return False
+    espera = main.espera_reintento(intento) if retry_after is None else retry_after
+    if espera > main.RATE_LIMIT_ESPERA_MAX or not main.presupuesto_reintentos.consumir():
+        return False
+    logger.warning("Reintentando llamada a '%s' (%s) en %.2fs", pool.nombre, motivo, espera)
+    await asyncio.sleep(espera)
+    return True
+
+
+def _respuesta_error(resultado, status_code):
+    """Igual que main.respuesta_error: Retry-After cuando el circuito está abierto"""
+    headers = {'Retry-After': str(resultado['retry_after'])} if resultado.get('retry_after') else None
+    return RespuestaJSON(resultado, status_code=status_code, headers=headers)
+
+
+async def _consultar_biometria_upstream(numero_documento, tipo_documento, id_transaccion):
+    """Llama a la API de Seguros Bolívar para obtener la URL de biometría"""
+    try:
+        seguros_api.http.circuito.verificar()
+        with main.medir_fase('token'):
+            access_token = await obtener_token()
+        if not access_token:
+            return {
+                'error': True,
+                'message': 'No se pudo obtener el token de acceso'
+            }
+
+        headers, body_data = seguros_api.preparar_consulta_biometria(
+            access_token, numero_documento, tipo_documento, id_transaccion
+        )
+        response = await _post_upstream(seguros_api.http, seguros_api.biometric_url, destino='biometria',
+                                        json=body_data, headers=headers, timeout=30)
+        with main.medir_fase('procesar'):
+            return seguros_api.procesar_respuesta_biometria(response)
+
+    except main.ServicioNoDisponibleError as e:
+        logger.warning(str(e))
+        return e.resultado()
+    except httpx.HTTPError as e:
+        logger.error("Error de conexión: %s", e)
+        return {
+            'error': True,
+            'message': f'Error de conexión: {str(e)}'
+        }
+    except Exception as e:
+        logger.error("Error en consultar_biometria_facial: %s", e)
+        return {
+            'error': True,
+            'message': f'Error interno: {str(e)}'
+        }
+
+
+async def consultar_biometria_facial(numero_documento, tipo_documento='CC', id_transaccion=None):
+    """Versión asíncrona de SegurosBolivarAPI.consultar_biometria_facial (misma cache)"""
+    clave = (id_transaccion, str(numero_documento), tipo_documento) if id_transaccion else None
+    if clave:
+        with main.medir_fase('cache'):
+            cacheado = seguros_api.cache.obtener(clave)
+        if cacheado is not None:
+            logger.info("Respuesta de biometría desde cache para transacción: %s", id_transaccion)
+            return cacheado
+
+    async def consultar():
+        resultado = await _consultar_biometria_upstream(numero_documento, tipo_documento, id_transaccion)
+        if clave and not resultado.get('error'):
+            seguros_api.cache.guardar(clave, resultado)
+        return resultado
+
+    if not clave:
+        return await consultar()
+
+    # Peticiones idénticas concurrentes comparten una sola llamada al upstream
+    tarea = _en_curso.get(clave)
+    if tarea is None:
+        tarea = asyncio.ensure_future(consultar())
+        _en_curso[clave] = tarea
+        tarea.add_done_callback(lambda _: _en_curso.pop(clave, None))
+    # shield: si un cliente se desconecta no se cancela la llamada de los demás
+    return copy.deepcopy(await asyncio.shield(tarea))
+
+
+class RespuestaJSON(JSONResponse):
+    """JSONResponse serializada con el codec de main.py (orjson si está instalado)"""
+
+    def render(self, content):
+        with main.medir_fase('json'):
+            return main.json_dumps(content)
+
+
+async def _leer_body(request):
+    """Lee el body respetando MAX_BODY_BYTES. Devuelve None si lo excede"""
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > main.MAX_BODY_BYTES:
+        return None
+    partes = []
+    total = 0
+    async for parte in request.stream():
+        total += len(parte)
+        if total > main.MAX_BODY_BYTES:
+            return None
+        partes.append(parte)
+    return b''.join(partes)
+
+
+async def _parsear_request(request, esquema=None):
+    """Lee, decodifica y valida el body del request. Devuelve (datos, respuesta_error)"""
+    with main.medir_fase('parseo'):
+        return await _leer_y_validar(request, esquema)
+
+
+async def _leer_y_validar(request, esquema):
+    raw_data = await _leer_body(request)
+    if raw_data is None:
+        return None, RespuestaJSON({
+            'error': True,
+            'message': f'El body excede el máximo de {main.MAX_BODY_BYTES} bytes'
+        }, status_code=413)
+
+    content_type = request.headers.get('content-type')
+    if muestrear_payload():
+        logger.debug("Request %s %s content_type=%s headers=%s body=%s", request.method, request.url.path,
+                     content_type, Recortado(dict(request.headers)), Recortado(raw_data))
+
+    mimetype = (content_type or '').split(';')[0].strip().lower()
+    data = main.decodificar_body(raw_data, mimetype)
+    if not data:
+        return None, RespuestaJSON(main.respuesta_body_requerido(content_type, request.method, raw_data),
+                                   status_code=400)
+
+    if esquema is None:
+        return data, None
+
+    datos, mensaje = main.validar_esquema(data, esquema)
+    if mensaje:
+        return None, RespuestaJSON({
+            'error': True,
+            'message': mensaje
+        }, status_code=400)
+    return datos, None
+
+
+def _error_interno(e):
+    return RespuestaJSON({
+        'error': True,
+        'message': f'Error interno del servidor: {str(e)}'
+    }, status_code=500)
+
+
+async def health_check(request):
+    """Health check endpoint"""
+    return RespuestaJSON({
+        'status': 'healthy',
+        'service': 'Seguros Bolívar Biometric API',
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def generar_url_biometria(request):
+    """Endpoint principal para generar URL de biometría facial"""
+    try:
+        datos, error = await _parsear_request(request, main.ESQUEMA_BIOMETRIA)
+        if error:
+            return error
+
+        numero_documento = datos['numeroDocumento']
+        tipo_documento = datos['tipoDocumento']
+        id_transaccion = datos.get('idTransaccion')
+
+        resultado = await consultar_biometria_facial(numero_documento, tipo_documento, id_transaccion)
+
+        if resultado.get('error'):
+            return _respuesta_error(resultado, resultado.get('status_code', 500))
+
+        return RespuestaJSON(main._formatear_respuesta_biometria(
+            resultado, numero_documento, tipo_documento, id_transaccion
+        ))
+
+    except Exception as e:
+        logger.error("Error en generar_url_biometria: %s", e)
+        return _error_interno(e)
+
+
+async def _procesar_item_batch(indice, item):
+    datos, error = main._validar_item_batch(indice, item)
+    if error:
+        return error
+
+    numero_documento = datos['numeroDocumento']
+    tipo_documento = datos['tipoDocumento']
+    id_transaccion = datos.get('idTransaccion')
+
+    async with _semaforo_batch:
+        resultado = await consultar_biometria_facial(numero_documento, tipo_documento, id_transaccion)
+
+    return main._resultado_item_batch(indice, resultado, numero_documento, tipo_documento, id_transaccion)
+
+
+async def generar_urls_biometria_batch(request):
+    """Genera URLs de biometría para varios documentos en una sola petición"""
+    try:
+        data, error = await _parsear_request(request)
+        if error:
+            return error
+
+        items = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return RespuestaJSON({
+                'error': True,
+                'message': 'items es requerido (lista de {numeroDocumento, tipoDocumento, idTransaccion})'
+            }, status_code=400)
+
+        if len(items) > main.BATCH_MAX_ITEMS:
+            return RespuestaJSON({
+                'error': True,
+                'message': f'Máximo {main.BATCH_MAX_ITEMS} items por batch (recibidos {len(items)})'
+            }, status_code=413)
+
+        try:
+            seguros_api.http.circuito.verificar()
+        except main.ServicioNoDisponibleError as e:
+            return _respuesta_error(e.resultado(), 503)
+
+        if not await obtener_token():
+            return RespuestaJSON({
+                'error': True,
+                'message': 'No se pudo obtener el token de acceso'
+            }, status_code=500)
+
+        logger.info("Procesando batch de biometría con %s items", len(items))
+        resultados = await asyncio.gather(*[
+            _procesar_item_batch(indice, item) for indice, item in enumerate(items)
+        ])
+        exitosos = sum(1 for r in resultados if r.get('success'))
+
+        return RespuestaJSON({
+            'success': exitosos == len(resultados),
+            'total': len(resultados),
+            'exitosos': exitosos,
+            'fallidos': len(resultados) - exitosos,
+            'resultados': resultados,
+            'timestamp': datetime.now().isoformat()
+        })
+
+    except Exception as e:
+        logger.error("Error en generar_urls_biometria_batch: %s", e)
+        return _error_interno(e)
+
+
+async def test_endpoint(request):
+    """Endpoint de prueba con datos predeterminados"""
+    numero_documento = request.query_params.get('documento', '1007409364')
+    tipo_documento = request.query_params.get('tipo', 'CC')
+    id_transaccion = request.query_params.get('idTransaccion', '983223933nn111')
+
+    resultado = await consultar_biometria_facial(numero_documento, tipo_documento, id_transaccion)
+
+    return RespuestaJSON({
+        'test': True,
+        'input': {
+            'numeroDocumento': numero_documento,
+            'tipoDocumento': tipo_documento,
+            'idTransaccion': id_transaccion
+        },
+        'resultado': resultado,
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def refresh_token(request):
+    """Endpoint para forzar refresh del token"""
+    resultado = await asyncio.to_thread(seguros_api.obtener_token)
+
+    if resultado:
+        return RespuestaJSON({
+            'success': True,
+            'message': 'Token renovado exitosamente',
+            'timestamp': datetime.now().isoformat()
+        })
+    return RespuestaJSON({
+        'error': True,
+        'message': 'Error al renovar token'
+    }, status_code=500)
+
+
+async def cache_stats(request):
+    """Estadísticas de la cache y de la agrupación de peticiones de biometría"""
+    return RespuestaJSON({
+        'biometria': seguros_api.cache.estadisticas(),
+        'biometria_en_curso': {'en_curso': len(_en_curso)},
+        'timestamp': datetime.now().isoformat()
+    })
+
+
+async def metrics(request):
+    """Métricas en formato Prometheus"""
+    return Response(main.generar_metricas(), headers={'Content-Type': main.CONTENT_TYPE_LATEST})
+
+
+async def circuitos(request):
+    """Estado de los circuit breakers de los upstreams"""
+    return RespuestaJSON(main.estado_circuitos())
+
+
+async def convertir_audio_base64(request):
+    """Endpoint para convertir audio URL a base64 usando Google Apps Script"""
+    try:
+        datos, error = await _parsear_request(request, main.ESQUEMA_AUDIO)
+        if error:
+            return error
+
+        audio_url = datos['audio_url']
+        id_session = datos['id_session']
+
+        payload = main.preparar_payload_apps_script(audio_url, id_session)
+        # Apps Script responde con una redirección a googleusercontent
+        response = await _post_upstream(
+            main.apps_script_http,
+            main.APPS_SCRIPT_URL,
+            json=payload,
+            headers={'Content-Type': 'application/json'},
+            timeout=main.APPS_SCRIPT_TIMEOUT,
+            follow_redirects=True
+        )
+
+        # El body ya está en memoria (httpx): se reenvía sin parsearlo ni volver a serializarlo
+        if (main.APPS_SCRIPT_PASSTHROUGH and response.status_code == 200 and
+                main.es_objeto_json(response.content[:main.APPS_SCRIPT_SNIFF_BYTES])):
+            return Response(response.content, media_type='application/json')
+
+        resultado, status_code = main.procesar_respuesta_apps_script(response, audio_url, id_session)
+        return RespuestaJSON(resultado, status_code=status_code)
+
+    except main.ServicioNoDisponibleError as e:
+        logger.warning(str(e))
+        return _respuesta_error(e.resultado(), e.status_code)
+    except httpx.HTTPError as e:
+        logger.error("Error de conexión con Google Apps Script: %s", e)
+        return RespuestaJSON({
+            'error': True,
+            'message': f'Error de conexión con Google Apps Script: {str(e)}'
+        }, status_code=500)
+    except Exception as e:
+        logger.error("Error en convertir_audio_base64: %s", e)
+        return _error_interno(e)
+
+
+class MiddlewareMetricas:
+    """Latencia y peticiones en curso por ruta (mismas métricas que main.py) y Server-Timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        # Las rutas no tienen parámetros: fuera de ellas se agrupa todo en 'desconocida'
+        ruta = scope['path'] if scope['path'] in RUTAS else 'desconocida'
+        status = {'codigo': 500}
+
+        async def enviar(mensaje):
+            if mensaje['type'] == 'http.response.start':
+                status['codigo'] = mensaje['status']
+                valor = main.server_timing((time.perf_counter() - inicio) * 1000)
+                if valor:
+                    mensaje['headers'] = list(mensaje.get('headers', [])) + [(b'server-timing', valor.encode('latin-1'))]
+            await send(mensaje)
+
+        en_curso = main.metrica_peticiones_en_curso.labels(ruta)
+        en_curso.inc()
+        inicio = time.perf_counter()
+        token_fases = main.iniciar_fases()
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            total = time.perf_counter() - inicio
+            en_curso.dec()
+            main.metrica_peticiones.labels(ruta, scope['method'], str(status['codigo'])).observe(total)
+            main.registrar_tiempos(scope['method'], ruta, status['codigo'], total * 1000)
+            main.terminar_fases(token_fases)
+
+
+def advertir_no_soportado():
+    """Registra como error cada opción configurada que el modo ASGI ignora"""
+    for activa, nombre, efecto in NO_SOPORTADO_ASGI:
+        if activa:
+            logger.error("%s no está soportado con SERVER_MODE=asgi: %s", nombre, efecto)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global _http, _semaforo_batch
+    _http = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=ASGI_HTTP_MAX_CONEXIONES,
+            max_keepalive_connections=ASGI_HTTP_KEEPALIVE
+        ),
+    )
+    _semaforo_batch = asyncio.Semaphore(main.BATCH_MAX_CONCURRENCIA)
+    # El camino rápido de obtener_token no pasa por gestor.obtener(): sin esto un
+    # worker que heredó el token precargado nunca lo renovaría por anticipado
+    seguros_api.gestor_token.iniciar_refresco()
+    advertir_no_soportado()
+    logger.info("Modo ASGI iniciado (pid %s, max_conexiones=%s)", os.getpid(), ASGI_HTTP_MAX_CONEXIONES)
+    try:
+        yield
+    finally:
+        await _http.aclose()
+
+
+app = Starlette(
+    routes=[
+        Route('/', health_check, methods=['GET']),
+        Route('/biometria', generar_url_biometria, methods=['POST']),
+        Route('/biometria/batch', generar_urls_biometria_batch, methods=['POST']),
+        Route('/test', test_endpoint, methods=['GET']),
+        Route('/token/refresh', refresh_token, methods=['POST']),
+        Route('/cache/stats', cache_stats, methods=['GET']),
+        Route('/circuitos', circuitos, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/audio_base64', convertir_audio_base64, methods=['POST']),
+    ],
+    middleware=[Middleware(MiddlewareMetricas)],
+    lifespan=lifespan
+)
+
+RUTAS = {ruta.path for ruta in app.routes}
@@ -0,0 +1,59 @@
+"""
+Compara dos reportes de benchmark/ejecutar.py (base vs. nuevo) por configuración y endpoint.
+
+Ejecutar con:  python benchmark/comparar.py base.json nuevo.json
+"""
+
+import sys
+import json
+import argparse
+
+
+def _cargar(ruta):
+    with open(ruta, encoding='utf-8') as archivo:
+        reporte = json.load(archivo)
+    return {
+        (r['server_mode'], r['workers'], r['threads'], r['endpoint']): r
+        for r in reporte['resultados']
+    }
+
+
+def _variacion(base, nuevo):
+    if base in (None, 0) or nuevo is None:
+        return 'n/a'
+    return f'{(nuevo - base) / base * 100:+.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara dos reportes de benchmark')
+    parser.add_argument('base')
+    parser.add_argument('nuevo')
+    args = parser.parse_args()
+
+    base = _cargar(args.base)
+    nuevo = _cargar(args.nuevo)
+    comunes = sorted(set(base) & set(nuevo))
+    if not comunes:
+        print('Los reportes no tienen configuraciones en común', file=sys.stderr)
+        sys.exit(1)
+
+    columnas = ('config', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'rss pico MB', 'errores')
+    print('\t'.join(columnas))
+    for clave in comunes:
+        b, n = base[clave], nuevo[clave]
+        modo, workers, threads, endpoint = clave
+        filas = [
+            f'{modo} w={workers} t={threads} {endpoint}',
+            f"{b['throughput_rps']} → {n['throughput_rps']} ({_variacion(b['throughput_rps'], n['throughput_rps'])})",
+        ]
+        for p in ('p50', 'p95', 'p99'):
+            vb, vn = b['latencia_ms'][p], n['latencia_ms'][p]
+            filas.append(f'{vb} → {vn} ({_variacion(vb, vn)})')
+        mb, mn = b['memoria_mb']['pico'], n['memoria_mb']['pico']
+        filas.append(f'{mb} → {mn} ({_variacion(mb, mn)})')
+        filas.append(f"{b['errores']} → {n['errores']}")
+        print('\t'.join(filas))
+
+
+if __name__ == '__main__':
+    main()
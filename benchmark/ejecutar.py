@@ -0,0 +1,354 @@
+"""
+Benchmark de carga de la API con upstreams falsos (sin tocar URLs de producción).
+
+Levanta benchmark/upstreams_falsos.py, arranca gunicorn (gunicorn.conf.py) con cada
+combinación de workers/hilos, genera carga concurrente contra cada endpoint durante
+--duracion segundos y reporta throughput, latencias p50/p95/p99 y memoria (RSS de
+gunicorn y sus workers) en JSON.
+
+Ejemplos:
+    python benchmark/ejecutar.py --workers 1,2 --threads 4,8 --salida base.json
+    python benchmark/ejecutar.py --endpoints biometria --latencia-biometria 0.5 --tasa-error 0.1
+    python benchmark/comparar.py base.json nuevo.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import signal
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+import requests
+
+from upstreams_falsos import agregar_argumentos
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+
+def _body_biometria(args, base_upstreams):
+    return {
+        'numeroDocumento': str(random.randint(10 ** 7, 10 ** 10)),
+        'tipoDocumento': 'CC',
+        # idTransaccion único: cada petición llega al upstream (sin cache)
+        'idTransaccion': uuid.uuid4().hex
+    }
+
+
+def _body_batch(args, base_upstreams):
+    return {'items': [_body_biometria(args, base_upstreams) for _ in range(args.items_batch)]}
+
+
+def _body_audio(args, base_upstreams):
+    return {
+        'audio_url': f'{base_upstreams}/audio.mp3?n={uuid.uuid4().hex}',
+        'id_session': uuid.uuid4().hex
+    }
+
+
+# endpoint -> (método, ruta, generador del body)
+ENDPOINTS = {
+    'health': ('GET', '/', None),
+    'biometria': ('POST', '/biometria', _body_biometria),
+    'batch': ('POST', '/biometria/batch', _body_batch),
+    'audio': ('POST', '/audio_base64', _body_audio),
+}
+
+
+def _lista_enteros(valor):
+    return [int(v) for v in valor.split(',') if v.strip()]
+
+
+def _rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as archivo:
+            for linea in archivo:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def rss_total_mb(pid_maestro):
+    """RSS del proceso maestro de gunicorn más el de sus workers (solo Linux)"""
+    total = _rss_kb(pid_maestro)
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as archivo:
+                # El nombre del proceso puede tener espacios: el ppid va tras el último ')'
+                ppid = int(archivo.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid_maestro:
+            total += _rss_kb(pid)
+    return round(total / 1024, 1)
+
+
+class MuestreadorMemoria(threading.Thread):
+    """Muestrea el RSS de gunicorn mientras corre la carga"""
+
+    def __init__(self, pid, intervalo=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.intervalo = intervalo
+        self.muestras = []
+        self._detener = threading.Event()
+
+    def run(self):
+        while not self._detener.is_set():
+            rss = rss_total_mb(self.pid)
+            if rss is not None:
+                self.muestras.append(rss)
+            self._detener.wait(self.intervalo)
+
+    def detener(self):
+        self._detener.set()
+        self.join()
+
+
+def percentil(ordenados, p):
+    """Percentil por rango más cercano sobre una lista ordenada"""
+    if not ordenados:
+        return None
+    indice = max(0, min(len(ordenados) - 1, int(round(p / 100 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+
+def generar_carga(base_url, endpoint, args, base_upstreams):
+    """Lanza --concurrencia clientes durante --duracion segundos. Devuelve [(latencia, status)]"""
+    metodo, ruta, generar_body = ENDPOINTS[endpoint]
+    fin = time.perf_counter() + args.duracion
+    resultados = []
+    lock = threading.Lock()
+
+    def cliente():
+        sesion = requests.Session()
+        propios = []
+        while time.perf_counter() < fin:
+            body = generar_body(args, base_upstreams) if generar_body else None
+            inicio = time.perf_counter()
+            try:
+                response = sesion.request(metodo, base_url + ruta, json=body, timeout=args.timeout)
+                response.content
+                status = str(response.status_code)
+            except requests.exceptions.RequestException:
+                status = 'error'
+            propios.append((time.perf_counter() - inicio, status))
+        sesion.close()
+        with lock:
+            resultados.extend(propios)
+
+    hilos = [threading.Thread(target=cliente) for _ in range(args.concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return resultados
+
+
+def resumir(endpoint, resultados, duracion, memoria):
+    latencias = sorted(latencia * 1000 for latencia, _ in resultados)
+    exitosas = [latencia * 1000 for latencia, status in resultados if status.startswith('2')]
+    por_status = {}
+    for _, status in resultados:
+        por_status[status] = por_status.get(status, 0) + 1
+
+    def redondear(valor):
+        return round(valor, 2) if valor is not None else None
+
+    return {
+        'endpoint': endpoint,
+        'peticiones': len(resultados),
+        'exitosas': len(exitosas),
+        'errores': len(resultados) - len(exitosas),
+        'status': por_status,
+        'throughput_rps': round(len(resultados) / duracion, 2),
+        'throughput_exitosas_rps': round(len(exitosas) / duracion, 2),
+        'latencia_ms': {
+            'media': redondear(sum(latencias) / len(latencias)) if latencias else None,
+            'p50': redondear(percentil(latencias, 50)),
+            'p95': redondear(percentil(latencias, 95)),
+            'p99': redondear(percentil(latencias, 99)),
+            'max': redondear(latencias[-1]) if latencias else None
+        },
+        'memoria_mb': memoria
+    }
+
+
+def iniciar_upstreams(args):
+    comando = [
+        sys.executable, os.path.join(DIRECTORIO, 'upstreams_falsos.py'),
+        '--puerto', str(args.puerto_upstreams),
+        '--latencia-token', str(args.latencia_token),
+        '--latencia-biometria', str(args.latencia_biometria),
+        '--latencia-apps-script', str(args.latencia_apps_script),
+        '--latencia-audio', str(args.latencia_audio),
+        '--jitter', str(args.jitter),
+        '--tasa-error', str(args.tasa_error),
+        '--bytes-audio', str(args.bytes_audio),
+    ]
+    proceso = subprocess.Popen(comando, stdout=subprocess.PIPE, text=True)
+    # Espera al mensaje de arranque; sin él (p. ej. el puerto está ocupado) el proceso terminó
+    if not proceso.stdout.readline() or proceso.poll() is not None:
+        if proceso.poll() is None:
+            proceso.kill()
+        proceso.wait()
+        raise RuntimeError(f'upstreams_falsos.py terminó al arrancar (código {proceso.returncode})')
+    return proceso
+
+
+def iniciar_gunicorn(args, workers, threads, base_upstreams, directorio_temporal):
+    entorno = dict(os.environ)
+    entorno.update({
+        'PORT': str(args.puerto),
+        'GUNICORN_WORKERS': str(workers),
+        'GUNICORN_THREADS': str(threads),
+        'SERVER_MODE': args.server_mode,
+        'SEGUROS_TOKEN_URL': f'{base_upstreams}/oauth2/token',
+        'SEGUROS_BIOMETRIC_URL': f'{base_upstreams}/biometria',
+        'APPS_SCRIPT_URL': f'{base_upstreams}/apps_script',
+        'AUDIO_BACKEND': args.audio_backend,
+        # Los upstreams falsos escuchan en loopback
+        'AUDIO_HOSTS_PERMITIDOS': '127.0.0.1',
+        'AUDIO_PERMITIR_REDES_PRIVADAS': 'true',
+        'LOG_LEVEL': args.log_level,
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(directorio_temporal, f'metricas_{workers}_{threads}'),
+    })
+    log = open(os.path.join(directorio_temporal, f'gunicorn_{workers}_{threads}.log'), 'w')
+    proceso = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py'],
+        cwd=RAIZ, env=entorno, stdout=log, stderr=subprocess.STDOUT
+    )
+    base_url = f'http://127.0.0.1:{args.puerto}'
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise RuntimeError(f'gunicorn terminó al arrancar (ver {log.name})')
+        try:
+            if requests.get(base_url + '/', timeout=1).status_code == 200:
+                return proceso, log
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    detener(proceso)
+    raise RuntimeError(f'gunicorn no respondió en 30 s (ver {log.name})')
+
+
+def detener(proceso, espera=10):
+    if proceso.poll() is None:
+        proceso.send_signal(signal.SIGTERM)
+        try:
+            proceso.wait(espera)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+            proceso.wait()
+
+
+def ejecutar_configuracion(args, workers, threads, base_upstreams, directorio_temporal):
+    proceso, log = iniciar_gunicorn(args, workers, threads, base_upstreams, directorio_temporal)
+    base_url = f'http://127.0.0.1:{args.puerto}'
+    resultados = []
+    try:
+        rss_arranque = rss_total_mb(proceso.pid)
+        for endpoint in args.endpoints:
+            # Calentamiento: token, pools de conexiones e imports perezosos
+            if args.calentamiento > 0:
+                calentamiento = argparse.Namespace(**vars(args))
+                calentamiento.duracion = args.calentamiento
+                generar_carga(base_url, endpoint, calentamiento, base_upstreams)
+
+            muestreador = MuestreadorMemoria(proceso.pid)
+            rss_inicio = rss_total_mb(proceso.pid)
+            muestreador.start()
+            inicio = time.perf_counter()
+            carga = generar_carga(base_url, endpoint, args, base_upstreams)
+            duracion = time.perf_counter() - inicio
+            muestreador.detener()
+
+            memoria = {
+                'arranque': rss_arranque,
+                'inicio': rss_inicio,
+                'pico': max(muestreador.muestras) if muestreador.muestras else None,
+                'fin': rss_total_mb(proceso.pid)
+            }
+            resumen = resumir(endpoint, carga, duracion, memoria)
+            resumen.update({'server_mode': args.server_mode, 'workers': workers, 'threads': threads})
+            resultados.append(resumen)
+            print(f"[{args.server_mode} w={workers} t={threads}] {endpoint}: "
+                  f"{resumen['throughput_rps']} rps, p50={resumen['latencia_ms']['p50']} ms, "
+                  f"p95={resumen['latencia_ms']['p95']} ms, p99={resumen['latencia_ms']['p99']} ms, "
+                  f"errores={resumen['errores']}, rss_pico={memoria['pico']} MB", file=sys.stderr)
+    finally:
+        detener(proceso)
+        log.close()
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de carga con upstreams falsos')
+    parser.add_argument('--workers', type=_lista_enteros, default=[1], help='lista separada por comas')
+    parser.add_argument('--threads', type=_lista_enteros, default=[8], help='lista separada por comas')
+    parser.add_argument('--server-mode', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--endpoints', default='health,biometria,batch,audio',
+                        type=lambda v: [e.strip() for e in v.split(',') if e.strip()])
+    parser.add_argument('--duracion', type=float, default=10, help='segundos de carga por endpoint')
+    parser.add_argument('--calentamiento', type=float, default=1, help='segundos de carga previa (sin medir)')
+    parser.add_argument('--concurrencia', type=int, default=16, help='clientes simultáneos')
+    parser.add_argument('--items-batch', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=90)
+    parser.add_argument('--audio-backend', choices=['apps_script', 'nativo'], default='apps_script')
+    parser.add_argument('--puerto', type=int, default=18081)
+    parser.add_argument('--puerto-upstreams', type=int, default=18080)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--salida', help='archivo JSON de resultados (por defecto stdout)')
+    agregar_argumentos(parser)
+    args = parser.parse_args()
+
+    desconocidos = [e for e in args.endpoints if e not in ENDPOINTS]
+    if desconocidos:
+        parser.error(f"endpoints desconocidos: {', '.join(desconocidos)} (válidos: {', '.join(ENDPOINTS)})")
+
+    base_upstreams = f'http://127.0.0.1:{args.puerto_upstreams}'
+    upstreams = iniciar_upstreams(args)
+    resultados = []
+    try:
+        with tempfile.TemporaryDirectory(prefix='benchmark_') as directorio_temporal:
+            for workers in args.workers:
+                for threads in args.threads:
+                    resultados.extend(ejecutar_configuracion(args, workers, threads, base_upstreams,
+                                                             directorio_temporal))
+    finally:
+        detener(upstreams)
+
+    reporte = {
+        'fecha': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parametros': {clave: valor for clave, valor in vars(args).items() if clave != 'salida'},
+        'resultados': resultados
+    }
+    texto = json.dumps(reporte, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as archivo:
+            archivo.write(texto + '\n')
+        print(f'Resultados guardados en {args.salida}', file=sys.stderr)
+    else:
+        print(texto)
+
+
+if __name__ == '__main__':
+    main()
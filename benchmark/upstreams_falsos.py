@@ -0,0 +1,154 @@
+"""
+Upstreams falsos para el benchmark: token OAuth2, URL de biometría, Google Apps Script
+y descarga de audio, con latencia, tasa de errores y tamaño de respuesta configurables.
+
+Ejecutar con:  python benchmark/upstreams_falsos.py --puerto 18080 --latencia-biometria 0.2
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import base64
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class ConfigUpstreams:
+    """Comportamiento de los upstreams falsos"""
+
+    def __init__(self, latencia_token=0.05, latencia_biometria=0.1, latencia_apps_script=1.0,
+                 latencia_audio=0.05, jitter=0.2, tasa_error=0.0, bytes_audio=256 * 1024):
+        self.latencias = {
+            'token': latencia_token,
+            'biometria': latencia_biometria,
+            'apps_script': latencia_apps_script,
+            'audio': latencia_audio
+        }
+        # Variación relativa de la latencia (0.2 = ±20 %)
+        self.jitter = jitter
+        # Fracción de respuestas 503 (el token nunca falla)
+        self.tasa_error = tasa_error
+        self.audio = os.urandom(bytes_audio)
+        self.respuesta_apps_script = json.dumps({
+            'success': True,
+            'mime_type': 'audio/mpeg',
+            'audio_base64': base64.b64encode(self.audio).decode('ascii')
+        }).encode('utf-8')
+
+    def esperar(self, destino):
+        latencia = self.latencias[destino]
+        if latencia > 0:
+            time.sleep(max(0.0, latencia * random.uniform(1 - self.jitter, 1 + self.jitter)))
+
+    def falla(self):
+        return self.tasa_error > 0 and random.random() < self.tasa_error
+
+
+class ManejadorUpstreams(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, formato, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def _responder(self, status, cuerpo, content_type='application/json'):
+        if not isinstance(cuerpo, bytes):
+            cuerpo = json.dumps(cuerpo).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(cuerpo)
+
+    def _leer_body(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(longitud) if longitud else b''
+
+    def do_POST(self):
+        self._leer_body()
+        if self.path == '/oauth2/token':
+            self.config.esperar('token')
+            self._responder(200, {'access_token': uuid.uuid4().hex, 'expires_in': 3600, 'token_type': 'Bearer'})
+        elif self.path == '/biometria':
+            self.config.esperar('biometria')
+            if self.config.falla():
+                self._responder(503, {'message': 'Service Unavailable'})
+                return
+            self._responder(200, {'url': f'https://biometria.local/sesion/{uuid.uuid4().hex}'})
+        elif self.path == '/apps_script':
+            self.config.esperar('apps_script')
+            if self.config.falla():
+                self._responder(503, {'message': 'Service Unavailable'})
+                return
+            self._responder(200, self.config.respuesta_apps_script)
+        else:
+            self._responder(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        if self.path.startswith('/audio.mp3'):
+            self.config.esperar('audio')
+            self._responder(200, self.config.audio, 'audio/mpeg')
+        else:
+            self._responder(404, {'message': 'Not Found'})
+
+    def do_HEAD(self):
+        if self.path.startswith('/audio.mp3'):
+            self._responder(200, self.config.audio, 'audio/mpeg')
+        else:
+            self._responder(404, b'')
+
+
+def crear_servidor(puerto, config):
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), ManejadorUpstreams)
+    servidor.daemon_threads = True
+    servidor.config = config
+    return servidor
+
+
+def agregar_argumentos(parser):
+    """Argumentos de configuración de los upstreams (compartidos con ejecutar.py)"""
+    parser.add_argument('--latencia-token', type=float, default=0.05, help='segundos')
+    parser.add_argument('--latencia-biometria', type=float, default=0.1, help='segundos')
+    parser.add_argument('--latencia-apps-script', type=float, default=1.0, help='segundos')
+    parser.add_argument('--latencia-audio', type=float, default=0.05, help='segundos')
+    parser.add_argument('--jitter', type=float, default=0.2, help='variación relativa de la latencia')
+    parser.add_argument('--tasa-error', type=float, default=0.0, help='fracción de respuestas 503')
+    parser.add_argument('--bytes-audio', type=int, default=256 * 1024, help='tamaño del audio')
+
+
+def config_desde_argumentos(args):
+    return ConfigUpstreams(
+        latencia_token=args.latencia_token,
+        latencia_biometria=args.latencia_biometria,
+        latencia_apps_script=args.latencia_apps_script,
+        latencia_audio=args.latencia_audio,
+        jitter=args.jitter,
+        tasa_error=args.tasa_error,
+        bytes_audio=args.bytes_audio
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Upstreams falsos para el benchmark')
+    parser.add_argument('--puerto', type=int, default=18080)
+    agregar_argumentos(parser)
+    args = parser.parse_args()
+
+    servidor = crear_servidor(args.puerto, config_desde_argumentos(args))
+    print(f'Upstreams falsos escuchando en http://127.0.0.1:{args.puerto}', flush=True)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Consulta y exportación del diario de transacciones (DIARIO_PATH) para conciliación.
+
+Ejecutar con:  python diario.py consultar --desde 2024-05-01 --tipo biometria
+               python diario.py exportar --formato csv --salida transacciones.csv
+               python diario.py resumen --desde 2024-05-01T00:00 --hasta 2024-05-02T00:00
+
+No importa main.py: solo lee el archivo SQLite (en modo lectura), así se puede
+usar mientras el servicio escribe.
+"""
+
+import os
+import sys
+import csv
+import json
+import sqlite3
+import argparse
+from datetime import datetime
+
+COLUMNAS = (
+    'id', 'ts', 'tipo', 'status', 'latencia_ms', 'id_transaccion', 'numero_documento', 'tipo_documento',
+    'id_session', 'url', 'upstream', 'upstream_status', 'error', 'pid'
+)
+
+
+def _timestamp(texto):
+    """Fecha ISO (2024-05-01 o 2024-05-01T10:30) a epoch"""
+    try:
+        return datetime.fromisoformat(texto).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Fecha inválida: {texto} (formato ISO, ej. 2024-05-01T10:30)')
+
+
+def conectar(ruta):
+    if not os.path.exists(ruta):
+        print(f'No existe el diario {ruta}', file=sys.stderr)
+        sys.exit(1)
+    conexion = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True, timeout=10)
+    conexion.row_factory = sqlite3.Row
+    return conexion
+
+
+def _filtros(args):
+    """Cláusula WHERE y parámetros a partir de los argumentos"""
+    condiciones = []
+    parametros = []
+    for campo, operador, valor in (
+        ('ts', '>=', args.desde),
+        ('ts', '<', args.hasta),
+        ('tipo', '=', args.tipo),
+        ('id_transaccion', '=', args.id_transaccion),
+        ('numero_documento', '=', args.documento),
+        ('status', '=', args.status),
+    ):
+        if valor is not None:
+            condiciones.append(f'{campo} {operador} ?')
+            parametros.append(valor)
+    if args.solo_errores:
+        condiciones.append('status >= 400')
+    where = f" WHERE {' AND '.join(condiciones)}" if condiciones else ''
+    return where, parametros
+
+
+def _fila(registro):
+    fila = {columna: registro[columna] for columna in COLUMNAS}
+    fila['fecha'] = datetime.fromtimestamp(registro['ts']).isoformat()
+    return fila
+
+
+def consultar(conexion, args):
+    where, parametros = _filtros(args)
+    consulta = f"SELECT {', '.join(COLUMNAS)} FROM transacciones{where} ORDER BY ts DESC LIMIT ?"
+    columnas = ('fecha', 'tipo', 'status', 'latencia_ms', 'id_transaccion', 'numero_documento',
+                'id_session', 'upstream_status', 'url', 'error')
+    print('\t'.join(columnas))
+    for registro in conexion.execute(consulta, parametros + [args.limite]):
+        fila = _fila(registro)
+        print('\t'.join('' if fila[c] is None else str(fila[c]) for c in columnas))
+
+
+def exportar(conexion, args):
+    """Exporta en orden cronológico sin cargar todo el resultado en memoria"""
+    where, parametros = _filtros(args)
+    cursor = conexion.execute(f"SELECT {', '.join(COLUMNAS)} FROM transacciones{where} ORDER BY ts", parametros)
+    salida = open(args.salida, 'w', newline='', encoding='utf-8') if args.salida else sys.stdout
+    try:
+        if args.formato == 'csv':
+            escritor = csv.DictWriter(salida, fieldnames=('fecha',) + COLUMNAS)
+            escritor.writeheader()
+            for registro in cursor:
+                escritor.writerow(_fila(registro))
+        else:
+            for registro in cursor:
+                salida.write(json.dumps(_fila(registro), ensure_ascii=False) + '\n')
+    finally:
+        if salida is not sys.stdout:
+            salida.close()
+
+
+def resumen(conexion, args):
+    """Conteo por tipo y status, con latencia media y máxima"""
+    where, parametros = _filtros(args)
+    consulta = (
+        f"SELECT tipo, status, COUNT(*) AS total, ROUND(AVG(latencia_ms), 1) AS latencia_media_ms, "
+        f"MAX(latencia_ms) AS latencia_max_ms FROM transacciones{where} GROUP BY tipo, status ORDER BY tipo, status"
+    )
+    columnas = ('tipo', 'status', 'total', 'latencia_media_ms', 'latencia_max_ms')
+    print('\t'.join(columnas))
+    for registro in conexion.execute(consulta, parametros):
+        print('\t'.join(str(registro[c]) for c in columnas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Diario de transacciones de biometría y audio')
+    parser.add_argument('--db', default=os.getenv('DIARIO_PATH') or 'diario_transacciones.db',
+                        help='archivo SQLite (por defecto DIARIO_PATH)')
+    subparsers = parser.add_subparsers(dest='comando', required=True)
+
+    filtros = argparse.ArgumentParser(add_help=False)
+    filtros.add_argument('--desde', type=_timestamp, help='fecha ISO inicial (incluida)')
+    filtros.add_argument('--hasta', type=_timestamp, help='fecha ISO final (excluida)')
+    filtros.add_argument('--tipo', choices=('biometria', 'biometria_batch', 'audio', 'audio_job'))
+    filtros.add_argument('--id-transaccion')
+    filtros.add_argument('--documento')
+    filtros.add_argument('--status', type=int)
+    filtros.add_argument('--solo-errores', action='store_true', help='solo status >= 400')
+
+    sub = subparsers.add_parser('consultar', parents=[filtros], help='últimos registros')
+    sub.add_argument('--limite', type=int, default=100)
+    sub = subparsers.add_parser('exportar', parents=[filtros], help='exporta a CSV o JSON lines')
+    sub.add_argument('--formato', choices=('csv', 'jsonl'), default='csv')
+    sub.add_argument('--salida', help='archivo de salida (por defecto stdout)')
+    subparsers.add_parser('resumen', parents=[filtros], help='conteo por tipo y status')
+
+    args = parser.parse_args()
+    comandos = {'consultar': consultar, 'exportar': exportar, 'resumen': resumen}
+    conexion = conectar(args.db)
+    try:
+        comandos[args.comando](conexion, args)
+    finally:
+        conexion.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Configuración de gunicorn
+Los hilos por worker (GUNICORN_THREADS) también dimensionan los pools HTTP de main.py
+SERVER_MODE=asgi sirve asgi.py con workers de uvicorn en lugar de main.py (Flask)
+Las métricas de Prometheus se agregan entre workers en PROMETHEUS_MULTIPROC_DIR
+La app se precarga en el maestro (GUNICORN_PRELOAD) y cada worker se calienta antes de aceptar tráfico
+"""
+
+import os
+import time
+import shutil
+
+bind = f":{os.getenv('PORT', '8080')}"
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+timeout = 0
+# Importar la app una sola vez en el maestro: los workers arrancan con un fork
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+if os.getenv('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'main:app'
+
+# Debe definirse antes de que se importe prometheus_client (con preload_app, en el maestro)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+
+
+def _limpiar_metricas():
+    """Descarta las métricas de ejecuciones anteriores (una vez por maestro, no en cada recarga)"""
+    if os.environ.get('GUNICORN_METRICAS_PID') == str(os.getpid()):
+        return
+    os.environ['GUNICORN_METRICAS_PID'] = str(os.getpid())
+    directorio = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+
+
+# La precarga importa main.py antes de on_starting: el directorio tiene que existir ya
+_limpiar_metricas()
+
+
+def on_starting(server):
+    """Con la app precargada, obtiene el token antes de abrir el puerto para que los workers lo hereden"""
+    if server.cfg.preload_app:
+        # El token se calienta con el módulo que sirve la app precargada
+        if os.getenv('SERVER_MODE', 'wsgi') == 'asgi':
+            import asgi as app_precargada
+        else:
+            import main as app_precargada
+        import main
+        if main.CALENTAR_AL_ARRANCAR:
+            app_precargada.calentar_token()
+        # Los gauges del maestro no se exponen: cada worker publica las fases heredadas
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def pre_fork(server, worker):
+    worker.inicio_fork = time.time()
+
+
+def post_worker_init(worker):
+    """Abre las conexiones del worker (no se heredan del maestro) antes de aceptar peticiones"""
+    if os.getenv('SERVER_MODE', 'wsgi') == 'asgi':
+        # El cliente httpx se crea en el lifespan de asgi.py; aquí solo el token
+        return
+    import main
+    main.calentar_worker(inicio_fork=getattr(worker, 'inicio_fork', None))
+
+
+def child_exit(server, worker):
+    """Los gauges del worker que terminó dejan de contarse"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
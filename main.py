@@ -4,149 +4,3615 @@ Flask application para generar URLs de biometría facial y convertir audio a bas
 """
 
 import os
+import re
 import json
+import queue
+import atexit
 import time
 import random
 import string
+import threading
+import uuid
+import base64
+import hashlib
+import mmap
+import struct
+import zlib
+import contextlib
+import contextvars
+import copy
+import functools
+import hmac
+import socket
+import ipaddress
+import sqlite3
+import cProfile
+import pstats
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturoTimeoutError
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
+from flask import Flask, Response, g, request, jsonify, send_file, url_for
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
 from datetime import datetime
+from urllib.parse import urljoin, urlparse, parse_qsl
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo disponible el almacén de token en memoria
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # Sin orjson se usa el módulo json estándar
+    orjson = None
+
+_INICIO_MODULO = time.time()
 
-# Configurar logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Flask(__name__)
+
+
+def _env_int(nombre, defecto):
+    """Lee una variable de entorno entera, usando el valor por defecto si no es válida"""
+    try:
+        return int(os.getenv(nombre, defecto))
+    except (TypeError, ValueError):
+        logger.warning("Valor inválido para %s, usando %s", nombre, defecto)
+        return defecto
+
+
+def _env_float(nombre, defecto):
+    """Lee una variable de entorno decimal, usando el valor por defecto si no es válida"""
+    try:
+        return float(os.getenv(nombre, defecto))
+    except (TypeError, ValueError):
+        logger.warning("Valor inválido para %s, usando %s", nombre, defecto)
+        return defecto
+
+
+# Configuración de logging. Los registros se encolan sin formatear y un hilo en
+# segundo plano los formatea, redacta y escribe, fuera del hilo de la petición.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'json' (una línea por registro, la interpreta Cloud Logging) o 'texto'
+LOG_FORMATO = os.getenv('LOG_FORMATO', 'json')
+# Máximo de caracteres por mensaje y por payload registrado
+LOG_MAX_CARACTERES = _env_int('LOG_MAX_CARACTERES', 2000)
+LOG_MAX_PAYLOAD = _env_int('LOG_MAX_PAYLOAD', 500)
+# Fracción de peticiones cuyos payloads se registran en DEBUG (0 a 1)
+LOG_MUESTREO_PAYLOAD = _env_float('LOG_MUESTREO_PAYLOAD', 0.01)
+LOG_COLA_MAX = _env_int('LOG_COLA_MAX', 10000)
+
+# Tokens y secretos que nunca deben llegar a los logs
+_PATRONES_REDACCION = [
+    (re.compile(r'(Bearer\s+)[\w\-.~+/]+=*', re.IGNORECASE), r'\1***'),
+    (re.compile(r'''(['"]?(?:access_token|client_secret|auth_token|Authorization)['"]?\s*[:=]\s*['"]?)[^'",\s}&]+''',
+                re.IGNORECASE), r'\1***'),
+    # Query string de las URLs (audio_url firmadas, URLs de biometría): puede llevar tokens
+    (re.compile(r'''(https?://[^\s?#'"]+)\?[^\s#'"]*''', re.IGNORECASE), r'\1?***'),
+    # Números de documento: solo se conservan los últimos 4 caracteres
+    (re.compile(r'''(['"]?(?:numeroDocumento|userId|documento)['"]?\s*[:=]\s*['"]?)[^'",\s}&]*([^'",\s}&]{4})'''),
+     r'\1***\2'),
+]
+
+
+def redactar(texto):
+    for patron, reemplazo in _PATRONES_REDACCION:
+        texto = patron.sub(reemplazo, texto)
+    return texto
+
+
+def _recortar_texto(texto, limite):
+    if len(texto) <= limite:
+        return texto
+    return f"{texto[:limite]}...(+{len(texto) - limite} caracteres)"
+
+
+class Recortado:
+    """Valor para logs que solo se convierte (y recorta) si el registro se formatea"""
+
+    def __init__(self, valor, limite=None):
+        self.valor = valor
+        self.limite = LOG_MAX_PAYLOAD if limite is None else limite
+
+    def __str__(self):
+        valor = self.valor
+        if isinstance(valor, (bytes, bytearray)):
+            # Solo se decodifica el prefijo, no el payload completo
+            texto = bytes(valor[:self.limite]).decode('utf-8', errors='replace')
+            if len(valor) > self.limite:
+                texto += f"...(+{len(valor) - self.limite} bytes)"
+            return texto
+        return _recortar_texto(str(valor), self.limite)
+
+
+class Enmascarado:
+    """Dato personal para logs: solo se muestran los últimos 4 caracteres"""
+
+    def __init__(self, valor):
+        self.valor = valor
+
+    def __str__(self):
+        texto = str(self.valor)
+        return '*' * max(len(texto) - 4, 0) + texto[-4:]
+
+
+def muestrear_payload():
+    """Indica si se registran los payloads (DEBUG) de esta petición, según el muestreo"""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_MUESTREO_PAYLOAD
+
+
+class FormateadorLog(logging.Formatter):
+    """Formatea, recorta y redacta los registros (en el hilo del listener)"""
+
+    def __init__(self, formato_json=True):
+        super().__init__()
+        self.formato_json = formato_json
+
+    def format(self, record):
+        mensaje = redactar(_recortar_texto(record.getMessage(), LOG_MAX_CARACTERES))
+        excepcion = redactar(self.formatException(record.exc_info)) if record.exc_info else None
+
+        if not self.formato_json:
+            linea = f"{self.formatTime(record)} {record.levelname} {record.name}: {mensaje}"
+            return f"{linea}\n{excepcion}" if excepcion else linea
+
+        entrada = {
+            'severity': record.levelname,
+            'message': mensaje,
+            'logger': record.name,
+            'time': datetime.fromtimestamp(record.created).isoformat(),
+            'thread': record.threadName
+        }
+        # Campos estructurados: logger.info("...", extra={'campos': {...}})
+        campos = getattr(record, 'campos', None)
+        if campos:
+            entrada.update(campos)
+        if excepcion:
+            entrada['exception'] = excepcion
+        return json.dumps(entrada, ensure_ascii=False, default=str)
+
+
+class ColaLogHandler(QueueHandler):
+    """Encola los registros sin formatearlos y los descarta si la cola está llena"""
+
+    descartados = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            ColaLogHandler.descartados += 1
+
+
+_log_listener = None
+
+
+def configurar_logging():
+    """Instala el pipeline de logging asíncrono en el logger raíz"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+
+    salida = logging.StreamHandler()
+    salida.setFormatter(FormateadorLog(formato_json=LOG_FORMATO == 'json'))
+    cola = queue.Queue(LOG_COLA_MAX)
+
+    raiz = logging.getLogger()
+    for handler in list(raiz.handlers):
+        if isinstance(handler, ColaLogHandler):
+            raiz.removeHandler(handler)
+    raiz.addHandler(ColaLogHandler(cola))
+    raiz.setLevel(LOG_LEVEL)
+
+    _log_listener = QueueListener(cola, salida)
+    _log_listener.start()
+
+
+def _reiniciar_logging_tras_fork():
+    # El hilo del listener no existe en el hijo: se crean cola y listener nuevos
+    global _log_listener
+    _log_listener = None
+    configurar_logging()
+
+
+configurar_logging()
+atexit.register(lambda: _log_listener and _log_listener.stop())
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_logging_tras_fork)
+
+
+# Codec JSON: orjson cuando está instalado, si no el módulo json estándar
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        """Serializa a bytes UTF-8"""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS, default=str)
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        """Serializa a bytes UTF-8"""
+        return json.dumps(obj, ensure_ascii=False, default=str).encode('utf-8')
+
+
+class ProveedorJSON(DefaultJSONProvider):
+    """jsonify y get_json con orjson cuando está disponible"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        opciones = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+        return orjson.dumps(obj, option=opciones, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        with medir_fase('json'):
+            return super().response(*args, **kwargs)
+
+
+app.json = ProveedorJSON(app)
+
+
+# Métricas Prometheus (GET /metrics). Con varios workers de gunicorn,
+# PROMETHEUS_MULTIPROC_DIR (lo define gunicorn.conf.py) hace que cada proceso
+# escriba sus valores en archivos mmap y /metrics los agregue todos.
+METRICAS_MULTIPROCESO = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+metrica_peticiones = Histogram(
+    'http_request_duration_seconds', 'Latencia de las peticiones por ruta y status',
+    ['ruta', 'metodo', 'status'], buckets=BUCKETS_LATENCIA
+)
+metrica_peticiones_en_curso = Gauge(
+    'http_requests_in_flight', 'Peticiones en curso por ruta',
+    ['ruta'], multiprocess_mode='livesum'
+)
+metrica_upstream = Histogram(
+    'upstream_request_duration_seconds', 'Latencia de las llamadas a los upstreams (por intento)',
+    ['destino', 'status'], buckets=BUCKETS_LATENCIA
+)
+metrica_upstream_en_curso = Gauge(
+    'upstream_requests_in_flight', 'Llamadas en curso por upstream',
+    ['destino'], multiprocess_mode='livesum'
+)
+metrica_token = Histogram(
+    'token_refresh_duration_seconds', 'Duración de las solicitudes de token OAuth2',
+    ['motivo', 'resultado'], buckets=BUCKETS_LATENCIA
+)
+metrica_cache = Counter(
+    'cache_requests_total', 'Consultas a las caches (hit ratio = hit / total)',
+    ['cache', 'resultado']
+)
+
+
+def generar_metricas():
+    """Métricas en formato de texto Prometheus (agregadas entre workers si aplica)"""
+    if METRICAS_MULTIPROCESO:
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    else:
+        registro = REGISTRY
+    return generate_latest(registro)
+
+
+# Server-Timing: duración de cada fase de la petición en la respuesta y en un
+# log estructurado (solo las peticiones de al menos TIEMPOS_LOG_MIN_MS)
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'true').lower() == 'true'
+TIEMPOS_LOG_MIN_MS = _env_float('TIEMPOS_LOG_MIN_MS', 0)
+
+
+# Fases medidas de la petición en curso: {nombre: ms}. Es un ContextVar para
+# que funcione igual en los hilos de Flask y en las tareas de asgi.py.
+_fases_peticion = contextvars.ContextVar('fases_peticion', default=None)
+
+
+def iniciar_fases():
+    """Empieza a acumular las fases de la petición actual. Devuelve el token para terminar_fases"""
+    return _fases_peticion.set({}) if SERVER_TIMING else None
+
+
+def terminar_fases(token):
+    if token is not None:
+        _fases_peticion.reset(token)
+
+
+@contextlib.contextmanager
+def medir_fase(nombre):
+    """Acumula la duración del bloque en las fases de la petición actual"""
+    fases = _fases_peticion.get()
+    if fases is None:
+        # Hilos sin petición (batch, trabajos, refresco de token): no se mide
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        fases[nombre] = fases.get(nombre, 0.0) + (time.perf_counter() - inicio) * 1000
+
+
+# Datos de la petición actual para el diario de transacciones: status de la
+# última llamada a cada upstream y el X-Id_transaction realmente enviado. Es un
+# dict mutable para que lo vean también las copias del contexto (hedging).
+_diario_peticion = contextvars.ContextVar('diario_peticion', default=None)
+
+
+@contextlib.contextmanager
+def anotaciones_diario():
+    """Recoge durante el bloque los datos del diario de las llamadas a upstreams"""
+    anotaciones = {'upstreams': {}, 'id_transaccion': None}
+    token = _diario_peticion.set(anotaciones)
+    try:
+        yield anotaciones
+    finally:
+        _diario_peticion.reset(token)
+
+
+def anotar_diario(campo, valor):
+    anotaciones = _diario_peticion.get()
+    if anotaciones is not None:
+        anotaciones[campo] = valor
+
+
+def server_timing(total_ms):
+    """Valor del header Server-Timing con las fases de la petición actual, o None"""
+    fases = _fases_peticion.get()
+    if fases is None:
+        return None
+    return ', '.join(
+        [f'{nombre};dur={duracion:.1f}' for nombre, duracion in fases.items()] + [f'total;dur={total_ms:.1f}']
+    )
+
+
+def registrar_tiempos(metodo, ruta, status, total_ms):
+    """Log estructurado con las fases de la petición (si dura al menos TIEMPOS_LOG_MIN_MS)"""
+    fases = _fases_peticion.get()
+    if fases is None or total_ms < TIEMPOS_LOG_MIN_MS:
+        return
+    logger.info("Tiempos %s %s %s: %.1f ms", metodo, ruta, status, total_ms,
+                extra={'campos': {
+                    'ruta': ruta,
+                    'status': status,
+                    'total_ms': round(total_ms, 1),
+                    'fases_ms': {nombre: round(duracion, 1) for nombre, duracion in fases.items()}
+                }})
+
+
+# Configuración de los pools de conexiones HTTP.
+# Por defecto cada pool admite tantas conexiones como hilos tiene el worker de gunicorn.
+GUNICORN_THREADS = _env_int('GUNICORN_THREADS', 8)
+HTTP_POOL_SIZE = _env_int('HTTP_POOL_SIZE', GUNICORN_THREADS)
+HTTP_POOL_RETRIES = _env_int('HTTP_POOL_RETRIES', 2)
+
+
+# Circuit breaker por upstream: se abre si en la ventana la fracción de errores
+# o de llamadas lentas supera el umbral, y tras CIRCUITO_TIEMPO_ABIERTO deja
+# pasar llamadas de prueba (semiabierto) antes de volver a cerrarse.
+CIRCUITO_VENTANA = _env_int('CIRCUITO_VENTANA', 30)
+CIRCUITO_MIN_LLAMADAS = _env_int('CIRCUITO_MIN_LLAMADAS', 10)
+CIRCUITO_UMBRAL_ERRORES = _env_float('CIRCUITO_UMBRAL_ERRORES', 0.5)
+CIRCUITO_LLAMADA_LENTA = _env_float('CIRCUITO_LLAMADA_LENTA', 10)
+CIRCUITO_UMBRAL_LENTAS = _env_float('CIRCUITO_UMBRAL_LENTAS', 0.8)
+CIRCUITO_TIEMPO_ABIERTO = _env_int('CIRCUITO_TIEMPO_ABIERTO', 30)
+CIRCUITO_SONDAS = _env_int('CIRCUITO_SONDAS', 1)
+
+# Presupuesto global de reintentos: como máximo REINTENTOS_PRESUPUESTO
+# reintentos por llamada en la ventana (con un mínimo de REINTENTOS_MINIMO)
+REINTENTOS_PRESUPUESTO = _env_float('REINTENTOS_PRESUPUESTO', 0.1)
+REINTENTOS_MINIMO = _env_int('REINTENTOS_MINIMO', 5)
+REINTENTOS_BACKOFF_BASE = _env_float('REINTENTOS_BACKOFF_BASE', 0.2)
+REINTENTOS_BACKOFF_MAX = _env_float('REINTENTOS_BACKOFF_MAX', 2)
+
+# Respuestas que indican que el upstream no procesó la petición (seguro reintentar)
+STATUS_REINTENTABLES = (429, 502, 503, 504)
+# Errores de transporte: cuentan como fallo del upstream en el circuit breaker.
+# El resto (InvalidHeader, InvalidURL...) son errores locales al armar la petición
+ERRORES_TRANSPORTE = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                      requests.exceptions.ChunkedEncodingError)
+
+
+def respuesta_exitosa(status_code):
+    """Para el circuit breaker: 5xx y 429 son fallos del upstream"""
+    return status_code < 500 and status_code != 429
+
+
+class ServicioNoDisponibleError(Exception):
+    """El servicio no puede atender ahora la petición; se responde con Retry-After"""
+
+    def __init__(self, mensaje, nombre, reintentar_en, status_code=503):
+        super().__init__(mensaje)
+        self.nombre = nombre
+        self.reintentar_en = max(1, int(reintentar_en + 0.999))
+        self.status_code = status_code
+
+    def resultado(self):
+        """Body de error para la respuesta 429/503"""
+        return {
+            'error': True,
+            'message': str(self),
+            'status_code': self.status_code,
+            'retry_after': self.reintentar_en
+        }
+
+
+class CircuitoAbiertoError(ServicioNoDisponibleError):
+    """El circuito del upstream está abierto: se falla rápido sin llamarlo"""
+
+    def __init__(self, nombre, reintentar_en):
+        super().__init__(f'Servicio {nombre} no disponible temporalmente (circuito abierto)',
+                         nombre, reintentar_en)
+
+
+class Circuito:
+    """Circuit breaker de un upstream (cerrado → abierto → semiabierto → cerrado)"""
+
+    def __init__(self, nombre, ventana=None, min_llamadas=None, umbral_errores=None,
+                 llamada_lenta=None, umbral_lentas=None, tiempo_abierto=None, sondas=None):
+        self.nombre = nombre
+        self.ventana = CIRCUITO_VENTANA if ventana is None else ventana
+        self.min_llamadas = CIRCUITO_MIN_LLAMADAS if min_llamadas is None else min_llamadas
+        self.umbral_errores = CIRCUITO_UMBRAL_ERRORES if umbral_errores is None else umbral_errores
+        self.llamada_lenta = CIRCUITO_LLAMADA_LENTA if llamada_lenta is None else llamada_lenta
+        self.umbral_lentas = CIRCUITO_UMBRAL_LENTAS if umbral_lentas is None else umbral_lentas
+        self.tiempo_abierto = CIRCUITO_TIEMPO_ABIERTO if tiempo_abierto is None else tiempo_abierto
+        self.sondas = max(1, CIRCUITO_SONDAS if sondas is None else sondas)
+        self.aperturas = 0
+        self.rechazadas = 0
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._lock = threading.Lock()
+        self._estado = 'cerrado'
+        self._llamadas = deque()  # (instante, exito, lenta)
+        self._abierto_hasta = 0.0
+        self._sondas_en_curso = 0
+        self._sondas_exitosas = 0
+
+    def _purgar(self, ahora):
+        limite = ahora - self.ventana
+        while self._llamadas and self._llamadas[0][0] < limite:
+            self._llamadas.popleft()
+
+    def _abrir(self, ahora, motivo):
+        self._estado = 'abierto'
+        self._abierto_hasta = ahora + self.tiempo_abierto
+        self._llamadas.clear()
+        self._sondas_en_curso = 0
+        self._sondas_exitosas = 0
+        self.aperturas += 1
+        logger.warning("Circuito '%s' abierto (%s) durante %ss", self.nombre, motivo, self.tiempo_abierto,
+                       extra={'campos': {'circuito': self.nombre, 'estado': 'abierto'}})
+
+    def _rechazar(self, ahora):
+        self.rechazadas += 1
+        raise CircuitoAbiertoError(self.nombre, self._abierto_hasta - ahora)
+
+    def verificar(self):
+        """Lanza CircuitoAbiertoError si el circuito está abierto, sin consumir sondas"""
+        ahora = time.monotonic()
+        with self._lock:
+            if self._estado == 'abierto' and ahora < self._abierto_hasta:
+                self._rechazar(ahora)
+
+    def permitir(self):
+        """Reserva el paso de una llamada o lanza CircuitoAbiertoError"""
+        ahora = time.monotonic()
+        with self._lock:
+            if self._estado == 'abierto':
+                if ahora < self._abierto_hasta:
+                    self._rechazar(ahora)
+                self._estado = 'semiabierto'
+                logger.info("Circuito '%s' semiabierto: probando el upstream", self.nombre)
+            if self._estado == 'semiabierto':
+                if self._sondas_en_curso >= self.sondas:
+                    # Mientras las sondas no respondan se sigue fallando rápido
+                    self._abierto_hasta = ahora + 1
+                    self._rechazar(ahora)
+                self._sondas_en_curso += 1
+
+    def liberar(self):
+        """Devuelve el paso reservado por permitir() sin registrar resultado (error local, no del upstream)"""
+        with self._lock:
+            if self._estado == 'semiabierto':
+                self._sondas_en_curso = max(0, self._sondas_en_curso - 1)
+
+    def registrar(self, exito, duracion):
+        """Registra el resultado de una llamada permitida"""
+        ahora = time.monotonic()
+        lenta = duracion >= self.llamada_lenta
+        with self._lock:
+            if self._estado == 'semiabierto':
+                self._sondas_en_curso = max(0, self._sondas_en_curso - 1)
+                if not exito or lenta:
+                    self._abrir(ahora, 'falló la llamada de prueba')
+                    return
+                self._sondas_exitosas += 1
+                if self._sondas_exitosas >= self.sondas:
+                    self._estado = 'cerrado'
+                    self._llamadas.clear()
+                    logger.info("Circuito '%s' cerrado", self.nombre,
+                                extra={'campos': {'circuito': self.nombre, 'estado': 'cerrado'}})
+                return
+            if self._estado != 'cerrado':
+                return
+
+            self._llamadas.append((ahora, exito, lenta))
+            self._purgar(ahora)
+            total = len(self._llamadas)
+            if total < self.min_llamadas:
+                return
+            errores = sum(1 for _, ok, _ in self._llamadas if not ok)
+            lentas = sum(1 for _, _, es_lenta in self._llamadas if es_lenta)
+            if errores / total >= self.umbral_errores:
+                self._abrir(ahora, f'{errores}/{total} errores')
+            elif lentas / total >= self.umbral_lentas:
+                self._abrir(ahora, f'{lentas}/{total} llamadas lentas')
+
+    def estado(self):
+        ahora = time.monotonic()
+        with self._lock:
+            self._purgar(ahora)
+            total = len(self._llamadas)
+            return {
+                'estado': self._estado,
+                'reintentar_en': round(max(0.0, self._abierto_hasta - ahora), 1) if self._estado == 'abierto' else 0,
+                'llamadas_ventana': total,
+                'errores_ventana': sum(1 for _, ok, _ in self._llamadas if not ok),
+                'lentas_ventana': sum(1 for _, _, lenta in self._llamadas if lenta),
+                'aperturas': self.aperturas,
+                'rechazadas': self.rechazadas
+            }
+
+
+class PresupuestoReintentos:
+    """Limita los reintentos a una fracción de las llamadas recientes (todos los upstreams)"""
+
+    def __init__(self, ratio, minimo, ventana):
+        self.ratio = ratio
+        self.minimo = minimo
+        self.ventana = ventana
+        self.denegados = 0
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._lock = threading.Lock()
+        self._llamadas = deque()
+        self._reintentos = deque()
+
+    def _purgar(self, ahora):
+        limite = ahora - self.ventana
+        for instantes in (self._llamadas, self._reintentos):
+            while instantes and instantes[0] < limite:
+                instantes.popleft()
+
+    def registrar_llamada(self):
+        ahora = time.monotonic()
+        with self._lock:
+            self._llamadas.append(ahora)
+            self._purgar(ahora)
+
+    def consumir(self):
+        """Devuelve True si queda presupuesto para un reintento (y lo descuenta)"""
+        ahora = time.monotonic()
+        with self._lock:
+            self._purgar(ahora)
+            if len(self._reintentos) >= max(self.minimo, self.ratio * len(self._llamadas)):
+                self.denegados += 1
+                return False
+            self._reintentos.append(ahora)
+            return True
+
+    def estadisticas(self):
+        ahora = time.monotonic()
+        with self._lock:
+            self._purgar(ahora)
+            return {
+                'llamadas_ventana': len(self._llamadas),
+                'reintentos_ventana': len(self._reintentos),
+                'disponibles': max(0, int(max(self.minimo, self.ratio * len(self._llamadas))) - len(self._reintentos)),
+                'denegados': self.denegados
+            }
+
+
+presupuesto_reintentos = PresupuestoReintentos(REINTENTOS_PRESUPUESTO, REINTENTOS_MINIMO, CIRCUITO_VENTANA)
+
+
+def espera_reintento(intento):
+    """Backoff exponencial con jitter completo"""
+    return random.uniform(0, min(REINTENTOS_BACKOFF_MAX, REINTENTOS_BACKOFF_BASE * (2 ** intento)))
+
+
+# Bulkheads: concurrencia máxima por ruta y por upstream (0 = sin límite).
+# Cuando se alcanza el límite, hasta BULKHEAD_COLA peticiones esperan como mucho
+# BULKHEAD_ESPERA segundos; el resto recibe 429 (ruta) o 503 (upstream) con Retry-After.
+BULKHEAD_BIOMETRIA = _env_int('BULKHEAD_BIOMETRIA', 0)
+BULKHEAD_BATCH = _env_int('BULKHEAD_BATCH', max(1, GUNICORN_THREADS // 4))
+BULKHEAD_AUDIO = _env_int('BULKHEAD_AUDIO', max(1, GUNICORN_THREADS // 2 - 1))
+BULKHEAD_SEGUROS_BOLIVAR = _env_int('BULKHEAD_SEGUROS_BOLIVAR', 0)
+BULKHEAD_APPS_SCRIPT = _env_int('BULKHEAD_APPS_SCRIPT', max(1, GUNICORN_THREADS // 2))
+BULKHEAD_COLA = _env_int('BULKHEAD_COLA', 2)
+BULKHEAD_ESPERA = _env_float('BULKHEAD_ESPERA', 0.5)
+
+
+class CompartimentoLlenoError(ServicioNoDisponibleError):
+    """Se alcanzó el límite de concurrencia de una ruta o upstream"""
+
+    def __init__(self, nombre, reintentar_en, status_code):
+        super().__init__(f'Capacidad de {nombre} agotada, reintente en unos segundos',
+                         nombre, reintentar_en, status_code)
+
+
+class Compartimento:
+    """Bulkhead: limita cuántas peticiones usan a la vez un recurso.
+
+    Si no hay cupo se espera un tiempo corto en una cola acotada; pasado ese
+    tiempo, o con la cola llena, se rechaza de inmediato.
+    """
+
+    def __init__(self, nombre, limite, status_code=429, reintentar_en=1, cola=None, espera=None):
+        self.nombre = nombre
+        self.limite = limite
+        self.status_code = status_code
+        self.reintentar_en = reintentar_en
+        self.cola = BULKHEAD_COLA if cola is None else cola
+        self.espera = BULKHEAD_ESPERA if espera is None else espera
+        self.admitidas = 0
+        self.rechazadas = 0
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._lock = threading.Lock()
+        self._semaforo = threading.BoundedSemaphore(self.limite) if self.limite > 0 else None
+        self._en_curso = 0
+        self._esperando = 0
+
+    def _rechazar(self):
+        with self._lock:
+            self.rechazadas += 1
+        logger.warning("Bulkhead '%s' lleno (límite %s)", self.nombre, self.limite)
+        raise CompartimentoLlenoError(self.nombre, self.reintentar_en, self.status_code)
+
+    def adquirir(self, esperar=True):
+        """Ocupa un cupo o lanza CompartimentoLlenoError.
+
+        Con esperar=False, si no hay un cupo libre devuelve False sin esperar ni rechazar.
+        """
+        if self._semaforo is None:
+            return True
+        if not self._semaforo.acquire(blocking=False):
+            if not esperar:
+                return False
+            with self._lock:
+                if self._esperando >= self.cola:
+                    lleno = True
+                else:
+                    lleno = False
+                    self._esperando += 1
+            if lleno:
+                self._rechazar()
+            try:
+                admitida = self._semaforo.acquire(timeout=self.espera)
+            finally:
+                with self._lock:
+                    self._esperando -= 1
+            if not admitida:
+                self._rechazar()
+        with self._lock:
+            self._en_curso += 1
+            self.admitidas += 1
+        return True
+
+    def liberar(self):
+        if self._semaforo is None:
+            return
+        with self._lock:
+            self._en_curso -= 1
+        self._semaforo.release()
+
+    @contextlib.contextmanager
+    def entrar(self):
+        self.adquirir()
+        try:
+            yield
+        finally:
+            self.liberar()
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'limite': self.limite,
+                'en_curso': self._en_curso,
+                'esperando': self._esperando,
+                'cola': self.cola,
+                'admitidas': self.admitidas,
+                'rechazadas': self.rechazadas
+            }
+
+
+# Rate limiting hacia la API de biometría (cuota del upstream): token bucket de
+# RATE_LIMIT_BIOMETRIA peticiones/s con ráfagas de RATE_LIMIT_BIOMETRIA_RAFAGA
+# (0 lo desactiva). Por encima de la tasa las llamadas esperan su turno hasta
+# RATE_LIMIT_ESPERA_MAX segundos; si la espera sería mayor se responde 429.
+# Con RATE_LIMIT_STORE=archivo el bucket se comparte entre los workers del host.
+RATE_LIMIT_BIOMETRIA = _env_float('RATE_LIMIT_BIOMETRIA', 0)
+RATE_LIMIT_BIOMETRIA_RAFAGA = _env_int('RATE_LIMIT_BIOMETRIA_RAFAGA', 10)
+RATE_LIMIT_ESPERA_MAX = _env_float('RATE_LIMIT_ESPERA_MAX', 5)
+RATE_LIMIT_STORE = os.getenv('RATE_LIMIT_STORE', 'memoria')
+RATE_LIMIT_STORE_PATH = os.getenv('RATE_LIMIT_STORE_PATH', '/tmp/seguros_bolivar_rate')
+
+metrica_limite_espera = Histogram(
+    'rate_limit_wait_seconds', 'Espera por el rate limiter antes de llamar al upstream',
+    ['destino'], buckets=(0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+metrica_limite_rechazadas = Counter(
+    'rate_limit_rejected_total', 'Llamadas rechazadas por superar la espera máxima del rate limiter',
+    ['destino']
+)
+
+
+class LimiteTasaError(ServicioNoDisponibleError):
+    """La espera por el rate limiter superaría RATE_LIMIT_ESPERA_MAX"""
+
+    def __init__(self, nombre, reintentar_en):
+        super().__init__(f'Cuota de {nombre} agotada, reintente en unos segundos',
+                         nombre, reintentar_en, status_code=429)
+
+
+class EstadoTasaMemoria:
+    """Estado del bucket por proceso"""
+
+    def __init__(self):
+        self._estado = None
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def bloqueo(self):
+        with self._lock:
+            yield
+
+    def leer(self):
+        return self._estado
+
+    def escribir(self, fichas, instante):
+        self._estado = (fichas, instante)
+
+
+class EstadoTasaArchivo:
+    """Estado del bucket compartido entre los workers del host (flock + 16 bytes)"""
+
+    _FORMATO = struct.Struct('dd')
+
+    def __init__(self, ruta):
+        if fcntl is None:
+            raise RuntimeError("RATE_LIMIT_STORE=archivo requiere fcntl (solo POSIX)")
+        self.ruta = ruta
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        # El descriptor se abre en cada proceso: flock es por descripción de archivo
+        self._fd = None
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def bloqueo(self):
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def leer(self):
+        datos = os.pread(self._fd, self._FORMATO.size, 0)
+        if len(datos) < self._FORMATO.size:
+            return None
+        return self._FORMATO.unpack(datos)
+
+    def escribir(self, fichas, instante):
+        os.pwrite(self._fd, self._FORMATO.pack(fichas, instante), 0)
+
+
+class LimitadorTasa:
+    """Token bucket con reserva de turnos.
+
+    Cada llamada toma una ficha; si no quedan, reserva la siguiente (las fichas
+    quedan en negativo) y espera fuera del lock hasta su turno, así las llamadas
+    salen espaciadas a la tasa configurada en lugar de fallar.
+    """
+
+    def __init__(self, nombre, tasa, rafaga, espera_max=None, estado=None):
+        self.nombre = nombre
+        self.tasa = tasa
+        self.rafaga = max(1, rafaga)
+        self.espera_max = RATE_LIMIT_ESPERA_MAX if espera_max is None else espera_max
+        self.estado = estado or EstadoTasaMemoria()
+        self.admitidas = 0
+        self.demoradas = 0
+        self.rechazadas = 0
+
+    def reservar(self):
+        """Reserva un turno y devuelve los segundos a esperar, o lanza LimiteTasaError"""
+        with self.estado.bloqueo():
+            ahora = time.time()
+            previo = self.estado.leer()
+            fichas = self.rafaga if previo is None else min(self.rafaga, previo[0] + (ahora - previo[1]) * self.tasa)
+            espera = 0.0 if fichas >= 1 else (1 - fichas) / self.tasa
+            if espera > self.espera_max:
+                self.rechazadas += 1
+                metrica_limite_rechazadas.labels(self.nombre).inc()
+                raise LimiteTasaError(self.nombre, espera)
+            self.estado.escribir(fichas - 1, ahora)
+            self.admitidas += 1
+            if espera > 0:
+                self.demoradas += 1
+        metrica_limite_espera.labels(self.nombre).observe(espera)
+        return espera
+
+    def esperar_turno(self):
+        espera = self.reservar()
+        if espera > 0:
+            time.sleep(espera)
+
+    def frenar(self, segundos):
+        """El upstream respondió 429: nadie llama hasta dentro de `segundos`"""
+        with self.estado.bloqueo():
+            ahora = time.time()
+            previo = self.estado.leer()
+            fichas = self.rafaga if previo is None else min(self.rafaga, previo[0] + (ahora - previo[1]) * self.tasa)
+            self.estado.escribir(min(fichas, 0.0) - segundos * self.tasa, ahora)
+        logger.warning("Upstream '%s' respondió 429: pausa de %.1fs", self.nombre, segundos)
+
+    def estadisticas(self):
+        return {
+            'tasa': self.tasa,
+            'rafaga': self.rafaga,
+            'espera_max': self.espera_max,
+            'admitidas': self.admitidas,
+            'demoradas': self.demoradas,
+            'rechazadas': self.rechazadas
+        }
+
+
+def crear_limitador_tasa(destino, tasa, rafaga):
+    """Limitador del destino con el almacén configurado en RATE_LIMIT_STORE, o None si tasa es 0"""
+    if tasa <= 0:
+        return None
+    if RATE_LIMIT_STORE == 'archivo':
+        ruta = f"{RATE_LIMIT_STORE_PATH}_{destino}.bin"
+        logger.info("Rate limit de '%s' compartido en %s", destino, ruta)
+        return LimitadorTasa(destino, tasa, rafaga, estado=EstadoTasaArchivo(ruta))
+    return LimitadorTasa(destino, tasa, rafaga)
+
+
+def segundos_retry_after(response):
+    """Segundos del header Retry-After (solo formato numérico), o None"""
+    valor = response.headers.get('Retry-After', '').strip()
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        return None
+
+
+def conexion_no_establecida(error):
+    """Indica si el error ocurrió al abrir la conexión, antes de enviar la petición.
+
+    ConnectionError de requests también cubre "Connection aborted" o
+    RemoteDisconnected con la petición ya enviada, que el upstream pudo haber
+    procesado: esos no se reintentan.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    # MaxRetryError de urllib3 con NewConnectionError/NameResolutionError como motivo
+    motivo = getattr(error.args[0], 'reason', error.args[0])
+    return isinstance(motivo, ConnectTimeoutError)
+
+
+def liberar_al_cerrar(response, liberar):
+    """Llama a liberar() una sola vez, la primera vez que se cierra la respuesta"""
+    cerrar = response.close
+    pendiente = threading.Lock()
+
+    def close():
+        try:
+            cerrar()
+        finally:
+            if pendiente.acquire(blocking=False):
+                liberar()
+
+    response.close = close
+
+
+class PoolHTTP:
+    """Sesión HTTP con pool de conexiones keep-alive compartida entre hilos.
+
+    Solo reintenta errores de conexión (la petición no llegó a enviarse), por lo
+    que es seguro usarla con POST. La sesión se crea de forma perezosa y se
+    descarta tras un fork para que cada worker de gunicorn abra sus propios sockets.
+    Con un circuito, las llamadas pasan por el circuit breaker y los reintentos
+    (también de 502/503/504) usan backoff con jitter dentro del presupuesto global.
+    Con un compartimento, se limita cuántas llamadas al upstream hay en curso
+    (con stream=True, hasta cerrar la respuesta), y con limitadores, la tasa de
+    llamadas por destino (429 del upstream incluido).
+    """
+
+    def __init__(self, nombre, pool_size=None, reintentos=None, circuito=None, compartimento=None,
+                 limitadores=None):
+        self.nombre = nombre
+        self.pool_size = pool_size or HTTP_POOL_SIZE
+        self.reintentos = HTTP_POOL_RETRIES if reintentos is None else reintentos
+        self.circuito = circuito
+        self.compartimento = compartimento
+        # destino -> LimitadorTasa: cada intento de llamada a ese destino espera su turno
+        self.limitadores = {destino: l for destino, l in (limitadores or {}).items() if l is not None}
+        self._sesion = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _crear_sesion(self):
+        # Con circuito los reintentos los hace _llamar (con presupuesto), no urllib3
+        reintentos_urllib3 = 0 if self.circuito else self.reintentos
+        retry = Retry(
+            total=reintentos_urllib3,
+            connect=reintentos_urllib3,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=0.1
+        )
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=self.pool_size,
+            max_retries=retry
+        )
+        sesion = requests.Session()
+        sesion.mount('https://', adapter)
+        sesion.mount('http://', adapter)
+        logger.info("Pool HTTP '%s' creado (maxsize=%s, reintentos=%s)", self.nombre, self.pool_size, self.reintentos)
+        return sesion
+
+    def _reiniciar_tras_fork(self):
+        """En el proceso hijo no se reutilizan sockets ni locks del padre"""
+        self._lock = threading.Lock()
+        self._sesion = None
+
+    @property
+    def sesion(self):
+        if self._sesion is None:
+            with self._lock:
+                if self._sesion is None:
+                    self._sesion = self._crear_sesion()
+        return self._sesion
+
+    def get(self, url, destino=None, **kwargs):
+        return self._llamar('GET', url, destino or self.nombre, **kwargs)
+
+    def post(self, url, destino=None, **kwargs):
+        return self._llamar('POST', url, destino or self.nombre, **kwargs)
+
+    def _llamar(self, metodo, url, destino, **kwargs):
+        if self.compartimento is None:
+            return self._llamar_con_circuito(metodo, url, destino, **kwargs)
+        if not kwargs.get('stream'):
+            with self.compartimento.entrar():
+                return self._llamar_con_circuito(metodo, url, destino, **kwargs)
+
+        # Con stream=True el body se lee después: el cupo se libera al cerrar la respuesta
+        self.compartimento.adquirir()
+        try:
+            response = self._llamar_con_circuito(metodo, url, destino, **kwargs)
+        except BaseException:
+            self.compartimento.liberar()
+            raise
+        liberar_al_cerrar(response, self.compartimento.liberar)
+        return response
+
+    def _enviar(self, metodo, url, destino, **kwargs):
+        """Un intento de llamada, medido en las métricas del upstream"""
+        en_curso = metrica_upstream_en_curso.labels(destino)
+        en_curso.inc()
+        inicio = time.perf_counter()
+        status = 'error'
+        try:
+            with medir_fase(f'upstream_{destino}'):
+                response = self.sesion.request(metodo, url, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            en_curso.dec()
+            metrica_upstream.labels(destino, status).observe(time.perf_counter() - inicio)
+            anotaciones = _diario_peticion.get()
+            if anotaciones is not None:
+                anotaciones['upstreams'][destino] = status
+
+    def _esperar_turno(self, destino):
+        limitador = self.limitadores.get(destino)
+        if limitador is not None:
+            with medir_fase('limite_tasa'):
+                limitador.esperar_turno()
+
+    def _llamar_con_circuito(self, metodo, url, destino, cobertura=False, **kwargs):
+        if self.circuito is None:
+            self._esperar_turno(destino)
+            return self._enviar(metodo, url, destino, **kwargs)
+
+        # Una cobertura (hedging) ya se descontó como reintento: no cuenta como llamada original
+        if not cobertura:
+            presupuesto_reintentos.registrar_llamada()
+        intento = 0
+        while True:
+            self._esperar_turno(destino)
+            self.circuito.permitir()
+            inicio = time.monotonic()
+            try:
+                response = self._enviar(metodo, url, destino, **kwargs)
+            except ERRORES_TRANSPORTE as e:
+                self.circuito.registrar(False, time.monotonic() - inicio)
+                # Solo un error al abrir la conexión garantiza que la petición no se procesó
+                if not conexion_no_establecida(e) or not self._reintentar(intento, e):
+                    raise
+            except BaseException:
+                # Error local (p. ej. un header inválido): no dice nada del upstream
+                self.circuito.liberar()
+                raise
+            else:
+                self.circuito.registrar(respuesta_exitosa(response.status_code), time.monotonic() - inicio)
+                retry_after = self._atender_429(response, destino)
+                if (response.status_code not in STATUS_REINTENTABLES or
+                        not self._reintentar(intento, response.status_code, retry_after)):
+                    return response
+                response.close()
+            intento += 1
+
+    def _atender_429(self, response, destino):
+        """Con un 429 frena el limitador del destino. Devuelve el Retry-After en segundos o None"""
+        if response.status_code != 429:
+            return None
+        retry_after = segundos_retry_after(response)
+        limitador = self.limitadores.get(destino)
+        if limitador is not None:
+            limitador.frenar(retry_after if retry_after is not None else 1 / limitador.tasa)
+            # El turno del reintento ya lo regula el limitador
+            return 0.0
+        return retry_after
+
+    def _reintentar(self, intento, motivo, retry_after=None):
+        """Espera el backoff (o el Retry-After) si quedan intentos y presupuesto de reintentos"""
+        if intento >= self.reintentos:
+            return False
+        espera = espera_reintento(intento) if retry_after is None else retry_after
+        if espera > RATE_LIMIT_ESPERA_MAX or not presupuesto_reintentos.consumir():
+            return False
+        logger.warning("Reintentando llamada a '%s' (%s) en %.2fs", self.nombre, motivo, espera)
+        time.sleep(espera)
+        return True
+
+    def cerrar(self):
+        with self._lock:
+            if self._sesion is not None:
+                self._sesion.close()
+                self._sesion = None
+
+
+# Renovación anticipada del token OAuth2 (segundos antes de token_expiry)
+TOKEN_REFRESCO_ANTICIPADO = _env_int('TOKEN_REFRESCO_ANTICIPADO', 300)
+# Espera entre reintentos cuando falla una renovación en segundo plano
+TOKEN_REINTENTO_REFRESCO = _env_int('TOKEN_REINTENTO_REFRESCO', 15)
+# Almacén del token: 'memoria' (un token por worker) o 'archivo' (compartido en el host)
+TOKEN_STORE = os.getenv('TOKEN_STORE', 'memoria')
+TOKEN_STORE_PATH = os.getenv('TOKEN_STORE_PATH', '/tmp/seguros_bolivar_token.json')
+
+
+class AlmacenTokenMemoria:
+    """Almacén por proceso: cada worker mantiene su propio token"""
+
+    def leer(self):
+        return None
+
+    def escribir(self, access_token, token_expiry, token_emitido):
+        pass
+
+    def bloqueo(self):
+        return contextlib.nullcontext()
+
+
+class AlmacenTokenArchivo:
+    """Token compartido entre los workers del host en un archivo local.
+
+    Las renovaciones se serializan entre procesos con flock sobre un archivo
+    .lock, de modo que un solo worker pide el token y el resto lo reutiliza.
+    """
+
+    def __init__(self, ruta):
+        if fcntl is None:
+            raise RuntimeError("TOKEN_STORE=archivo requiere fcntl (solo POSIX)")
+        self.ruta = ruta
+        self.ruta_lock = f"{ruta}.lock"
+
+    def leer(self):
+        try:
+            with open(self.ruta, 'r') as f:
+                data = json.load(f)
+            return data['access_token'], data['token_expiry'], data['token_emitido']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def escribir(self, access_token, token_expiry, token_emitido):
+        # Escritura atómica con permisos restringidos (el archivo contiene un secreto)
+        temporal = f"{self.ruta}.{os.getpid()}.tmp"
+        fd = os.open(temporal, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'access_token': access_token,
+                'token_expiry': token_expiry,
+                'token_emitido': token_emitido
+            }, f)
+        os.replace(temporal, self.ruta)
+
+    @contextlib.contextmanager
+    def bloqueo(self):
+        fd = os.open(self.ruta_lock, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def crear_almacen_token():
+    """Crea el almacén de token configurado en TOKEN_STORE"""
+    if TOKEN_STORE == 'archivo':
+        logger.info("Token OAuth2 compartido en %s", TOKEN_STORE_PATH)
+        return AlmacenTokenArchivo(TOKEN_STORE_PATH)
+    return AlmacenTokenMemoria()
+
+
+class GestorToken:
+    """Gestiona el token OAuth2 compartido por todos los hilos del worker.
+
+    Solo se ejecuta una renovación a la vez: los hilos que llegan mientras hay
+    una en curso esperan su resultado en lugar de pedir otro token. Un hilo en
+    segundo plano renueva el token antes de que expire, y si una renovación
+    falla se sigue sirviendo el token anterior mientras sea válido. Con un
+    almacén compartido, antes de pedir un token se reutiliza el que otro
+    worker haya renovado.
+    """
+
+    def __init__(self, solicitar_token, almacen=None, refresco_anticipado=None, reintento=None):
+        # solicitar_token() -> (access_token, expires_in) o None
+        self._solicitar_token = solicitar_token
+        self.almacen = almacen or AlmacenTokenMemoria()
+        self.refresco_anticipado = TOKEN_REFRESCO_ANTICIPADO if refresco_anticipado is None else refresco_anticipado
+        self.reintento = TOKEN_REINTENTO_REFRESCO if reintento is None else reintento
+        self.access_token = None
+        self.token_expiry = None
+        self._token_emitido = None
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        """Los hilos no sobreviven a un fork: el hijo arranca su propio refresco"""
+        self._cond = threading.Condition()
+        self._refrescando = False
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def token_valido(self):
+        """Verifica si el token actual es válido"""
+        return (self.access_token is not None and
+                self.token_expiry is not None and
+                time.time() < self.token_expiry)
+
+    def obtener(self):
+        """Devuelve un token válido, renovándolo solo si es necesario"""
+        self._iniciar_refresco_proactivo()
+        if self.token_valido():
+            return self.access_token
+        return self._renovar('expirado')
+
+    def refrescar(self, forzar=True):
+        """Renueva el token (single-flight). Devuelve el token o None si falla"""
+        return self._renovar('forzado' if forzar else 'expirado')
+
+    def _anticipo(self, token_expiry, token_emitido):
+        # Con tokens de vida corta no anticipar más de la mitad de su duración
+        vida = token_expiry - token_emitido
+        return min(self.refresco_anticipado, max(vida / 2, 0))
+
+    def _token_util(self, datos, motivo):
+        """Indica si un token (access_token, token_expiry, token_emitido) evita renovar"""
+        if motivo == 'forzado' or not datos or datos[0] is None or datos[1] is None:
+            return False
+        access_token, token_expiry, token_emitido = datos
+        limite = token_expiry
+        if motivo == 'proactivo':
+            limite -= self._anticipo(token_expiry, token_emitido)
+        return time.time() < limite
+
+    def _renovar(self, motivo):
+        with self._cond:
+            if self._refrescando:
+                # Otro hilo ya está renovando: esperar su resultado
+                while self._refrescando:
+                    self._cond.wait()
+                return self.access_token if self.token_valido() else None
+            if self._token_util((self.access_token, self.token_expiry, self._token_emitido), motivo):
+                return self.access_token
+            self._refrescando = True
+
+        datos = None
+        try:
+            with self.almacen.bloqueo():
+                compartido = self.almacen.leer()
+                if self._token_util(compartido, motivo):
+                    logger.info("Token reutilizado del almacén compartido")
+                    datos = compartido
+                else:
+                    inicio = time.perf_counter()
+                    resultado = self._solicitar_token()
+                    metrica_token.labels(motivo, 'ok' if resultado else 'error').observe(time.perf_counter() - inicio)
+                    if resultado:
+                        access_token, expires_in = resultado
+                        token_emitido = time.time()
+                        datos = (access_token, token_emitido + expires_in - 60, token_emitido)  # 1 minuto de margen
+                        try:
+                            self.almacen.escribir(*datos)
+                        except OSError as e:
+                            logger.warning("No se pudo guardar el token compartido: %s", e)
+        except Exception as e:
+            logger.error("Error renovando token: %s", e)
+        finally:
+            with self._cond:
+                if datos:
+                    self.access_token, self.token_expiry, self._token_emitido = datos
+                self._refrescando = False
+                self._cond.notify_all()
+
+        if not datos:
+            if self.token_valido():
+                logger.warning("Falló la renovación del token, se mantiene el token vigente")
+            return None
+        self._despertar.set()
+        return datos[0]
+
+    def iniciar_refresco(self):
+        """Arranca el refresco en segundo plano si este proceso aún no lo tiene"""
+        self._iniciar_refresco_proactivo()
+
+    def _iniciar_refresco_proactivo(self):
+        if self._hilo is not None:
+            return
+        with self._cond:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle_refresco, name='refresco-token', daemon=True)
+                self._hilo.start()
+
+    def _segundos_hasta_refresco(self):
+        if self.token_expiry is None:
+            return None
+        anticipo = self._anticipo(self.token_expiry, self._token_emitido)
+        return self.token_expiry - anticipo - time.time()
+
+    def _bucle_refresco(self):
+        while True:
+            espera = self._segundos_hasta_refresco()
+            if espera is None or espera > 0:
+                # Sin token todavía: esperar a que un hilo obtenga el primero
+                self._despertar.wait(espera)
+                self._despertar.clear()
+                continue
+            logger.info("Renovando token OAuth2 en segundo plano")
+            if self._renovar('proactivo') is None:
+                time.sleep(self.reintento)
+
+
+# Cache de respuestas de biometría (0 entradas la desactiva)
+BIOMETRIA_CACHE_MAX = _env_int('BIOMETRIA_CACHE_MAX', 1024)
+BIOMETRIA_CACHE_TTL = _env_int('BIOMETRIA_CACHE_TTL', 300)
+
+
+class CacheTTL:
+    """Cache LRU en memoria, acotada en entradas y con expiración por TTL.
+
+    Guarda y devuelve copias, así los llamadores pueden modificar el resultado.
+    """
+
+    def __init__(self, max_entradas, ttl, nombre='biometria'):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.nombre = nombre
+        self._metrica_hit = metrica_cache.labels(nombre, 'hit')
+        self._metrica_miss = metrica_cache.labels(nombre, 'miss')
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirados = 0
+
+    def obtener(self, clave):
+        if self.max_entradas <= 0:
+            return None
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                self.misses += 1
+                self._metrica_miss.inc()
+                return None
+            expira, valor = entrada
+            if time.time() >= expira:
+                del self._datos[clave]
+                self.expirados += 1
+                self.misses += 1
+                self._metrica_miss.inc()
+                return None
+            self._datos.move_to_end(clave)
+            self.hits += 1
+        self._metrica_hit.inc()
+        return copy.deepcopy(valor)
+
+    def guardar(self, clave, valor):
+        if self.max_entradas <= 0:
+            return
+        valor = copy.deepcopy(valor)
+        with self._lock:
+            self._datos[clave] = (time.time() + self.ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                self.evictions += 1
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.hits + self.misses
+            return {
+                'entradas': len(self._datos),
+                'max_entradas': self.max_entradas,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirados': self.expirados,
+                'hit_ratio': round(self.hits / consultas, 4) if consultas else 0.0
+            }
+
+
+class CoalescedorLlamadas:
+    """Agrupa llamadas concurrentes con la misma clave en una sola ejecución.
+
+    El primer hilo ejecuta la función; los que llegan mientras está en curso
+    esperan y reciben el mismo resultado (cada uno una copia propia).
+    """
+
+    def __init__(self):
+        self._en_curso = {}
+        self._lock = threading.Lock()
+        self.ejecutadas = 0
+        self.agrupadas = 0
+
+    def ejecutar(self, clave, funcion):
+        with self._lock:
+            futuro = self._en_curso.get(clave)
+            lider = futuro is None
+            if lider:
+                futuro = Future()
+                self._en_curso[clave] = futuro
+                self.ejecutadas += 1
+            else:
+                self.agrupadas += 1
+
+        if lider:
+            try:
+                futuro.set_result(funcion())
+            except BaseException as e:
+                futuro.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._en_curso[clave]
+
+        return copy.deepcopy(futuro.result())
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'en_curso': len(self._en_curso),
+                'ejecutadas': self.ejecutadas,
+                'agrupadas': self.agrupadas
+            }
+
+
+# Hedged requests hacia la API de biometría: si la llamada no responde dentro
+# del percentil HEDGE_PERCENTIL de las latencias recientes se lanza una segunda
+# idéntica (mismo X-Id_transaction) y se usa la que responda primero. Las
+# llamadas extra se limitan a HEDGE_MAX_EXTRA de las llamadas de la ventana.
+HEDGE_BIOMETRIA = os.getenv('HEDGE_BIOMETRIA', 'false').lower() == 'true'
+HEDGE_PERCENTIL = _env_float('HEDGE_PERCENTIL', 0.95)
+HEDGE_RETRASO_MIN = _env_float('HEDGE_RETRASO_MIN', 0.05)
+HEDGE_MAX_EXTRA = _env_float('HEDGE_MAX_EXTRA', 0.1)
+HEDGE_MINIMO = _env_int('HEDGE_MINIMO', 2)
+# Latencias necesarias antes de empezar a cubrir llamadas
+HEDGE_MUESTRAS_MIN = _env_int('HEDGE_MUESTRAS_MIN', 20)
+
+metrica_hedge = Counter(
+    'hedged_requests_total', 'Llamadas de cobertura (hedging): disparadas, ganadas y omitidas por presupuesto',
+    ['destino', 'resultado']
+)
+
+
+class Cobertura:
+    """Hedged requests: cubre la llamada lenta con una segunda idéntica.
+
+    Solo es seguro para llamadas idempotentes. La llamada original corre en un
+    hilo del executor; si no termina en el retraso adaptativo (percentil de las
+    últimas latencias) y queda presupuesto, se lanza la segunda y se devuelve
+    la primera respuesta útil (sin excepción y status < 500). La otra no se
+    puede cancelar con requests: se deja terminar y se descarta.
+
+    La segunda llamada se descuenta como reintento del presupuesto global
+    (presupuesto_global) y se hace con funcion(cobertura=True), para que
+    PoolHTTP no la vuelva a contar como llamada original.
+    """
+
+    def __init__(self, destino, activa, percentil, retraso_min, muestras_min, presupuesto, ventana=200,
+                 presupuesto_global=None):
+        self.destino = destino
+        self.activa = activa
+        self.percentil = percentil
+        self.retraso_min = retraso_min
+        self.muestras_min = muestras_min
+        self.presupuesto = presupuesto
+        self.presupuesto_global = presupuesto_global
+        self.ventana = ventana
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._lock = threading.Lock()
+        self._latencias = deque(maxlen=self.ventana)
+        self._nuevas = 0
+        self._retraso = None
+        self._executor = None
+        self.disparadas = 0
+        self.ganadas = 0
+        self.omitidas = 0
+
+    @staticmethod
+    def hilos_necesarios():
+        """Dos intentos por cada hilo que puede consultar a la vez, para que ninguno espere en cola.
+
+        Consultan los hilos de gunicorn (ningún bulkhead de ruta admite más) y
+        los del executor del batch, que comparten esta cobertura.
+        """
+        return 2 * (GUNICORN_THREADS + BATCH_MAX_CONCURRENCIA)
+
+    def _obtener_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.hilos_necesarios(), thread_name_prefix=f'hedge-{self.destino}'
+                    )
+        return self._executor
+
+    def _registrar_latencia(self, segundos):
+        with self._lock:
+            self._latencias.append(segundos)
+            self._nuevas += 1
+            # El percentil se recalcula cada 10 muestras, no en cada llamada
+            if len(self._latencias) >= self.muestras_min and (self._retraso is None or self._nuevas >= 10):
+                ordenadas = sorted(self._latencias)
+                indice = min(len(ordenadas) - 1, int(self.percentil * len(ordenadas)))
+                self._retraso = max(self.retraso_min, ordenadas[indice])
+                self._nuevas = 0
+
+    def retraso(self):
+        """Segundos a esperar antes de cubrir la llamada, o None si aún no hay suficientes muestras"""
+        return self._retraso
+
+    def _intentar(self, funcion):
+        inicio = time.monotonic()
+        response = funcion()
+        self._registrar_latencia(time.monotonic() - inicio)
+        return response
+
+    def _lanzar(self, funcion):
+        # Cada intento con su copia del contexto: fases de Server-Timing y diario de la petición
+        return self._obtener_executor().submit(contextvars.copy_context().run, self._intentar, funcion)
+
+    def ejecutar(self, funcion):
+        """Ejecuta funcion() (devuelve un requests.Response) con cobertura si está activa.
+
+        funcion debe aceptar cobertura=True para la segunda llamada (como PoolHTTP.post).
+        """
+        if not self.activa:
+            return funcion()
+        self.presupuesto.registrar_llamada()
+        retraso = self.retraso()
+        if retraso is None:
+            return self._intentar(funcion)
+
+        original = self._lanzar(funcion)
+        try:
+            return original.result(timeout=retraso)
+        except FuturoTimeoutError:
+            pass
+
+        if not self.presupuesto.consumir() or (self.presupuesto_global is not None and
+                                               not self.presupuesto_global.consumir()):
+            with self._lock:
+                self.omitidas += 1
+            metrica_hedge.labels(self.destino, 'omitida').inc()
+            return original.result()
+
+        cobertura = self._lanzar(functools.partial(funcion, cobertura=True))
+        with self._lock:
+            self.disparadas += 1
+        metrica_hedge.labels(self.destino, 'disparada').inc()
+        logger.info("Llamada a '%s' sin respuesta en %.0f ms: se lanza la cobertura", self.destino, retraso * 1000)
+        return self._primera_util(original, cobertura)
+
+    def _primera_util(self, original, cobertura):
+        pendientes = {original, cobertura}
+        ultima = None
+        error = None
+        while pendientes:
+            terminados, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            # Si terminan a la vez se prefiere la original
+            for futuro in sorted(terminados, key=lambda f: f is cobertura):
+                if futuro.exception() is not None:
+                    error = error or futuro.exception()
+                    continue
+                response = futuro.result()
+                if response.status_code < 500:
+                    if futuro is cobertura:
+                        with self._lock:
+                            self.ganadas += 1
+                        metrica_hedge.labels(self.destino, 'ganada').inc()
+                    for otro in pendientes | (terminados - {futuro}):
+                        otro.add_done_callback(self._descartar)
+                    if ultima is not None:
+                        ultima.close()
+                    return response
+                if ultima is not None:
+                    ultima.close()
+                ultima = response
+        if ultima is not None:
+            return ultima
+        raise error
+
+    @staticmethod
+    def _descartar(futuro):
+        if futuro.exception() is None:
+            futuro.result().close()
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'activa': self.activa,
+                'retraso_ms': round(self._retraso * 1000, 1) if self._retraso is not None else None,
+                'muestras': len(self._latencias),
+                'disparadas': self.disparadas,
+                'ganadas': self.ganadas,
+                'omitidas': self.omitidas,
+                'presupuesto': self.presupuesto.estadisticas()
+            }
+
+
+# Configuración de la API de Seguros Bolívar
+class SegurosBolivarAPI:
+    def __init__(self):
+        self.client_id = os.getenv('SEGUROS_CLIENT_ID', '7p2djtisjjsng91q8laktkmp36')
+        self.client_secret = os.getenv('SEGUROS_CLIENT_SECRET', '1ocv4ohfjqu69r7cukebhccbk51panhqdgfl31fu2og49d3hmk1s')
+        self.token_url = os.getenv('SEGUROS_TOKEN_URL', 'https://api-conecta.segurosbolivar.com/prod/oauth2/token')
+        self.biometric_url = os.getenv(
+            'SEGUROS_BIOMETRIC_URL',
+            'https://api-conecta.segurosbolivar.com/prod/identidadDigital/biometria/facial/url'
+        )
+        self.http = PoolHTTP(
+            'seguros_bolivar',
+            circuito=Circuito('seguros_bolivar'),
+            compartimento=Compartimento('seguros_bolivar', BULKHEAD_SEGUROS_BOLIVAR, status_code=503),
+            limitadores={
+                'biometria': crear_limitador_tasa('biometria', RATE_LIMIT_BIOMETRIA, RATE_LIMIT_BIOMETRIA_RAFAGA)
+            }
+        )
+        self.gestor_token = GestorToken(self._solicitar_token, almacen=crear_almacen_token())
+        self.cache = CacheTTL(BIOMETRIA_CACHE_MAX, BIOMETRIA_CACHE_TTL)
+        self.coalescedor = CoalescedorLlamadas()
+        # Es seguro repetir la consulta: el upstream la identifica por X-Id_transaction
+        self.cobertura = Cobertura(
+            'biometria', HEDGE_BIOMETRIA, HEDGE_PERCENTIL, HEDGE_RETRASO_MIN, HEDGE_MUESTRAS_MIN,
+            PresupuestoReintentos(HEDGE_MAX_EXTRA, HEDGE_MINIMO, CIRCUITO_VENTANA),
+            presupuesto_global=presupuesto_reintentos
+        )
+
+    def generar_id_transaccion(self):
+        """Genera un ID único para la transacción"""
+        timestamp = str(int(time.time()))
+        random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=10))
+        return f"{timestamp}{random_str}"
+
+    def _solicitar_token(self):
+        """Solicita un token OAuth2 nuevo. Devuelve (access_token, expires_in) o None"""
+        try:
+            payload = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'scope': 'aws.cognito.signin.user.admin SrcServerCognitoConecta/ConectaApiScope'
+            }
+
+            headers = {
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
+
+            logger.info("Solicitando token OAuth2...")
+            response = self.http.post(self.token_url, destino='token', data=payload, headers=headers, timeout=30)
+
+            if response.status_code != 200:
+                logger.error("Error al obtener token: %s - %s", response.status_code, Recortado(response.content))
+                return None
+
+            data = response.json()
+            access_token = data.get('access_token')
+            if not access_token:
+                logger.error("Respuesta de token sin access_token")
+                return None
+
+            logger.info("Token obtenido exitosamente")
+            # Por defecto el token dura 1 hora
+            return access_token, data.get('expires_in', 3600)
+
+        except Exception as e:
+            logger.error("Error al solicitar token: %s", e)
+            return None
+
+    def obtener_token(self):
+        """Fuerza la renovación del token OAuth2 a través del gestor"""
+        return self.gestor_token.refrescar()
+
+    def token_valido(self):
+        """Verifica si el token actual es válido"""
+        return self.gestor_token.token_valido()
+
+    @property
+    def access_token(self):
+        return self.gestor_token.access_token
+
+    @property
+    def token_expiry(self):
+        return self.gestor_token.token_expiry
+
+    def consultar_biometria_facial(self, numero_documento, tipo_documento='CC', id_transaccion=None):
+        """Consulta la URL de biometría facial"""
+        # Los reintentos con el mismo idTransaccion se responden desde la cache
+        clave = (id_transaccion, str(numero_documento), tipo_documento) if id_transaccion else None
+        if clave:
+            with medir_fase('cache'):
+                cacheado = self.cache.obtener(clave)
+            if cacheado is not None:
+                logger.info("Respuesta de biometría desde cache para transacción: %s", id_transaccion)
+                return cacheado
+
+        def consultar():
+            resultado = self._consultar_biometria_upstream(numero_documento, tipo_documento, id_transaccion)
+            if clave and not resultado.get('error'):
+                self.cache.guardar(clave, resultado)
+            return resultado
+
+        if not clave:
+            return consultar()
+        # Peticiones idénticas concurrentes comparten una sola llamada al upstream
+        return self.coalescedor.ejecutar(clave, consultar)
+
+    def preparar_consulta_biometria(self, access_token, numero_documento, tipo_documento, id_transaccion):
+        """Devuelve (headers, body) de la consulta de biometría"""
+        # Usar ID de transacción proporcionado o generar uno nuevo
+        transaction_id = id_transaccion or self.generar_id_transaccion()
+        anotar_diario('id_transaccion', transaction_id)
+
+        # Preparar headers (valores fijos como en Apps Script)
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'X-Channel': 'SEGUROS_BOLIVAR',
+            'X-IPAddr': '186.82.101.105',
+            'X-Id_transaction': transaction_id,
+            'process': 'indem_patri',
+            'Content-Type': 'application/json'
+        }
+
+        # Preparar body
+        body_data = {
+            'userData': {
+                'userId': str(numero_documento),
+                'userType': tipo_documento
+            }
+        }
+
+        logger.info("Consultando biometría documento=%s transacción=%s", Enmascarado(numero_documento), transaction_id)
+        if muestrear_payload():
+            logger.debug("Biometría headers=%s body=%s", Recortado(headers), Recortado(body_data))
+
+        return headers, body_data
+
+    def procesar_respuesta_biometria(self, response):
+        """Convierte la respuesta HTTP del upstream en el resultado de la consulta"""
+        logger.info("Respuesta de biometría: %s", response.status_code,
+                    extra={'campos': {'upstream': 'biometria', 'status': response.status_code}})
+        if muestrear_payload():
+            logger.debug("Biometría response=%s", Recortado(response.content))
+
+        if response.status_code != 200:
+            return {
+                'error': True,
+                'message': f'API Error {response.status_code}: {response.text}',
+                'status_code': response.status_code
+            }
+
+        return response.json()
+
+    def _consultar_biometria_upstream(self, numero_documento, tipo_documento, id_transaccion):
+        """Llama a la API de Seguros Bolívar para obtener la URL de biometría"""
+        try:
+            # Con el circuito abierto no se espera ni siquiera por el token
+            self.http.circuito.verificar()
+
+            # Obtener token vigente (el gestor lo renueva solo si hace falta)
+            with medir_fase('token'):
+                access_token = self.gestor_token.obtener()
+            if not access_token:
+                return {
+                    'error': True,
+                    'message': 'No se pudo obtener el token de acceso'
+                }
+
+            headers, body_data = self.preparar_consulta_biometria(
+                access_token, numero_documento, tipo_documento, id_transaccion
+            )
+
+            # Ambos intentos llevan el mismo X-Id_transaction
+            response = self.cobertura.ejecutar(functools.partial(
+                self.http.post,
+                self.biometric_url,
+                destino='biometria',
+                json=body_data,
+                headers=headers,
+                timeout=30
+            ))
+
+            with medir_fase('procesar'):
+                return self.procesar_respuesta_biometria(response)
+
+        except ServicioNoDisponibleError as e:
+            logger.warning(str(e))
+            return e.resultado()
+        except requests.exceptions.RequestException as e:
+            logger.error("Error de conexión: %s", e)
+            return {
+                'error': True,
+                'message': f'Error de conexión: {str(e)}'
+            }
+        except Exception as e:
+            logger.error("Error en consultar_biometria_facial: %s", e)
+            return {
+                'error': True,
+                'message': f'Error interno: {str(e)}'
+            }
+
+
+# Instancia global de la API
+seguros_api = SegurosBolivarAPI()
+
+# Pool independiente para Google Apps Script (conversión de audio)
+apps_script_http = PoolHTTP(
+    'apps_script',
+    circuito=Circuito('apps_script'),
+    compartimento=Compartimento('apps_script', BULKHEAD_APPS_SCRIPT, status_code=503, reintentar_en=5)
+)
+
+# URL del Google Apps Script
+APPS_SCRIPT_URL = os.getenv(
+    'APPS_SCRIPT_URL',
+    'https://script.google.com/macros/s/AKfycbx4Vho2TiRvTDdCZoKeLVzxXjGfigyf74YqwbLnHkQdXpn-4JHqhqu8lIpZIgzXoA3svQ/exec'
+)
+# Auth token fijo (configurado internamente)
+APPS_SCRIPT_AUTH_TOKEN = os.getenv(
+    'APPS_SCRIPT_AUTH_TOKEN',
+    'ac4a666571ebf85116a87237ba05bfa4-7b59d052-ca59-4f4b-a324-faf1643f56aa'
+)
+# 4ea2df623fed2f34af5b27c258f47581-e418b99d-1476-4103-a128-a5a7b8e28778 Dev
+# ac4a666571ebf85116a87237ba05bfa4-7b59d052-ca59-4f4b-a324-faf1643f56aa Prod
+# Timeout más largo para procesamiento de audio
+APPS_SCRIPT_TIMEOUT = 60
+# Reenviar la respuesta de Apps Script en streaming sin parsearla: solo se
+# revisan el status y los primeros APPS_SCRIPT_SNIFF_BYTES bytes
+APPS_SCRIPT_PASSTHROUGH = os.getenv('APPS_SCRIPT_PASSTHROUGH', 'true').lower() == 'true'
+APPS_SCRIPT_SNIFF_BYTES = _env_int('APPS_SCRIPT_SNIFF_BYTES', 512)
+
+
+def preparar_payload_apps_script(audio_url, id_session):
+    """Payload para Apps Script (incluyendo auth_token fijo)"""
+    payload = {
+        'audio_url': audio_url,
+        'id_session': id_session,
+        'auth_token': APPS_SCRIPT_AUTH_TOKEN
+    }
+
+    logger.info("Enviando petición a Apps Script (id_session=%s)", id_session)
+    if muestrear_payload():
+        logger.debug("Apps Script payload=%s", Recortado(payload))
+
+    return payload
+
+
+def es_objeto_json(prefijo):
+    """Revisión acotada del inicio del body: un objeto JSON y no, por ejemplo, una página HTML de error"""
+    return prefijo.lstrip()[:1] == b'{'
+
+
+def procesar_respuesta_apps_script(response, audio_url, id_session):
+    """Convierte la respuesta del Apps Script en (body, status_code)"""
+    logger.info("Apps Script response status: %s (%s bytes)", response.status_code, len(response.content),
+                extra={'campos': {'upstream': 'apps_script', 'status': response.status_code}})
+    if muestrear_payload():
+        logger.debug("Apps Script response=%s", Recortado(response.content))
+
+    if response.status_code != 200:
+        return {
+            'error': True,
+            'message': f'Error en Google Apps Script: {response.status_code}',
+            'details': response.text,
+            'input': {
+                'audio_url': audio_url,
+                'id_session': id_session
+            }
+        }, 500
+
+    # Parsear respuesta del Apps Script
+    try:
+        apps_script_response = response.json()
+    except Exception as e:
+        logger.error("Error parsing Apps Script response: %s", e)
+        return {
+            'error': True,
+            'message': 'Error parsing response from Google Apps Script',
+            'raw_response': response.text,
+            'input': {
+                'audio_url': audio_url,
+                'id_session': id_session
+            }
+        }, 500
+
+    # Retornar la respuesta del Apps Script tal como viene
+    return apps_script_response, 200
+
+
+# Tamaño máximo del body de las peticiones (Werkzeug también lo aplica al leer)
+MAX_BODY_BYTES = _env_int('MAX_BODY_BYTES', 1024 * 1024)
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
+
+# Campos de cada endpoint: requerido, valor por defecto y tipos aceptados. Los
+# campos que aceptan str e int se entregan siempre como str
+ESQUEMA_BIOMETRIA = {
+    'numeroDocumento': {'requerido': True, 'tipos': (str, int)},
+    'tipoDocumento': {'defecto': 'CC', 'tipos': (str,)},
+    'idTransaccion': {'tipos': (str, int)},
+}
+ESQUEMA_AUDIO = {
+    'audio_url': {'requerido': True, 'tipos': (str,)},
+    'id_session': {'requerido': True, 'tipos': (str, int)},
+}
+
+
+def decodificar_body(raw, mimetype):
+    """Decodifica el body una sola vez: JSON aunque el Content-Type no lo indique, o form urlencoded"""
+    if not raw:
+        return None
+    try:
+        return json_loads(raw)
+    except ValueError:
+        pass
+    if mimetype == 'application/x-www-form-urlencoded':
+        return dict(parse_qsl(raw.decode('utf-8', errors='replace'), keep_blank_values=True))
+    return None
+
+
+def validar_esquema(data, esquema):
+    """Valida y completa los campos declarados. Devuelve (datos, mensaje_error)"""
+    if not isinstance(data, dict):
+        return None, 'El body debe ser un objeto JSON'
+
+    datos = dict(data)
+    for campo, regla in esquema.items():
+        valor = datos.get(campo)
+        if valor is None or valor == '':
+            if regla.get('requerido'):
+                return None, f'{campo} es requerido'
+            if 'defecto' in regla:
+                datos[campo] = regla['defecto']
+            continue
+        tipos = regla.get('tipos')
+        if tipos and (isinstance(valor, bool) or not isinstance(valor, tipos)):
+            return None, f'{campo} tiene un tipo inválido'
+        # 987 y "987" son el mismo valor: en los headers del upstream y en las claves de cache
+        if tipos and str in tipos and not isinstance(valor, str):
+            datos[campo] = str(valor)
+    return datos, None
+
+
+def respuesta_body_requerido(content_type, method, raw):
+    """Body de la respuesta 400 cuando no se pudo obtener el body del request"""
+    logger.warning("No se pudo obtener datos del request (content_type=%s)", content_type)
+    return {
+        'error': True,
+        'message': 'Body JSON requerido',
+        'debug': {
+            'content_type': content_type,
+            'method': method,
+            'raw_data': raw[:500].decode('utf-8', errors='replace')  # Primeros 500 bytes
+        }
+    }
+
+
+def _respuesta_body_excedido():
+    return jsonify({
+        'error': True,
+        'message': f'El body excede el máximo de {MAX_BODY_BYTES} bytes'
+    }), 413
+
+
+def parsear_request(esquema=None):
+    """Lee, decodifica y valida el body del request. Devuelve (datos, respuesta_error)"""
+    with medir_fase('parseo'):
+        datos, error = _parsear_request(esquema)
+    # Para el diario de transacciones
+    g.datos_peticion = datos
+    return datos, error
+
+
+def _parsear_request(esquema):
+    if request.content_length is not None and request.content_length > MAX_BODY_BYTES:
+        return None, _respuesta_body_excedido()
+
+    try:
+        if request.mimetype == 'multipart/form-data':
+            raw = b''
+            data = request.form.to_dict()
+        else:
+            raw = request.get_data(cache=True)
+            data = decodificar_body(raw, request.mimetype)
+    except RequestEntityTooLarge:
+        return None, _respuesta_body_excedido()
+
+    # Log request para debugging (muestreado)
+    if muestrear_payload():
+        logger.debug("Request %s %s content_type=%s headers=%s body=%s", request.method, request.path,
+                     request.content_type, Recortado(dict(request.headers)), Recortado(raw))
+
+    if not data:
+        return None, (jsonify(respuesta_body_requerido(request.content_type, request.method, raw)), 400)
+
+    if esquema is None:
+        return data, None
+
+    datos, mensaje = validar_esquema(data, esquema)
+    if mensaje:
+        return None, (jsonify({
+            'error': True,
+            'message': mensaje
+        }), 400)
+    return datos, None
+
+
+def respuesta_error(resultado, status_code):
+    """Respuesta de error; si el upstream está en pausa (circuito abierto) incluye Retry-After"""
+    respuesta = jsonify(resultado)
+    if resultado.get('retry_after'):
+        respuesta.headers['Retry-After'] = str(resultado['retry_after'])
+    return respuesta, status_code
+
+
+def _formatear_respuesta_biometria(resultado, numero_documento, tipo_documento, id_transaccion):
+    """Construye la respuesta plana a partir de la respuesta de Seguros Bolívar"""
+    # Procesar la URL de la respuesta original de Seguros Bolívar
+    if resultado.get('url') and resultado['url'].startswith('https://'):
+        original_url = resultado['url']
+        resultado['url'] = original_url.replace('https://', '')
+        logger.debug("URL procesada: %s -> %s", original_url, resultado['url'])
+
+    # Log de la respuesta procesada para debug
+    if muestrear_payload():
+        logger.debug("Respuesta procesada de Seguros Bolívar: %s", Recortado(resultado))
+
+    return {
+        'url': resultado.get('url', ''),
+        'idTransaccion': id_transaccion,
+        'numeroDocumento': numero_documento,
+        'tipoDocumento': tipo_documento,
+        'success': True,
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+# Límites del endpoint /biometria/batch. El pool de hilos es compartido por todos
+# los batches, así un batch grande no acapara los hilos del tráfico interactivo.
+BATCH_MAX_ITEMS = _env_int('BATCH_MAX_ITEMS', 50)
+BATCH_MAX_CONCURRENCIA = _env_int('BATCH_MAX_CONCURRENCIA', 4)
+
+_executor_batch = None
+_executor_batch_lock = threading.Lock()
+
+
+def _obtener_executor_batch():
+    global _executor_batch
+    if _executor_batch is None:
+        with _executor_batch_lock:
+            if _executor_batch is None:
+                _executor_batch = ThreadPoolExecutor(
+                    max_workers=BATCH_MAX_CONCURRENCIA,
+                    thread_name_prefix='biometria-batch'
+                )
+    return _executor_batch
+
+
+def _reiniciar_executor_batch():
+    global _executor_batch, _executor_batch_lock
+    _executor_batch = None
+    _executor_batch_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_executor_batch)
+
+
+def _validar_item_batch(indice, item):
+    """Valida un item del batch. Devuelve (datos, error_del_item)"""
+    datos, mensaje = validar_esquema(item, ESQUEMA_BIOMETRIA)
+    if mensaje:
+        return None, {
+            'indice': indice,
+            'success': False,
+            'error': True,
+            'message': mensaje
+        }
+    return datos, None
+
+
+def _resultado_item_batch(indice, resultado, numero_documento, tipo_documento, id_transaccion):
+    """Construye el resultado de un item del batch a partir de la consulta"""
+    if resultado.get('error'):
+        return {
+            'indice': indice,
+            'success': False,
+            'error': True,
+            'message': resultado.get('message'),
+            'status_code': resultado.get('status_code', 500),
+            'idTransaccion': id_transaccion,
+            'numeroDocumento': numero_documento,
+            'tipoDocumento': tipo_documento
+        }
+
+    respuesta = _formatear_respuesta_biometria(resultado, numero_documento, tipo_documento, id_transaccion)
+    respuesta['indice'] = indice
+    return respuesta
+
+
+def _procesar_item_batch(indice, item):
+    """Procesa un item del batch y lo registra en el diario de transacciones"""
+    if not diario.activo:
+        return _consultar_item_batch(indice, item)
+    inicio = time.perf_counter()
+    with anotaciones_diario() as anotaciones:
+        resultado = _consultar_item_batch(indice, item)
+    if resultado.get('error'):
+        # Sin status_code el item no pasó la validación
+        status, error = resultado.get('status_code', 400), resultado.get('message')
+    else:
+        status, error = 200, None
+    _escribir_en_diario('biometria_batch', status, inicio, item if isinstance(item, dict) else {},
+                        anotaciones, error=error)
+    return resultado
+
+
+def _consultar_item_batch(indice, item):
+    """Consulta un item del batch; los errores se reportan en el propio item"""
+    datos, error = _validar_item_batch(indice, item)
+    if error:
+        return error
+
+    numero_documento = datos['numeroDocumento']
+    tipo_documento = datos['tipoDocumento']
+    id_transaccion = datos.get('idTransaccion')
+
+    try:
+        resultado = seguros_api.consultar_biometria_facial(
+            numero_documento=numero_documento,
+            tipo_documento=tipo_documento,
+            id_transaccion=id_transaccion
+        )
+    except Exception as e:
+        logger.error("Error en item %s del batch: %s", indice, e)
+        resultado = {'error': True, 'message': f'Error interno: {str(e)}'}
+
+    return _resultado_item_batch(indice, resultado, numero_documento, tipo_documento, id_transaccion)
+
+
+def _post_apps_script(audio_url, id_session, stream=False):
+    """Petición al Google Apps Script"""
+    payload = preparar_payload_apps_script(audio_url, id_session)
+    return apps_script_http.post(
+        APPS_SCRIPT_URL,
+        json=payload,
+        headers={'Content-Type': 'application/json'},
+        timeout=APPS_SCRIPT_TIMEOUT,
+        stream=stream
+    )
+
+
+def _error_conexion_apps_script(e):
+    logger.error("Error de conexión con Google Apps Script: %s", e)
+    return {
+        'error': True,
+        'message': f'Error de conexión con Google Apps Script: {str(e)}'
+    }, 500
+
+
+def conversion_exitosa(resultado):
+    """Solo se cachean conversiones completas: success true y audio_base64 (forma asumida de Apps Script)"""
+    return isinstance(resultado, dict) and resultado.get('success') is True and bool(resultado.get('audio_base64'))
+
+
+_PATRON_EXITO = re.compile(rb'"success"\s*:\s*true')
+_PATRON_AUDIO = re.compile(rb'"audio_base64"\s*:\s*"[^"]')
+
+
+def archivo_conversion_exitosa(ruta):
+    """conversion_exitosa() sobre una respuesta de Apps Script ya escrita en disco, sin cargarla en memoria"""
+    try:
+        with open(ruta, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+                return bool(_PATRON_EXITO.search(datos) and _PATRON_AUDIO.search(datos))
+    except (OSError, ValueError):
+        return False
+
+
+def _convertir_audio_apps_script(audio_url, id_session, clave_cache=None):
+    """Convierte el audio con Google Apps Script. Devuelve (body, status_code)"""
+    try:
+        response = _post_apps_script(audio_url, id_session)
+
+        with medir_fase('procesar'):
+            resultado, status_code = procesar_respuesta_apps_script(response, audio_url, id_session)
+        if clave_cache and status_code == 200 and conversion_exitosa(resultado):
+            cache_audio.guardar_respuesta(clave_cache, response.content)
+        return resultado, status_code
+
+    except ServicioNoDisponibleError as e:
+        logger.warning(str(e))
+        return e.resultado(), e.status_code
+    except requests.exceptions.RequestException as e:
+        return _error_conexion_apps_script(e)
+
+
+def _leer_prefijo(bloques, minimo):
+    """Lee bloques hasta reunir al menos `minimo` bytes (o hasta el final del body)"""
+    leidos = []
+    total = 0
+    for bloque in bloques:
+        leidos.append(bloque)
+        total += len(bloque)
+        if total >= minimo:
+            break
+    return b''.join(leidos)
+
+
+def _reenviar_apps_script(response, prefijo, bloques):
+    try:
+        yield prefijo
+        yield from bloques
+    except requests.exceptions.RequestException as e:
+        # Los headers ya se enviaron: solo queda cortar la respuesta
+        logger.error("Reenvío de la respuesta de Apps Script interrumpido: %s", e)
+        raise
+    finally:
+        response.close()
+
+
+def respuesta_apps_script_directa(audio_url, id_session, clave_cache=None):
+    """Respuesta Flask con el body de Apps Script reenviado por bloques, sin parsear el JSON.
+
+    La memoria del worker no depende del tamaño del audio: solo se retiene el
+    prefijo inspeccionado y el bloque en tránsito.
+    """
+    try:
+        response = _post_apps_script(audio_url, id_session, stream=True)
+    except ServicioNoDisponibleError as e:
+        logger.warning(str(e))
+        return respuesta_error(e.resultado(), e.status_code)
+    except requests.exceptions.RequestException as e:
+        return respuesta_error(*_error_conexion_apps_script(e))
+
+    if response.status_code != 200:
+        with response:
+            return respuesta_error(*procesar_respuesta_apps_script(response, audio_url, id_session))
+
+    bloques = response.iter_content(chunk_size=AUDIO_CHUNK_SIZE)
+    try:
+        with medir_fase('procesar'):
+            prefijo = _leer_prefijo(bloques, APPS_SCRIPT_SNIFF_BYTES)
+    except requests.exceptions.RequestException as e:
+        response.close()
+        return respuesta_error(*_error_conexion_apps_script(e))
+
+    if not es_objeto_json(prefijo):
+        response.close()
+        logger.error("La respuesta de Apps Script no es un objeto JSON")
+        return respuesta_error({
+            'error': True,
+            'message': 'Error parsing response from Google Apps Script',
+            'raw_response': prefijo[:APPS_SCRIPT_SNIFF_BYTES].decode('utf-8', errors='replace'),
+            'input': {
+                'audio_url': audio_url,
+                'id_session': id_session
+            }
+        }, 500)
+
+    logger.info("Apps Script response status: 200 (reenvío directo)",
+                extra={'campos': {'upstream': 'apps_script', 'status': 200}})
+    cuerpo = _reenviar_apps_script(response, prefijo, bloques)
+    if clave_cache:
+        # El body no se parsea: se valida el archivo terminado antes de que entre a la cache
+        cuerpo = cache_audio.guardar_en_streaming(clave_cache, cuerpo, valido=archivo_conversion_exitosa)
+    respuesta = Response(cuerpo, mimetype='application/json')
+    # El cupo del bulkhead de Apps Script se libera al cerrar la respuesta, aunque
+    # el generador no llegue a iniciarse (y por tanto no ejecute su finally)
+    respuesta.call_on_close(response.close)
+    return respuesta
+
+
+# Backend de conversión de audio: 'apps_script' (por defecto) o 'nativo'
+# (descarga y codificación en streaming dentro del propio servicio)
+AUDIO_BACKEND = os.getenv('AUDIO_BACKEND', 'apps_script')
+# Con el backend nativo, usar Apps Script si la descarga no se puede iniciar
+AUDIO_FALLBACK_APPS_SCRIPT = os.getenv('AUDIO_FALLBACK_APPS_SCRIPT', 'true').lower() == 'true'
+AUDIO_MAX_BYTES = _env_int('AUDIO_MAX_BYTES', 50 * 1024 * 1024)
+AUDIO_TIMEOUT = _env_int('AUDIO_TIMEOUT', 60)
+# Múltiplo de 3 para que cada bloque se codifique en base64 sin relleno intermedio
+AUDIO_CHUNK_SIZE = _env_int('AUDIO_CHUNK_SIZE', 192 * 1024)
+# Hosts de los que el servicio descarga audio_url, separados por coma. Vacío
+# no permite ninguno: el servicio es público y descargar cualquier URL sería SSRF
+AUDIO_HOSTS_PERMITIDOS = [h.strip() for h in os.getenv('AUDIO_HOSTS_PERMITIDOS', '').split(',') if h.strip()]
+# Permitir hosts que resuelven a loopback, redes privadas o link-local (solo
+# para pruebas locales, p. ej. el benchmark con upstreams falsos)
+AUDIO_PERMITIR_REDES_PRIVADAS = os.getenv('AUDIO_PERMITIR_REDES_PRIVADAS', 'false').lower() == 'true'
+# Redirecciones que se siguen al descargar, validando el host de cada salto
+AUDIO_MAX_REDIRECCIONES = _env_int('AUDIO_MAX_REDIRECCIONES', 3)
+
+# Cache en disco de conversiones (0 bytes la desactiva). En Cloud Run /tmp vive
+# en memoria, así que el tamaño cuenta contra el límite del contenedor.
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', '/tmp/audio_cache')
+AUDIO_CACHE_MAX_BYTES = _env_int('AUDIO_CACHE_MAX_BYTES', 0)
+# Incluir ETag/Last-Modified del audio (petición HEAD) en la clave de la cache
+AUDIO_CACHE_VALIDAR = os.getenv('AUDIO_CACHE_VALIDAR', 'false').lower() == 'true'
+# Segundos que vale una entrada desde que se escribió (0: hasta que la expulse el LRU)
+AUDIO_CACHE_TTL = _env_int('AUDIO_CACHE_TTL', 3600)
+
+# Pool para descargar los audios con el backend nativo
+audio_http = PoolHTTP('audio')
+
+
+class ErrorDescargaAudio(Exception):
+    """Error al descargar o codificar el audio con el backend nativo"""
+
+    def __init__(self, message, status_code=502):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _validar_ip_publica(hostname, puerto):
+    """Rechaza hosts que resuelven (en cualquiera de sus direcciones) a una IP no pública.
+
+    requests vuelve a resolver el nombre al conectar, así que esto no cubre un
+    DNS que cambia entre ambas resoluciones: la defensa principal es la lista
+    AUDIO_HOSTS_PERMITIDOS.
+    """
+    try:
+        direcciones = {info[4][0] for info in socket.getaddrinfo(hostname, puerto, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError) as e:
+        raise ErrorDescargaAudio(f'No se pudo resolver el host de audio_url {hostname}: {e}', 400)
+    for direccion in direcciones:
+        # '%' separa la zona de las IPv6 link-local (fe80::1%eth0)
+        if not ipaddress.ip_address(direccion.split('%')[0]).is_global:
+            raise ErrorDescargaAudio(f'Host no permitido para audio_url: {hostname} resuelve a {direccion}', 400)
+
+
+def _validar_audio_url(audio_url):
+    """Valida esquema, lista de hosts permitidos y que el host resuelva a IPs públicas"""
+    url = urlparse(audio_url)
+    if url.scheme not in ('http', 'https') or not url.hostname:
+        raise ErrorDescargaAudio('audio_url debe ser una URL http(s)', 400)
+    if url.hostname not in AUDIO_HOSTS_PERMITIDOS:
+        raise ErrorDescargaAudio(f'Host no permitido para audio_url: {url.hostname}', 400)
+    if not AUDIO_PERMITIR_REDES_PRIVADAS:
+        _validar_ip_publica(url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+
+
+def solicitar_audio(metodo, audio_url, **kwargs):
+    """Petición a audio_url siguiendo las redirecciones a mano, validando el host de cada salto"""
+    url = audio_url
+    for _ in range(AUDIO_MAX_REDIRECCIONES + 1):
+        _validar_audio_url(url)
+        if metodo == 'HEAD':
+            response = audio_http.sesion.head(url, allow_redirects=False, **kwargs)
+        else:
+            response = audio_http.get(url, allow_redirects=False, **kwargs)
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers['Location'])
+    raise ErrorDescargaAudio(f'audio_url supera el máximo de {AUDIO_MAX_REDIRECCIONES} redirecciones', 400)
+
+
+def abrir_descarga_audio(audio_url):
+    """Inicia la descarga del audio en streaming validando URL, status y tamaño declarado"""
+    logger.info("Descargando audio: %s", audio_url)
+    try:
+        response = solicitar_audio('GET', audio_url, stream=True, timeout=(10, AUDIO_TIMEOUT))
+    except requests.exceptions.RequestException as e:
+        raise ErrorDescargaAudio(f'Error de conexión descargando audio: {str(e)}')
+
+    if response.status_code != 200:
+        response.close()
+        raise ErrorDescargaAudio(f'Error descargando audio: {response.status_code}')
+
+    declarado = response.headers.get('Content-Length', '')
+    if declarado.isdigit() and int(declarado) > AUDIO_MAX_BYTES:
+        response.close()
+        raise ErrorDescargaAudio(f'El audio supera el máximo de {AUDIO_MAX_BYTES} bytes', 413)
+
+    return response
+
+
+def leer_audio(response):
+    """Bloques del audio a medida que se descarga, con los límites de tamaño y tiempo"""
+    limite = time.monotonic() + AUDIO_TIMEOUT
+    total = 0
+    try:
+        for chunk in response.iter_content(chunk_size=AUDIO_CHUNK_SIZE):
+            total += len(chunk)
+            if total > AUDIO_MAX_BYTES:
+                raise ErrorDescargaAudio(f'El audio supera el máximo de {AUDIO_MAX_BYTES} bytes', 413)
+            if time.monotonic() > limite:
+                raise ErrorDescargaAudio('Tiempo máximo de descarga excedido', 504)
+            yield chunk
+    except requests.exceptions.RequestException as e:
+        raise ErrorDescargaAudio(f'Error de conexión descargando audio: {str(e)}')
+    finally:
+        response.close()
+
+
+def codificar_audio_base64(response):
+    """Codifica en base64 por bloques a medida que se descarga el audio"""
+    resto = b''
+    for chunk in leer_audio(response):
+        datos = resto + chunk if resto else chunk
+        corte = len(datos) - len(datos) % 3
+        resto = datos[corte:]
+        if corte:
+            yield base64.b64encode(datos[:corte])
+    if resto:
+        yield base64.b64encode(resto)
+
+
+def _tipo_mime(response):
+    return response.headers.get('Content-Type', 'application/octet-stream').split(';')[0].strip()
+
+
+def _encabezado_audio_nativo(mime_type, audio_url, id_session):
+    return {
+        'success': True,
+        'audio_url': audio_url,
+        'id_session': id_session,
+        'mime_type': mime_type
+    }
+
+
+def _generar_json_base64(encabezado, bloques):
+    """Genera el JSON {encabezado..., audio_base64} por partes"""
+    texto = json.dumps(encabezado)
+    yield texto[:-1].encode('utf-8') + b', "audio_base64": "'
+    yield from bloques
+    yield b'"}'
+
+
+class CacheAudioDisco:
+    """Cache en disco de conversiones de audio, acotada en bytes con expulsión LRU.
+
+    Con el backend nativo se guarda solo el base64 (precedido del tipo MIME) y
+    el JSON se arma al servir, con el id_session de cada petición; con Apps
+    Script se guarda su respuesta tal cual, así que la clave incluye el
+    id_session y solo se reutiliza dentro de la misma sesión. Solo se guardan
+    conversiones exitosas. Los archivos se sirven con sendfile o mmap, sin
+    cargarlos en memoria del worker. La recencia LRU es el atime del archivo y
+    la antigüedad para el TTL su mtime, así los comparten todos los workers
+    del host.
+    """
+
+    def __init__(self, directorio, max_bytes, validar, ttl=0):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.validar = validar
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expiradas = 0
+        if self.activa:
+            os.makedirs(directorio, exist_ok=True)
+
+    @property
+    def activa(self):
+        return self.max_bytes > 0
+
+    def clave(self, audio_url, id_session):
+        """Clave del audio para el backend actual, o None si no se debe usar la cache"""
+        if not self.activa:
+            return None
+        validador = ''
+        if self.validar:
+            try:
+                response = solicitar_audio('HEAD', audio_url, timeout=10)
+                validador = response.headers.get('ETag') or response.headers.get('Last-Modified') or ''
+            except (ErrorDescargaAudio, requests.exceptions.RequestException) as e:
+                logger.warning("No se pudo validar el audio para la cache: %s", e)
+                return None
+        # La respuesta de Apps Script es propia de la sesión: no se comparte entre sesiones
+        sesion = '' if AUDIO_BACKEND == 'nativo' else str(id_session)
+        partes = json.dumps([AUDIO_BACKEND, audio_url, sesion, validador])
+        return hashlib.sha256(partes.encode('utf-8')).hexdigest()
+
+    def _ruta(self, clave):
+        extension = 'b64' if AUDIO_BACKEND == 'nativo' else 'resp'
+        return os.path.join(self.directorio, f"{clave}.{extension}")
+
+    def _abrir(self, clave):
+        """Abre la entrada (marcándola como usada recientemente) o devuelve None"""
+        ruta = self._ruta(clave)
+        try:
+            archivo = open(ruta, 'rb')
+            info = os.fstat(archivo.fileno())
+        except OSError:
+            return self._miss()
+        if self._expirada(info, time.time()):
+            archivo.close()
+            self._eliminar_expirada(ruta)
+            return self._miss()
+        try:
+            # Uso reciente en el atime; el mtime conserva el momento de escritura (TTL)
+            os.utime(ruta, (time.time(), info.st_mtime))
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        metrica_cache.labels('audio', 'hit').inc()
+        logger.info("Audio servido desde cache en disco: %s", clave)
+        return archivo
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+        metrica_cache.labels('audio', 'miss').inc()
+        return None
+
+    def _expirada(self, info, ahora):
+        return self.ttl > 0 and ahora - info.st_mtime > self.ttl
+
+    def _eliminar_expirada(self, ruta):
+        try:
+            os.remove(ruta)
+        except OSError:
+            return
+        with self._lock:
+            self.expiradas += 1
+
+    def respuesta(self, clave, audio_url, id_session):
+        """Respuesta Flask desde la cache, o None si no hay entrada"""
+        archivo = self._abrir(clave)
+        if archivo is None:
+            return None
+        if AUDIO_BACKEND != 'nativo':
+            return send_file(archivo, mimetype='application/json', conditional=False, etag=False)
+        mime_type, inicio, datos = self._mapear(archivo)
+        encabezado = _encabezado_audio_nativo(mime_type, audio_url, id_session)
+        return Response(_generar_json_base64(encabezado, self._bloques(datos, inicio)), mimetype='application/json')
+
+    def resultado(self, clave, audio_url, id_session):
+        """Resultado (dict) desde la cache, o None si no hay entrada"""
+        archivo = self._abrir(clave)
+        if archivo is None:
+            return None
+        with archivo:
+            if AUDIO_BACKEND != 'nativo':
+                return json.load(archivo)
+            mime_type = archivo.readline().decode('utf-8').strip()
+            resultado = _encabezado_audio_nativo(mime_type, audio_url, id_session)
+            resultado['audio_base64'] = archivo.read().decode('ascii')
+            return resultado
+
+    @staticmethod
+    def _mapear(archivo):
+        """Mapea el archivo en memoria; devuelve (mime_type, inicio del base64, mmap)"""
+        with archivo:
+            datos = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+        inicio = datos.find(b'\n') + 1
+        return datos[:inicio].decode('utf-8').strip(), inicio, datos
+
+    @staticmethod
+    def _bloques(datos, inicio):
+        try:
+            for posicion in range(inicio, len(datos), AUDIO_CHUNK_SIZE):
+                yield datos[posicion:posicion + AUDIO_CHUNK_SIZE]
+        finally:
+            datos.close()
+
+    def _temporal(self, clave):
+        return os.path.join(self.directorio, f".{clave}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    def guardar_respuesta(self, clave, contenido):
+        temporal = self._temporal(clave)
+        try:
+            with open(temporal, 'wb') as f:
+                f.write(contenido)
+            os.replace(temporal, self._ruta(clave))
+        except OSError as e:
+            logger.warning("No se pudo guardar el audio en cache: %s", e)
+            return
+        self._expulsar()
+
+    def guardar_en_streaming(self, clave, bloques, encabezado=b'', valido=None):
+        """Reenvía los bloques y los guarda (tras `encabezado`) si la respuesta termina completa.
+
+        Con `valido(ruta)`, el archivo terminado solo entra a la cache si lo acepta.
+        """
+        temporal = self._temporal(clave)
+        completo = False
+        try:
+            with open(temporal, 'wb') as f:
+                f.write(encabezado)
+                for bloque in bloques:
+                    f.write(bloque)
+                    yield bloque
+            completo = valido is None or valido(temporal)
+        finally:
+            try:
+                if completo:
+                    os.replace(temporal, self._ruta(clave))
+                else:
+                    os.remove(temporal)
+            except OSError as e:
+                logger.warning("No se pudo guardar el audio en cache: %s", e)
+        self._expulsar()
+
+    def _expulsar(self):
+        """Elimina las entradas expiradas y luego las menos usadas hasta quedar bajo max_bytes"""
+        entradas = []
+        total = 0
+        ahora = time.time()
+        try:
+            with os.scandir(self.directorio) as it:
+                for entrada in it:
+                    if entrada.is_file() and not entrada.name.startswith('.'):
+                        info = entrada.stat()
+                        if self._expirada(info, ahora):
+                            self._eliminar_expirada(entrada.path)
+                            continue
+                        entradas.append((info.st_atime, info.st_size, entrada.path))
+                        total += info.st_size
+        except OSError as e:
+            logger.warning("No se pudo revisar la cache de audio: %s", e)
+            return
+
+        entradas.sort()
+        for _, tamano, ruta in entradas:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(ruta)
+                total -= tamano
+                with self._lock:
+                    self.evictions += 1
+            except OSError:
+                pass
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self.hits + self.misses
+            return {
+                'activa': self.activa,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expiradas': self.expiradas,
+                'ttl': self.ttl,
+                'hit_ratio': round(self.hits / consultas, 4) if consultas else 0.0
+            }
+
 
+cache_audio = CacheAudioDisco(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_VALIDAR, AUDIO_CACHE_TTL)
 
-# Configuración de la API de Seguros Bolívar
-class SegurosBolivarAPI:
-    def __init__(self):
-        self.client_id = os.getenv('SEGUROS_CLIENT_ID', '7p2djtisjjsng91q8laktkmp36')
-        self.client_secret = os.getenv('SEGUROS_CLIENT_SECRET', '1ocv4ohfjqu69r7cukebhccbk51panhqdgfl31fu2og49d3hmk1s')
-        self.token_url = 'https://api-conecta.segurosbolivar.com/prod/oauth2/token'
-        self.biometric_url = 'https://api-conecta.segurosbolivar.com/prod/identidadDigital/biometria/facial/url'
-        self.access_token = None
-        self.token_expiry = None
 
-    def generar_id_transaccion(self):
-        """Genera un ID único para la transacción"""
-        timestamp = str(int(time.time()))
-        random_str = ''.join(random.choices(string.ascii_lowercase + string.digits, k=10))
-        return f"{timestamp}{random_str}"
+def _bloques_audio_nativo(response, clave_cache):
+    bloques = codificar_audio_base64(response)
+    if clave_cache:
+        bloques = cache_audio.guardar_en_streaming(clave_cache, bloques, _tipo_mime(response).encode('utf-8') + b'\n')
+    return bloques
 
-    def obtener_token(self):
-        """Obtiene el token de acceso OAuth2"""
-        try:
-            payload = {
-                'grant_type': 'client_credentials',
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'scope': 'aws.cognito.signin.user.admin SrcServerCognitoConecta/ConectaApiScope'
+
+def generar_json_audio_nativo(response, audio_url, id_session, clave_cache=None):
+    """Genera el JSON de respuesta por partes, con el base64 en streaming"""
+    encabezado = _encabezado_audio_nativo(_tipo_mime(response), audio_url, id_session)
+    try:
+        yield from _generar_json_base64(encabezado, _bloques_audio_nativo(response, clave_cache))
+    except ErrorDescargaAudio as e:
+        # Los headers ya se enviaron: solo queda cortar la respuesta
+        logger.error("Conversión de audio interrumpida: %s", e)
+        raise
+
+
+def _abrir_descarga_o_fallback(audio_url, id_session):
+    """Devuelve (response_audio, None) o (None, (body, status_code)) si hubo error o fallback"""
+    try:
+        return abrir_descarga_audio(audio_url), None
+    except ErrorDescargaAudio as e:
+        if e.status_code == 502 and AUDIO_FALLBACK_APPS_SCRIPT:
+            logger.warning("%s; usando Google Apps Script como respaldo", e)
+            return None, _convertir_audio_apps_script(audio_url, id_session)
+        logger.error(str(e))
+        return None, ({
+            'error': True,
+            'message': str(e),
+            'input': {
+                'audio_url': audio_url,
+                'id_session': id_session
             }
+        }, e.status_code)
 
-            headers = {
-                'Content-Type': 'application/x-www-form-urlencoded'
+
+def convertir_audio(audio_url, id_session):
+    """Convierte el audio con el backend configurado. Devuelve (body, status_code)"""
+    clave = cache_audio.clave(audio_url, id_session)
+    if clave:
+        cacheado = cache_audio.resultado(clave, audio_url, id_session)
+        if cacheado is not None:
+            return cacheado, 200
+
+    if AUDIO_BACKEND != 'nativo':
+        return _convertir_audio_apps_script(audio_url, id_session, clave)
+
+    response, error = _abrir_descarga_o_fallback(audio_url, id_session)
+    if error:
+        return error
+    try:
+        resultado = _encabezado_audio_nativo(_tipo_mime(response), audio_url, id_session)
+        resultado['audio_base64'] = b''.join(_bloques_audio_nativo(response, clave)).decode('ascii')
+        return resultado, 200
+    except ErrorDescargaAudio as e:
+        logger.error(str(e))
+        return {'error': True, 'message': str(e)}, e.status_code
+
+
+def respuesta_audio(audio_url, id_session):
+    """Respuesta Flask de la conversión; con el backend nativo se envía en streaming"""
+    clave = cache_audio.clave(audio_url, id_session)
+    if clave:
+        cacheada = cache_audio.respuesta(clave, audio_url, id_session)
+        if cacheada is not None:
+            return cacheada
+
+    if AUDIO_BACKEND != 'nativo':
+        if APPS_SCRIPT_PASSTHROUGH:
+            return respuesta_apps_script_directa(audio_url, id_session, clave)
+        resultado, status_code = _convertir_audio_apps_script(audio_url, id_session, clave)
+        return respuesta_error(resultado, status_code) if status_code != 200 else (jsonify(resultado), 200)
+
+    response, error = _abrir_descarga_o_fallback(audio_url, id_session)
+    if error:
+        return respuesta_error(*error)
+    return Response(generar_json_audio_nativo(response, audio_url, id_session, clave), mimetype='application/json')
+
+
+# Formatos de /audio_base64 según el header Accept: JSON con base64 (por
+# defecto) o los bytes del audio tal cual
+FORMATOS_AUDIO = ('application/json', 'application/octet-stream')
+# Nivel de zlib para gzip/deflate (0 desactiva la compresión). El base64 de un
+# audio ya comprimido solo recupera la inflación de la codificación, así que
+# niveles altos cuestan CPU sin reducir mucho más
+AUDIO_COMPRESION_NIVEL = _env_int('AUDIO_COMPRESION_NIVEL', 1)
+# wbits de zlib: gzip con su encabezado, deflate con la envoltura zlib (RFC 9110)
+_WBITS_COMPRESION = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+def _respuesta_binaria_desde_resultado(resultado, status_code):
+    """Bytes del audio a partir de un resultado JSON {audio_base64, mime_type}"""
+    if status_code != 200:
+        return respuesta_error(resultado, status_code)
+    if not isinstance(resultado, dict) or not resultado.get('audio_base64'):
+        logger.error("La respuesta de Apps Script no trae audio_base64")
+        return respuesta_error({'error': True, 'message': 'Apps Script no devolvió el audio'}, 502)
+    return Response(base64.b64decode(resultado['audio_base64']), mimetype='application/octet-stream',
+                    headers={'X-Audio-Mime-Type': resultado.get('mime_type') or 'application/octet-stream'})
+
+
+def respuesta_audio_binaria(audio_url, id_session):
+    """Respuesta Flask con los bytes del audio (application/octet-stream), sin base64 ni JSON.
+
+    Respeta el backend configurado: el servicio solo descarga audio_url con el
+    backend nativo (y sus validaciones de host). Con Apps Script se decodifica
+    el audio_base64 de su respuesta, que se asume con la misma forma que la
+    del backend nativo ({audio_base64, mime_type}); si no trae audio_base64
+    se responde 502.
+    """
+    if AUDIO_BACKEND != 'nativo':
+        return _respuesta_binaria_desde_resultado(*convertir_audio(audio_url, id_session))
+
+    response, error = _abrir_descarga_o_fallback(audio_url, id_session)
+    if error:
+        return _respuesta_binaria_desde_resultado(*error)
+
+    headers = {'X-Audio-Mime-Type': _tipo_mime(response)}
+    declarado = response.headers.get('Content-Length', '')
+    # requests descomprime el Content-Encoding del origen: solo así coincide el tamaño
+    if declarado.isdigit() and 'Content-Encoding' not in response.headers:
+        headers['Content-Length'] = declarado
+    return Response(leer_audio(response), mimetype='application/octet-stream', headers=headers)
+
+
+def _comprimir_bloques(bloques, compresor):
+    try:
+        for bloque in bloques:
+            comprimido = compresor.compress(bloque)
+            if comprimido:
+                yield comprimido
+        yield compresor.flush()
+    finally:
+        if hasattr(bloques, 'close'):
+            bloques.close()
+
+
+def comprimir_respuesta(respuesta):
+    """Comprime en streaming una respuesta JSON 200 si el cliente acepta gzip o deflate"""
+    respuesta.vary.add('Accept-Encoding')
+    if (AUDIO_COMPRESION_NIVEL <= 0 or respuesta.status_code != 200 or
+            respuesta.mimetype != 'application/json' or 'Content-Encoding' in respuesta.headers):
+        return respuesta
+    codificacion = request.accept_encodings.best_match(tuple(_WBITS_COMPRESION))
+    if codificacion is None:
+        return respuesta
+
+    compresor = zlib.compressobj(AUDIO_COMPRESION_NIVEL, zlib.DEFLATED, _WBITS_COMPRESION[codificacion])
+    respuesta.response = _comprimir_bloques(respuesta.response, compresor)
+    respuesta.direct_passthrough = False
+    respuesta.headers['Content-Encoding'] = codificacion
+    respuesta.headers.pop('Content-Length', None)
+    return respuesta
+
+
+# Trabajos asíncronos de conversión de audio (/audio_base64/jobs).
+# Los trabajos viven en memoria del worker: con varios workers o instancias el
+# cliente debe consultar el mismo proceso que creó el trabajo.
+AUDIO_JOBS_WORKERS = _env_int('AUDIO_JOBS_WORKERS', 2)
+AUDIO_JOBS_MAX_PENDIENTES = _env_int('AUDIO_JOBS_MAX_PENDIENTES', 50)
+AUDIO_JOBS_MAX_RESULTADOS = _env_int('AUDIO_JOBS_MAX_RESULTADOS', 200)
+AUDIO_JOBS_TTL = _env_int('AUDIO_JOBS_TTL', 600)
+# Bytes máximos de resultados retenidos: un base64 puede pesar varios MB y la
+# instancia de Cloud Run tiene 512Mi
+AUDIO_JOBS_MAX_BYTES = _env_int('AUDIO_JOBS_MAX_BYTES', 64 * 1024 * 1024)
+
+
+class ColaLlenaError(Exception):
+    """No se admiten más trabajos pendientes"""
+
+
+class ColaTrabajosAudio:
+    """Cola acotada de conversiones de audio procesadas por un pool de hilos.
+
+    Un trabajo idéntico (mismo audio_url e id_session) que aún está pendiente
+    se reutiliza en lugar de encolarse otra vez. Los resultados se conservan
+    AUDIO_JOBS_TTL segundos, como máximo AUDIO_JOBS_MAX_RESULTADOS y sin
+    superar AUDIO_JOBS_MAX_BYTES entre todos; un resultado que por sí solo
+    supera ese límite se reemplaza por un error.
+
+    al_terminar(trabajo, inicio, anotaciones) se llama con cada trabajo
+    terminado, su perf_counter de inicio y las anotaciones del diario.
+    """
+
+    def __init__(self, procesar, max_workers, max_pendientes, max_resultados, ttl, max_bytes=0, al_terminar=None):
+        self._procesar = procesar
+        self.al_terminar = al_terminar
+        self.max_workers = max_workers
+        self.max_pendientes = max_pendientes
+        self.max_resultados = max_resultados
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._trabajos = OrderedDict()
+        self._pendientes = {}
+        self._tamanos = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _obtener_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='audio-job')
+        return self._executor
+
+    def enviar(self, audio_url, id_session):
+        """Encola un trabajo. Devuelve (trabajo, duplicado) o lanza ColaLlenaError"""
+        clave = (audio_url, id_session)
+        with self._lock:
+            self._purgar()
+            job_id = self._pendientes.get(clave)
+            if job_id is not None:
+                return dict(self._trabajos[job_id]), True
+
+            if len(self._pendientes) >= self.max_pendientes:
+                raise ColaLlenaError(f'Máximo {self.max_pendientes} trabajos pendientes')
+
+            job_id = uuid.uuid4().hex
+            ahora = time.time()
+            self._trabajos[job_id] = {
+                'job_id': job_id,
+                'estado': 'pendiente',
+                'audio_url': audio_url,
+                'id_session': id_session,
+                'creado': ahora,
+                'actualizado': ahora
             }
+            self._pendientes[clave] = job_id
+            trabajo = dict(self._trabajos[job_id])
+            self._obtener_executor().submit(self._ejecutar, job_id, clave)
+
+        return trabajo, False
+
+    def consultar(self, job_id):
+        with self._lock:
+            self._purgar()
+            trabajo = self._trabajos.get(job_id)
+            return dict(trabajo) if trabajo else None
+
+    def _actualizar(self, job_id, **campos):
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is not None:
+                trabajo.update(campos, actualizado=time.time())
+
+    def _ejecutar(self, job_id, clave):
+        self._actualizar(job_id, estado='procesando')
+        inicio = time.perf_counter()
+        with anotaciones_diario() as anotaciones:
+            try:
+                resultado, status_code = self._procesar(*clave)
+                estado = 'error' if status_code >= 400 else 'completado'
+            except Exception as e:
+                logger.error("Error en trabajo de audio %s: %s", job_id, e)
+                resultado, status_code, estado = {'error': True, 'message': f'Error interno: {str(e)}'}, 500, 'error'
 
-            logger.info("Solicitando token OAuth2...")
-            response = requests.post(self.token_url, data=payload, headers=headers, timeout=30)
+        tamano = self._tamano(resultado)
+        if self.max_bytes and tamano > self.max_bytes:
+            logger.warning("Resultado del trabajo de audio %s descartado (%s bytes)", job_id, tamano)
+            resultado, status_code, estado = {
+                'error': True,
+                'message': f'El resultado supera el máximo de {self.max_bytes} bytes retenidos; use /audio_base64'
+            }, 413, 'error'
+            tamano = self._tamano(resultado)
+
+        with self._lock:
+            self._pendientes.pop(clave, None)
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is not None:
+                self._tamanos[job_id] = tamano
+                self._bytes += tamano
+                trabajo.update(
+                    estado=estado,
+                    resultado=resultado,
+                    status_code=status_code,
+                    actualizado=time.time(),
+                    expira=time.time() + self.ttl
+                )
+                # Los terminados se ordenan por fin de ejecución para la expulsión
+                self._trabajos.move_to_end(job_id)
+                self._purgar()
+        logger.info("Trabajo de audio %s terminado: %s", job_id, estado)
+
+        if self.al_terminar is not None:
+            try:
+                self.al_terminar({
+                    'job_id': job_id, 'audio_url': clave[0], 'id_session': clave[1],
+                    'estado': estado, 'status_code': status_code, 'resultado': resultado
+                }, inicio, anotaciones)
+            except Exception as e:
+                logger.error("Error al notificar el trabajo de audio %s: %s", job_id, e)
+
+    @staticmethod
+    def _tamano(resultado):
+        """Bytes aproximados del resultado: lo que pesa son sus textos (el base64)"""
+        if not isinstance(resultado, dict):
+            return 0
+        return sum(len(v) for v in resultado.values() if isinstance(v, (str, bytes)))
+
+    def _purgar(self):
+        """Elimina resultados expirados y los más antiguos si se supera el máximo de resultados o de bytes"""
+        ahora = time.time()
+        terminados = [job_id for job_id, t in self._trabajos.items() if 'expira' in t]
+        exceso = len(terminados) - self.max_resultados
+        for job_id in terminados:
+            if (exceso > 0 or self._trabajos[job_id]['expira'] <= ahora or
+                    (self.max_bytes and self._bytes > self.max_bytes)):
+                del self._trabajos[job_id]
+                self._bytes -= self._tamanos.pop(job_id, 0)
+                exceso -= 1
+
+    def estadisticas(self):
+        with self._lock:
+            self._purgar()
+            return {
+                'pendientes': len(self._pendientes),
+                'almacenados': len(self._trabajos),
+                'max_pendientes': self.max_pendientes,
+                'bytes_resultados': self._bytes,
+                'max_bytes': self.max_bytes
+            }
 
-            if response.status_code != 200:
-                logger.error(f"Error al obtener token: {response.status_code} - {response.text}")
-                return None
 
-            data = response.json()
-            self.access_token = data.get('access_token')
-            # Calcular expiración (por defecto 1 hora)
-            expires_in = data.get('expires_in', 3600)
-            self.token_expiry = time.time() + expires_in - 60  # 1 minuto de margen
+trabajos_audio = ColaTrabajosAudio(
+    convertir_audio,
+    max_workers=AUDIO_JOBS_WORKERS,
+    max_pendientes=AUDIO_JOBS_MAX_PENDIENTES,
+    max_resultados=AUDIO_JOBS_MAX_RESULTADOS,
+    ttl=AUDIO_JOBS_TTL,
+    max_bytes=AUDIO_JOBS_MAX_BYTES
+)
 
-            logger.info("Token obtenido exitosamente")
-            return self.access_token
 
-        except Exception as e:
-            logger.error(f"Error en obtener_token: {str(e)}")
-            return None
+def _encolar_trabajo_audio(audio_url, id_session):
+    """Respuesta 202 con el trabajo encolado (o el pendiente idéntico)"""
+    try:
+        trabajo, duplicado = trabajos_audio.enviar(audio_url, id_session)
+    except ColaLlenaError as e:
+        logger.warning("Cola de trabajos de audio llena: %s", e)
+        respuesta = jsonify({
+            'error': True,
+            'message': f'Cola de trabajos llena: {e}'
+        })
+        respuesta.headers['Retry-After'] = '5'
+        return respuesta, 429
+
+    status_url = url_for('consultar_trabajo_audio', job_id=trabajo['job_id'])
+    respuesta = jsonify({
+        'job_id': trabajo['job_id'],
+        'estado': trabajo['estado'],
+        'duplicado': duplicado,
+        'status_url': status_url
+    })
+    respuesta.headers['Location'] = status_url
+    return respuesta, 202
 
-    def token_valido(self):
-        """Verifica si el token actual es válido"""
-        return (self.access_token is not None and
-                self.token_expiry is not None and
-                time.time() < self.token_expiry)
 
-    def consultar_biometria_facial(self, numero_documento, tipo_documento='CC', id_transaccion=None):
-        """Consulta la URL de biometría facial"""
+# Bulkheads por ruta: el audio (hasta 60 s por petición) no puede ocupar todos
+# los hilos del worker y dejar sin capacidad a /biometria
+compartimentos_rutas = {
+    'biometria': Compartimento('biometria', BULKHEAD_BIOMETRIA),
+    'batch': Compartimento('biometria_batch', BULKHEAD_BATCH),
+    'audio': Compartimento('audio_base64', BULKHEAD_AUDIO, reintentar_en=5),
+}
+
+
+def limitar_concurrencia(nombre):
+    """Decorador de vistas: admite la petición solo si hay cupo en el bulkhead de la ruta"""
+    compartimento = compartimentos_rutas[nombre]
+
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(*args, **kwargs):
+            try:
+                compartimento.adquirir()
+            except ServicioNoDisponibleError as e:
+                return respuesta_error(e.resultado(), e.status_code)
+            try:
+                respuesta = app.make_response(vista(*args, **kwargs))
+            except BaseException:
+                compartimento.liberar()
+                raise
+            # Las respuestas en streaming mantienen el cupo hasta terminar de enviarse
+            if respuesta.is_streamed:
+                respuesta.call_on_close(compartimento.liberar)
+            else:
+                compartimento.liberar()
+            return respuesta
+        return envoltura
+    return decorador
+
+
+# Diario de transacciones de /biometria, cada item de /biometria/batch,
+# /audio_base64 y cada trabajo de /audio_base64/jobs: SQLite local de solo
+# inserción, escrito en lotes por un hilo en segundo plano (write-behind) para
+# no sumar latencia a la petición. Vacío lo desactiva. Contiene números de
+# documento: el archivo debe protegerse como cualquier dato personal.
+DIARIO_PATH = os.getenv('DIARIO_PATH', '')
+DIARIO_COLA_MAX = _env_int('DIARIO_COLA_MAX', 10000)
+DIARIO_LOTE = _env_int('DIARIO_LOTE', 200)
+# Espera máxima para acumular un lote antes de escribirlo
+DIARIO_INTERVALO = _env_float('DIARIO_INTERVALO', 0.5)
+# Con la cola llena la petición espera hasta DIARIO_ESPERA_MAX segundos; después se descarta el registro
+DIARIO_ESPERA_MAX = _env_float('DIARIO_ESPERA_MAX', 0.05)
+
+metrica_diario = Counter(
+    'journal_entries_total', 'Registros del diario de transacciones (escritos, descartados, con error)',
+    ['resultado']
+)
+
+# Campos de cada registro, en el orden de la tabla
+COLUMNAS_DIARIO = (
+    'ts', 'tipo', 'status', 'latencia_ms', 'id_transaccion', 'numero_documento', 'tipo_documento',
+    'id_session', 'url', 'upstream', 'upstream_status', 'error', 'pid'
+)
+
+_ESQUEMA_DIARIO = """
+CREATE TABLE IF NOT EXISTS transacciones (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    tipo TEXT NOT NULL,
+    status INTEGER,
+    latencia_ms REAL,
+    id_transaccion TEXT,
+    numero_documento TEXT,
+    tipo_documento TEXT,
+    id_session TEXT,
+    url TEXT,
+    upstream TEXT,
+    upstream_status TEXT,
+    error TEXT,
+    pid INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_transacciones_ts ON transacciones (ts);
+CREATE INDEX IF NOT EXISTS idx_transacciones_id_transaccion ON transacciones (id_transaccion);
+CREATE TRIGGER IF NOT EXISTS transacciones_solo_insercion BEFORE UPDATE ON transacciones
+BEGIN
+    SELECT RAISE(ABORT, 'El diario de transacciones es de solo inserción');
+END;
+"""
+
+
+class DiarioTransacciones:
+    """Diario de transacciones con escritura diferida en SQLite.
+
+    registrar() solo encola la fila (cola acotada); un hilo por proceso la
+    inserta en lotes, en una transacción por lote. Con la cola llena la
+    petición espera hasta `espera_max` (contrapresión) y luego se descarta el
+    registro. Lo pendiente se escribe al terminar el proceso. Los workers del
+    host comparten el archivo en modo WAL.
+    """
+
+    _FIN = object()
+
+    def __init__(self, ruta, cola_max=10000, lote=200, intervalo=0.5, espera_max=0.05):
+        self.ruta = ruta
+        self.cola_max = cola_max
+        self.lote = max(1, lote)
+        self.intervalo = intervalo
+        self.espera_max = espera_max
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+        atexit.register(self.cerrar)
+
+    def _reiniciar_tras_fork(self):
+        # El hilo escritor no existe en el hijo: cola y contadores propios
+        self._lock = threading.Lock()
+        self._cola = queue.Queue(self.cola_max)
+        self._hilo = None
+        self.escritos = 0
+        self.descartados = 0
+        self.errores = 0
+
+    @property
+    def activo(self):
+        return bool(self.ruta)
+
+    def _asegurar_hilo(self):
+        # Se inicia con el primer registro: el maestro de gunicorn (preload) no lo necesita
+        if self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._escribir, name='diario-transacciones', daemon=True)
+                self._hilo.start()
+
+    def registrar(self, **campos):
+        """Encola un registro. Devuelve False si se descartó"""
+        if not self.activo:
+            return False
+        self._asegurar_hilo()
+        fila = tuple(campos.get(columna) for columna in COLUMNAS_DIARIO)
         try:
-            # Verificar/obtener token
-            if not self.token_valido():
-                if not self.obtener_token():
-                    return {
-                        'error': True,
-                        'message': 'No se pudo obtener el token de acceso'
-                    }
-
-            # Usar ID de transacción proporcionado o generar uno nuevo
-            transaction_id = id_transaccion or self.generar_id_transaccion()
-
-            # Preparar headers (valores fijos como en Apps Script)
-            headers = {
-                'Authorization': f'Bearer {self.access_token}',
-                'X-Channel': 'SEGUROS_BOLIVAR',
-                'X-IPAddr': '186.82.101.105',
-                'X-Id_transaction': transaction_id,
-                'process': 'indem_patri',
-                'Content-Type': 'application/json'
-            }
+            self._cola.put(fila, timeout=self.espera_max)
+        except queue.Full:
+            with self._lock:
+                self.descartados += 1
+            metrica_diario.labels('descartado').inc()
+            return False
+        return True
+
+    def conectar(self):
+        conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+        conexion.execute('PRAGMA journal_mode=WAL')
+        conexion.execute('PRAGMA synchronous=NORMAL')
+        conexion.executescript(_ESQUEMA_DIARIO)
+        return conexion
+
+    def _siguiente_lote(self):
+        """Bloquea hasta el primer registro y junta hasta `lote` durante `intervalo`"""
+        lote = [self._cola.get()]
+        limite = time.monotonic() + self.intervalo
+        while len(lote) < self.lote and lote[-1] is not self._FIN:
+            restante = limite - time.monotonic()
+            try:
+                lote.append(self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait())
+            except queue.Empty:
+                break
+        return lote
 
-            # Preparar body
-            body_data = {
-                'userData': {
-                    'userId': str(numero_documento),
-                    'userType': tipo_documento
-                }
+    def _escribir(self):
+        try:
+            conexion = self.conectar()
+        except sqlite3.Error as e:
+            logger.error("No se pudo abrir el diario de transacciones %s: %s", self.ruta, e)
+            conexion = None
+
+        terminar = False
+        while not terminar:
+            lote = self._siguiente_lote()
+            if lote[-1] is self._FIN:
+                terminar = True
+                lote.pop()
+            if lote:
+                self._insertar(conexion, lote)
+        if conexion is not None:
+            conexion.close()
+
+    def _insertar(self, conexion, filas):
+        columnas = ', '.join(COLUMNAS_DIARIO)
+        marcas = ', '.join('?' * len(COLUMNAS_DIARIO))
+        try:
+            if conexion is None:
+                raise sqlite3.OperationalError('diario no disponible')
+            with conexion:
+                conexion.execute('BEGIN')
+                conexion.executemany(f'INSERT INTO transacciones ({columnas}) VALUES ({marcas})', filas)
+        except sqlite3.Error as e:
+            logger.error("No se pudieron escribir %s registros en el diario: %s", len(filas), e)
+            with self._lock:
+                self.errores += len(filas)
+            metrica_diario.labels('error').inc(len(filas))
+            return
+        with self._lock:
+            self.escritos += len(filas)
+        metrica_diario.labels('escrito').inc(len(filas))
+
+    def cerrar(self, timeout=10):
+        """Escribe lo pendiente y detiene el hilo escritor"""
+        hilo = self._hilo
+        if hilo is None or not hilo.is_alive():
+            return
+        try:
+            self._cola.put(self._FIN, timeout=timeout)
+        except queue.Full:
+            logger.warning("Diario de transacciones: cola llena al cerrar")
+            return
+        hilo.join(timeout)
+        self._hilo = None
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'activo': self.activo,
+                'ruta': self.ruta,
+                'pendientes': self._cola.qsize(),
+                'escritos': self.escritos,
+                'descartados': self.descartados,
+                'errores': self.errores
             }
 
-            logger.info(f"Consultando biometría para documento: {numero_documento}")
-            logger.info(f"Headers: {headers}")
-            logger.info(f"Body: {json.dumps(body_data)}")
 
-            response = requests.post(
-                self.biometric_url,
-                json=body_data,
-                headers=headers,
-                timeout=30
-            )
+diario = DiarioTransacciones(DIARIO_PATH, DIARIO_COLA_MAX, DIARIO_LOTE, DIARIO_INTERVALO, DIARIO_ESPERA_MAX)
 
-            logger.info(f"Status code: {response.status_code}")
-            logger.info(f"Response: {response.text}")
 
-            if response.status_code != 200:
-                return {
-                    'error': True,
-                    'message': f'API Error {response.status_code}: {response.text}',
-                    'status_code': response.status_code
-                }
+def _registrar_en_diario(tipo, respuesta, inicio, datos, anotaciones):
+    # Solo se lee el body de respuestas pequeñas (no el audio en base64)
+    cuerpo = None
+    if not respuesta.is_streamed and respuesta.is_json and (respuesta.content_length or 0) <= 4096:
+        cuerpo = respuesta.get_json(silent=True)
+    cuerpo = cuerpo if isinstance(cuerpo, dict) else {}
+    _escribir_en_diario(
+        tipo, respuesta.status_code, inicio, datos, anotaciones,
+        url=cuerpo.get('url'),
+        error=cuerpo.get('message') if cuerpo.get('error') else None
+    )
 
-            return response.json()
 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error de conexión: {str(e)}")
-            return {
-                'error': True,
-                'message': f'Error de conexión: {str(e)}'
-            }
-        except Exception as e:
-            logger.error(f"Error en consultar_biometria_facial: {str(e)}")
-            return {
-                'error': True,
-                'message': f'Error interno: {str(e)}'
+def _escribir_en_diario(tipo, status, inicio, datos, anotaciones, url=None, error=None):
+    """Encola un registro del diario; datos son los campos recibidos en la petición o el item"""
+    upstreams = anotaciones['upstreams']
+    upstream, upstream_status = list(upstreams.items())[-1] if upstreams else (None, None)
+
+    diario.registrar(
+        ts=time.time(),
+        tipo=tipo,
+        status=status,
+        latencia_ms=round((time.perf_counter() - inicio) * 1000, 1),
+        # El generado por el servicio si la petición no traía idTransaccion
+        id_transaccion=anotaciones['id_transaccion'] or _texto_o_none(datos.get('idTransaccion')),
+        numero_documento=_texto_o_none(datos.get('numeroDocumento')),
+        tipo_documento=_texto_o_none(datos.get('tipoDocumento')),
+        id_session=_texto_o_none(datos.get('id_session')),
+        url=url or _texto_o_none(datos.get('audio_url')),
+        upstream=upstream,
+        upstream_status=upstream_status,
+        error=error,
+        pid=os.getpid()
+    )
+
+
+def _registrar_trabajo_en_diario(trabajo, inicio, anotaciones):
+    """Registra un trabajo de /audio_base64/jobs al terminar (ColaTrabajosAudio.al_terminar)"""
+    if not diario.activo:
+        return
+    resultado = trabajo.get('resultado') or {}
+    _escribir_en_diario(
+        'audio_job', trabajo['status_code'], inicio, trabajo, anotaciones,
+        error=resultado.get('message') if resultado.get('error') else None
+    )
+
+
+trabajos_audio.al_terminar = _registrar_trabajo_en_diario
+
+
+def _texto_o_none(valor):
+    return None if valor is None else str(valor)
+
+
+def registrar_transaccion(tipo):
+    """Decorador de vistas: registra cada llamada en el diario de transacciones.
+
+    Va por encima de limitar_concurrencia para registrar también los rechazos.
+    Las respuestas en streaming se registran al terminar de enviarse.
+    """
+    def decorador(vista):
+        @functools.wraps(vista)
+        def envoltura(*args, **kwargs):
+            if not diario.activo:
+                return vista(*args, **kwargs)
+            inicio = time.perf_counter()
+            with anotaciones_diario() as anotaciones:
+                respuesta = app.make_response(vista(*args, **kwargs))
+            # Al cerrar una respuesta en streaming ya no hay contexto de la petición (g)
+            datos = g.get('datos_peticion') or {}
+            if respuesta.is_streamed:
+                respuesta.call_on_close(lambda: _registrar_en_diario(tipo, respuesta, inicio, datos, anotaciones))
+            else:
+                _registrar_en_diario(tipo, respuesta, inicio, datos, anotaciones)
+            return respuesta
+        return envoltura
+    return decorador
+
+
+# Arranque en frío: antes de atender tráfico se obtiene el token OAuth2 (en el
+# proceso maestro si gunicorn precarga la app, así los workers lo heredan) y cada
+# worker abre conexiones TLS keep-alive con los upstreams (ver gunicorn.conf.py).
+CALENTAR_AL_ARRANCAR = os.getenv('CALENTAR_AL_ARRANCAR', 'true').lower() == 'true'
+CALENTAR_CONEXIONES = _env_int('CALENTAR_CONEXIONES', 2)
+# /warmup es público: mientras el worker no está listo, como máximo un
+# calentamiento cada CALENTAR_INTERVALO_MIN segundos
+CALENTAR_INTERVALO_MIN = _env_float('CALENTAR_INTERVALO_MIN', 10)
+
+# Duración de cada fase del arranque en segundos (por proceso)
+tiempos_arranque = {}
+
+metrica_arranque = Gauge(
+    'app_startup_seconds', 'Duración de las fases de arranque del worker',
+    ['fase'], multiprocess_mode='liveall'
+)
+
+
+def registrar_tiempo_arranque(fase, segundos):
+    tiempos_arranque[fase] = round(segundos, 3)
+    metrica_arranque.labels(fase).set(segundos)
+
+
+def calentar_token():
+    """Obtiene el token si no hay uno vigente (sin iniciar el hilo de refresco). Devuelve True si hay token"""
+    gestor = seguros_api.gestor_token
+    if gestor.token_valido():
+        # Heredado del maestro: se conserva la duración medida allí
+        return True
+    inicio = time.perf_counter()
+    token = gestor.refrescar(forzar=False)
+    registrar_tiempo_arranque('token', time.perf_counter() - inicio)
+    if not token:
+        logger.warning("Calentamiento: no se pudo obtener el token OAuth2")
+    return token is not None
+
+
+def _abrir_conexion(pool, url):
+    """HEAD a la raíz del host: abre la conexión TLS y queda en el pool (sin breaker ni métricas)"""
+    origen = urlparse(url)
+    try:
+        pool.sesion.head(f'{origen.scheme}://{origen.netloc}/', timeout=5, allow_redirects=False).close()
+        return True
+    except requests.exceptions.RequestException as e:
+        logger.warning("Calentamiento: no se pudo conectar con '%s': %s", pool.nombre, e)
+        return False
+
+
+def calentar_conexiones():
+    """Abre CALENTAR_CONEXIONES conexiones por upstream en paralelo. Devuelve las abiertas por pool"""
+    inicio = time.perf_counter()
+    destinos = [(seguros_api.http, seguros_api.token_url), (apps_script_http, APPS_SCRIPT_URL)]
+    n = max(0, min(CALENTAR_CONEXIONES, HTTP_POOL_SIZE))
+    abiertas = {pool.nombre: 0 for pool, _ in destinos}
+    if n:
+        with ThreadPoolExecutor(max_workers=n * len(destinos), thread_name_prefix='calentamiento') as executor:
+            futuros = [(pool, executor.submit(_abrir_conexion, pool, url)) for pool, url in destinos for _ in range(n)]
+            for pool, futuro in futuros:
+                abiertas[pool.nombre] += 1 if futuro.result() else 0
+    registrar_tiempo_arranque('conexiones', time.perf_counter() - inicio)
+    return abiertas
+
+
+# Último calentamiento de este proceso (lo consulta /warmup)
+_calentamiento = {'resumen': None, 'momento': 0.0}
+_lock_calentamiento = threading.Lock()
+
+
+def calentar():
+    """Token y conexiones listos para la primera petición. Devuelve el resumen del calentamiento"""
+    inicio = time.perf_counter()
+    token = calentar_token()
+    conexiones = calentar_conexiones()
+    registrar_tiempo_arranque('calentamiento', time.perf_counter() - inicio)
+    resumen = {'token': token, 'conexiones': conexiones}
+    _calentamiento.update(resumen=resumen, momento=time.monotonic())
+    return resumen
+
+
+def calentar_si_hace_falta():
+    """Resumen del calentamiento, calentando solo si el worker no está listo.
+
+    Con el worker caliente no sale ninguna llamada a los upstreams; si no lo
+    está, se calienta a lo sumo una vez cada CALENTAR_INTERVALO_MIN segundos.
+    """
+    with _lock_calentamiento:
+        resumen = _calentamiento['resumen']
+        listo = resumen is not None and resumen['token'] and seguros_api.gestor_token.token_valido()
+        if listo or (resumen is not None and
+                     time.monotonic() - _calentamiento['momento'] < CALENTAR_INTERVALO_MIN):
+            return resumen
+        return calentar()
+
+
+def calentar_worker(inicio_fork=None):
+    """Calentamiento de un worker recién creado (gunicorn post_worker_init)"""
+    # Las fases medidas en el maestro antes del fork se publican con el pid del worker
+    for fase, segundos in list(tiempos_arranque.items()):
+        metrica_arranque.labels(fase).set(segundos)
+    resumen = calentar() if CALENTAR_AL_ARRANCAR else None
+    if inicio_fork is not None:
+        registrar_tiempo_arranque('worker', time.time() - inicio_fork)
+    logger.info("Worker %s listo para recibir tráfico", os.getpid(),
+                extra={'campos': {'arranque_s': dict(tiempos_arranque), 'calentamiento': resumen}})
+    return resumen
+
+
+@app.before_request
+def _iniciar_metricas_peticion():
+    g.inicio_peticion = time.perf_counter()
+    g.ruta_metricas = request.url_rule.rule if request.url_rule else 'desconocida'
+    metrica_peticiones_en_curso.labels(g.ruta_metricas).inc()
+
+
+@app.after_request
+def _registrar_metricas_peticion(response):
+    inicio = g.get('inicio_peticion')
+    if inicio is not None:
+        metrica_peticiones.labels(g.ruta_metricas, request.method, str(response.status_code)).observe(
+            time.perf_counter() - inicio
+        )
+    return response
+
+
+@app.teardown_request
+def _finalizar_metricas_peticion(error=None):
+    ruta = g.pop('ruta_metricas', None)
+    if ruta is not None:
+        metrica_peticiones_en_curso.labels(ruta).dec()
+
+
+@app.before_request
+def _iniciar_server_timing():
+    g.token_fases = iniciar_fases()
+
+
+@app.after_request
+def _agregar_server_timing(response):
+    inicio = g.get('inicio_peticion')
+    if inicio is None:
+        return response
+    total = (time.perf_counter() - inicio) * 1000
+    valor = server_timing(total)
+    if valor:
+        response.headers['Server-Timing'] = valor
+    registrar_tiempos(request.method, g.get('ruta_metricas', request.path), response.status_code, total)
+    return response
+
+
+@app.teardown_request
+def _terminar_server_timing(error=None):
+    terminar_fases(g.pop('token_fases', None))
+
+
+# Perfilado opcional: fracción de peticiones perfiladas con cProfile (0 lo desactiva).
+# Los puntos calientes se consultan en GET /admin/perfil con el header X-Admin-Token.
+PERFIL_MUESTREO = _env_float('PERFIL_MUESTREO', 0)
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+
+class PerfiladorMuestreado:
+    """Perfila con cProfile una muestra de las peticiones y acumula sus estadísticas.
+
+    Se perfila como mucho una petición a la vez por worker (cProfile mide solo
+    el hilo que lo activa y no admite perfiles simultáneos de forma fiable); las
+    que llegan mientras tanto no se perfilan. Las estadísticas son por worker.
+    """
+
+    def __init__(self, muestreo):
+        self.muestreo = muestreo
+        self._reiniciar_tras_fork()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar_tras_fork)
+
+    def _reiniciar_tras_fork(self):
+        self._lock = threading.Lock()
+        self._en_uso = threading.Lock()
+        self._stats = None
+        self.peticiones = 0
+
+    def iniciar(self):
+        """Devuelve un perfil activo si la petición entra en la muestra, o None"""
+        if self.muestreo <= 0 or random.random() >= self.muestreo:
+            return None
+        if not self._en_uso.acquire(blocking=False):
+            return None
+        perfil = cProfile.Profile()
+        try:
+            perfil.enable()
+        except ValueError:
+            # Otro profiler activo en el proceso
+            self._en_uso.release()
+            return None
+        return perfil
+
+    def finalizar(self, perfil):
+        perfil.disable()
+        self._en_uso.release()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(perfil)
+            else:
+                self._stats.add(perfil)
+            self.peticiones += 1
+
+    def reiniciar(self):
+        with self._lock:
+            self._stats = None
+            self.peticiones = 0
+
+    def puntos_calientes(self, orden='acumulado', limite=30):
+        """Funciones con más tiempo acumulado (o propio) en las peticiones perfiladas"""
+        indice = 2 if orden == 'propio' else 3
+        with self._lock:
+            if self._stats is None:
+                return []
+            filas = sorted(self._stats.stats.items(), key=lambda item: item[1][indice], reverse=True)[:limite]
+        return [
+            {
+                'funcion': pstats.func_std_string(funcion),
+                'llamadas': llamadas,
+                'llamadas_primitivas': primitivas,
+                'tiempo_propio_ms': round(propio * 1000, 3),
+                'tiempo_acumulado_ms': round(acumulado * 1000, 3)
             }
+            for funcion, (primitivas, llamadas, propio, acumulado, _) in filas
+        ]
 
 
-# Instancia global de la API
-seguros_api = SegurosBolivarAPI()
+perfilador = PerfiladorMuestreado(PERFIL_MUESTREO)
+
+
+@app.before_request
+def _iniciar_perfil():
+    perfil = perfilador.iniciar()
+    if perfil is not None:
+        g.perfil = perfil
+
+
+@app.teardown_request
+def _finalizar_perfil(error=None):
+    perfil = g.pop('perfil', None)
+    if perfil is not None:
+        perfilador.finalizar(perfil)
+
+
+def _autorizar_admin():
+    """Respuesta de error si la petición no trae el ADMIN_TOKEN, o None"""
+    if not ADMIN_TOKEN:
+        return jsonify({
+            'error': True,
+            'message': 'Endpoints de administración deshabilitados (definir ADMIN_TOKEN)'
+        }), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({
+            'error': True,
+            'message': 'X-Admin-Token inválido'
+        }), 401
+    return None
 
 
 @app.route('/', methods=['GET'])
@@ -160,100 +3626,97 @@ def health_check():
 
 
 @app.route('/biometria', methods=['POST'])
+@registrar_transaccion('biometria')
+@limitar_concurrencia('biometria')
 def generar_url_biometria():
     """Endpoint principal para generar URL de biometría facial"""
     try:
-        # Log request para debugging
-        logger.info(f"Request method: {request.method}")
-        logger.info(f"Request headers: {dict(request.headers)}")
-        logger.info(f"Request content type: {request.content_type}")
-        logger.info(f"Request data: {request.data}")
+        # Solo estos 3 campos se usan del JSON
+        datos, error = parsear_request(ESQUEMA_BIOMETRIA)
+        if error:
+            return error
 
-        # Intentar obtener datos del request de múltiples formas
-        data = None
+        numero_documento = datos['numeroDocumento']
+        tipo_documento = datos['tipoDocumento']
+        id_transaccion = datos.get('idTransaccion')
 
-        # Método 1: JSON estándar
-        try:
-            data = request.get_json(force=True)
-            logger.info(f"JSON data (method 1): {data}")
-        except Exception as e:
-            logger.warning(f"Failed to parse JSON with method 1: {e}")
+        # Consultar API (IP fija, otros valores quemados)
+        resultado = seguros_api.consultar_biometria_facial(
+            numero_documento=numero_documento,
+            tipo_documento=tipo_documento,
+            id_transaccion=id_transaccion
+        )
 
-        # Método 2: Si falla, intentar parsear manualmente
-        if not data:
-            try:
-                raw_data = request.get_data(as_text=True)
-                logger.info(f"Raw data: {raw_data}")
-                if raw_data:
-                    data = json.loads(raw_data)
-                    logger.info(f"JSON data (method 2): {data}")
-            except Exception as e:
-                logger.warning(f"Failed to parse JSON with method 2: {e}")
+        if resultado.get('error'):
+            return respuesta_error(resultado, resultado.get('status_code', 500))
 
-        # Método 3: Intentar desde form data
-        if not data and request.form:
-            try:
-                data = request.form.to_dict()
-                logger.info(f"Form data (method 3): {data}")
-            except Exception as e:
-                logger.warning(f"Failed to parse form data: {e}")
+        # Respuesta exitosa con estructura plana
+        return jsonify(_formatear_respuesta_biometria(
+            resultado, numero_documento, tipo_documento, id_transaccion
+        ))
 
-        if not data:
-            logger.error("No se pudo obtener datos del request")
-            return jsonify({
-                'error': True,
-                'message': 'Body JSON requerido',
-                'debug': {
-                    'content_type': request.content_type,
-                    'method': request.method,
-                    'headers': dict(request.headers),
-                    'raw_data': request.get_data(as_text=True)[:500]  # Primeros 500 chars
-                }
-            }), 400
+    except Exception as e:
+        logger.error("Error en generar_url_biometria: %s", e)
+        return jsonify({
+            'error': True,
+            'message': f'Error interno del servidor: {str(e)}'
+        }), 500
 
-        # Solo estos 3 campos son requeridos del JSON
-        numero_documento = data.get('numeroDocumento')
-        tipo_documento = data.get('tipoDocumento', 'CC')
-        id_transaccion = data.get('idTransaccion')
 
-        if not numero_documento:
+@app.route('/biometria/batch', methods=['POST'])
+@limitar_concurrencia('batch')
+def generar_urls_biometria_batch():
+    """Genera URLs de biometría para varios documentos en una sola petición"""
+    try:
+        data, error = parsear_request()
+        if error:
+            return error
+
+        # Se acepta una lista de items o un objeto {"items": [...]}
+        items = data.get('items') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
             return jsonify({
                 'error': True,
-                'message': 'numeroDocumento es requerido'
+                'message': 'items es requerido (lista de {numeroDocumento, tipoDocumento, idTransaccion})'
             }), 400
 
-        # Consultar API (IP fija, otros valores quemados)
-        resultado = seguros_api.consultar_biometria_facial(
-            numero_documento=numero_documento,
-            tipo_documento=tipo_documento,
-            id_transaccion=id_transaccion
-        )
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({
+                'error': True,
+                'message': f'Máximo {BATCH_MAX_ITEMS} items por batch (recibidos {len(items)})'
+            }), 413
 
-        if resultado.get('error'):
-            status_code = resultado.get('status_code', 500)
-            return jsonify(resultado), status_code
+        # Con el circuito abierto todo el batch fallaría: responder 503 de inmediato
+        try:
+            seguros_api.http.circuito.verificar()
+        except CircuitoAbiertoError as e:
+            return respuesta_error(e.resultado(), 503)
 
-        # Procesar la URL de la respuesta original de Seguros Bolívar
-        if resultado.get('url') and resultado['url'].startswith('https://'):
-            original_url = resultado['url']
-            resultado['url'] = original_url.replace('https://', '')
-            logger.info(f"URL procesada: {original_url} -> {resultado['url']}")
+        # Un solo token para todo el batch
+        if not seguros_api.gestor_token.obtener():
+            return jsonify({
+                'error': True,
+                'message': 'No se pudo obtener el token de acceso'
+            }), 500
 
-        # Log de la respuesta procesada para debug
-        logger.info(f"Respuesta procesada de Seguros Bolívar: {json.dumps(resultado)}")
+        logger.info("Procesando batch de biometría con %s items", len(items))
+        executor = _obtener_executor_batch()
+        futuros = [executor.submit(_procesar_item_batch, indice, item) for indice, item in enumerate(items)]
+        # Los resultados se devuelven en el mismo orden de entrada
+        resultados = [futuro.result() for futuro in futuros]
+        exitosos = sum(1 for r in resultados if r.get('success'))
 
-        # Respuesta exitosa con estructura plana
         return jsonify({
-            'url': resultado.get('url', ''),
-            'idTransaccion': id_transaccion,
-            'numeroDocumento': numero_documento,
-            'tipoDocumento': tipo_documento,
-            'success': True,
+            'success': exitosos == len(resultados),
+            'total': len(resultados),
+            'exitosos': exitosos,
+            'fallidos': len(resultados) - exitosos,
+            'resultados': resultados,
             'timestamp': datetime.now().isoformat()
         })
 
     except Exception as e:
-        logger.error(f"Error en generar_url_biometria: {str(e)}")
+        logger.error("Error en generar_urls_biometria_batch: %s", e)
         return jsonify({
             'error': True,
             'message': f'Error interno del servidor: {str(e)}'
@@ -303,151 +3766,178 @@ def refresh_token():
         }), 500
 
 
-@app.route('/audio_base64', methods=['POST'])
-def convertir_audio_base64():
-    """Endpoint para convertir audio URL a base64 usando Google Apps Script"""
-    try:
-        # Log request para debugging
-        logger.info(f"Request method: {request.method}")
-        logger.info(f"Request headers: {dict(request.headers)}")
-        logger.info(f"Request content type: {request.content_type}")
-        logger.info(f"Request data: {request.data}")
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Estadísticas de las caches y de la agrupación de peticiones de biometría"""
+    return jsonify({
+        'biometria': seguros_api.cache.estadisticas(),
+        'biometria_en_curso': seguros_api.coalescedor.estadisticas(),
+        'audio': cache_audio.estadisticas(),
+        'timestamp': datetime.now().isoformat()
+    })
 
-        # Obtener datos del request (usando la misma lógica robusta del endpoint biometria)
-        data = None
 
-        # Método 1: JSON estándar
-        try:
-            data = request.get_json(force=True)
-            logger.info(f"JSON data (method 1): {data}")
-        except Exception as e:
-            logger.warning(f"Failed to parse JSON with method 1: {e}")
+@app.route('/diario/stats', methods=['GET'])
+def diario_stats():
+    """Estado del diario de transacciones de este worker (consultas: python diario.py)"""
+    return jsonify({**diario.estadisticas(), 'pid': os.getpid(), 'timestamp': datetime.now().isoformat()})
 
-        # Método 2: Si falla, intentar parsear manualmente
-        if not data:
-            try:
-                raw_data = request.get_data(as_text=True)
-                logger.info(f"Raw data: {raw_data}")
-                if raw_data:
-                    data = json.loads(raw_data)
-                    logger.info(f"JSON data (method 2): {data}")
-            except Exception as e:
-                logger.warning(f"Failed to parse JSON with method 2: {e}")
 
-        # Método 3: Intentar desde form data
-        if not data and request.form:
-            try:
-                data = request.form.to_dict()
-                logger.info(f"Form data (method 3): {data}")
-            except Exception as e:
-                logger.warning(f"Failed to parse form data: {e}")
+def estado_circuitos():
+    """Estado de los circuit breakers de cada upstream, del presupuesto de reintentos y del hedging"""
+    return {
+        'circuitos': {
+            pool.circuito.nombre: pool.circuito.estado()
+            for pool in (seguros_api.http, apps_script_http)
+        },
+        'reintentos': presupuesto_reintentos.estadisticas(),
+        'hedging': seguros_api.cobertura.estadisticas(),
+        'timestamp': datetime.now().isoformat()
+    }
 
-        if not data:
-            logger.error("No se pudo obtener datos del request")
-            return jsonify({
-                'error': True,
-                'message': 'Body JSON requerido',
-                'debug': {
-                    'content_type': request.content_type,
-                    'method': request.method,
-                    'headers': dict(request.headers),
-                    'raw_data': request.get_data(as_text=True)[:500]
-                }
-            }), 400
 
-        # Validar campos requeridos (solo audio_url e id_session)
-        audio_url = data.get('audio_url')
-        id_session = data.get('id_session')
+@app.route('/circuitos', methods=['GET'])
+def circuitos():
+    """Estado de los circuit breakers de los upstreams"""
+    return jsonify(estado_circuitos())
 
-        if not audio_url:
-            return jsonify({
-                'error': True,
-                'message': 'audio_url es requerido'
-            }), 400
 
-        if not id_session:
-            return jsonify({
-                'error': True,
-                'message': 'id_session es requerido'
-            }), 400
+def estado_compartimentos():
+    """Uso de los bulkheads por ruta y por upstream"""
+    return {
+        'rutas': {nombre: c.estadisticas() for nombre, c in compartimentos_rutas.items()},
+        'upstreams': {
+            pool.nombre: pool.compartimento.estadisticas()
+            for pool in (seguros_api.http, apps_script_http)
+        },
+        'limites_tasa': {
+            destino: limitador.estadisticas()
+            for pool in (seguros_api.http, apps_script_http)
+            for destino, limitador in pool.limitadores.items()
+        },
+        'timestamp': datetime.now().isoformat()
+    }
 
-        # Auth token fijo (configurado internamente)
-        auth_token = "ac4a666571ebf85116a87237ba05bfa4-7b59d052-ca59-4f4b-a324-faf1643f56aa"
-        # 4ea2df623fed2f34af5b27c258f47581-e418b99d-1476-4103-a128-a5a7b8e28778 Dev
-        # ac4a666571ebf85116a87237ba05bfa4-7b59d052-ca59-4f4b-a324-faf1643f56aa Prod
 
-        # URL del Google Apps Script
-        apps_script_url = 'https://script.google.com/macros/s/AKfycbx4Vho2TiRvTDdCZoKeLVzxXjGfigyf74YqwbLnHkQdXpn-4JHqhqu8lIpZIgzXoA3svQ/exec'
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Métricas en formato Prometheus"""
+    return Response(generar_metricas(), content_type=CONTENT_TYPE_LATEST)
 
-        # Preparar payload para Apps Script (incluyendo auth_token fijo)
-        payload = {
-            'audio_url': audio_url,
-            'id_session': id_session,
-            'auth_token': auth_token
-        }
 
-        # Headers para la petición
-        headers = {
-            'Content-Type': 'application/json'
-        }
+@app.route('/admin/perfil', methods=['GET', 'DELETE'])
+def perfil_admin():
+    """Puntos calientes del perfilado muestreado (DELETE reinicia las estadísticas)"""
+    error = _autorizar_admin()
+    if error:
+        return error
 
-        logger.info(f"Enviando petición a Apps Script: {apps_script_url}")
-        logger.info(f"Payload: {json.dumps(payload)}")
+    if request.method == 'DELETE':
+        perfilador.reiniciar()
+        return jsonify({'success': True, 'message': 'Estadísticas de perfilado reiniciadas'})
 
-        # Hacer petición al Google Apps Script
-        response = requests.post(
-            apps_script_url,
-            json=payload,
-            headers=headers,
-            timeout=60  # Timeout más largo para procesamiento de audio
-        )
+    orden = request.args.get('orden', 'acumulado')
+    limite = request.args.get('limite', '30')
+    return jsonify({
+        'muestreo': perfilador.muestreo,
+        'peticiones_perfiladas': perfilador.peticiones,
+        'orden': orden,
+        'funciones': perfilador.puntos_calientes(orden, int(limite) if limite.isdigit() else 30),
+        'pid': os.getpid(),
+        'timestamp': datetime.now().isoformat()
+    })
 
-        logger.info(f"Apps Script response status: {response.status_code}")
-        logger.info(f"Apps Script response: {response.text}")
 
-        if response.status_code != 200:
-            return jsonify({
-                'error': True,
-                'message': f'Error en Google Apps Script: {response.status_code}',
-                'details': response.text,
-                'input': {
-                    'audio_url': audio_url,
-                    'id_session': id_session
-                }
-            }), 500
+@app.route('/warmup', methods=['GET'])
+def warmup():
+    """Estado del calentamiento (calienta si aún no está listo); 200 cuando el worker está listo para /biometria"""
+    resumen = calentar_si_hace_falta()
+    listo = resumen['token'] and seguros_api.gestor_token.token_valido()
+    return jsonify({
+        'listo': listo,
+        'calentamiento': resumen,
+        'arranque_s': tiempos_arranque,
+        'pid': os.getpid(),
+        'timestamp': datetime.now().isoformat()
+    }), 200 if listo else 503
 
-        # Parsear respuesta del Apps Script
-        try:
-            apps_script_response = response.json()
-        except Exception as e:
-            logger.error(f"Error parsing Apps Script response: {e}")
-            return jsonify({
-                'error': True,
-                'message': 'Error parsing response from Google Apps Script',
-                'raw_response': response.text,
-                'input': {
-                    'audio_url': audio_url,
-                    'id_session': id_session
-                }
-            }), 500
 
-        # Retornar la respuesta del Apps Script tal como viene
-        return jsonify(apps_script_response)
+@app.route('/compartimentos', methods=['GET'])
+def compartimentos():
+    """Uso de los bulkheads (límites de concurrencia)"""
+    return jsonify(estado_compartimentos())
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error de conexión con Google Apps Script: {str(e)}")
+
+@app.route('/audio_base64', methods=['POST'])
+@registrar_transaccion('audio')
+@limitar_concurrencia('audio')
+def convertir_audio_base64():
+    """Endpoint para convertir audio URL a base64 (Google Apps Script o backend nativo).
+
+    Con "Accept: application/octet-stream" devuelve los bytes del audio y con
+    "Accept-Encoding: gzip/deflate" el JSON comprimido en streaming.
+    """
+    try:
+        datos, error = parsear_request(ESQUEMA_AUDIO)
+        if error:
+            return error
+
+        audio_url = datos['audio_url']
+        id_session = datos['id_session']
+
+        # Con "Prefer: respond-async" se encola como trabajo (igual que /audio_base64/jobs)
+        if 'respond-async' in request.headers.get('Prefer', ''):
+            return _encolar_trabajo_audio(audio_url, id_session)
+
+        if request.accept_mimetypes.best_match(FORMATOS_AUDIO) == 'application/octet-stream':
+            return respuesta_audio_binaria(audio_url, id_session)
+        return comprimir_respuesta(app.make_response(respuesta_audio(audio_url, id_session)))
+
+    except Exception as e:
+        logger.error("Error en convertir_audio_base64: %s", e)
         return jsonify({
             'error': True,
-            'message': f'Error de conexión con Google Apps Script: {str(e)}'
+            'message': f'Error interno del servidor: {str(e)}'
         }), 500
+
+
+@app.route('/audio_base64/jobs', methods=['POST'])
+def crear_trabajo_audio():
+    """Encola una conversión de audio y responde 202 con el id del trabajo"""
+    try:
+        datos, error = parsear_request(ESQUEMA_AUDIO)
+        if error:
+            return error
+
+        audio_url = datos['audio_url']
+        id_session = datos['id_session']
+
+        return _encolar_trabajo_audio(audio_url, id_session)
+
     except Exception as e:
-        logger.error(f"Error en convertir_audio_base64: {str(e)}")
+        logger.error("Error en crear_trabajo_audio: %s", e)
         return jsonify({
             'error': True,
             'message': f'Error interno del servidor: {str(e)}'
         }), 500
 
 
+@app.route('/audio_base64/jobs/<job_id>', methods=['GET'])
+def consultar_trabajo_audio(job_id):
+    """Estado y, si terminó, resultado de un trabajo de conversión de audio"""
+    trabajo = trabajos_audio.consultar(job_id)
+    if trabajo is None:
+        return jsonify({
+            'error': True,
+            'message': f'Trabajo {job_id} no encontrado o expirado'
+        }), 404
+    return jsonify(trabajo)
+
+
+registrar_tiempo_arranque('modulo', time.time() - _INICIO_MODULO)
+
+
 if __name__ == '__main__':
+    calentar_worker()
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""Configuración común de las pruebas: importar main.py desde la raíz del repositorio"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,134 @@
+"""Pruebas de /audio_base64: negociación por Accept y rechazo de audio_url internas (SSRF)"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+
+class ManejadorUpstream(BaseHTTPRequestHandler):
+    """Audio "interno" en GET /secreto, redirección en GET /redirigir y Apps Script en POST"""
+
+    def do_GET(self):
+        self.server.descargas.append(self.path)
+        if self.path.startswith('/redirigir'):
+            self.send_response(302)
+            self.send_header('Location', self.server.destino_redireccion)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.end_headers()
+        self.wfile.write(b'SECRETO')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(self.server.respuesta_apps_script).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), ManejadorUpstream)
+    servidor.descargas = []
+    servidor.respuesta_apps_script = {'success': True, 'mime_type': 'audio/ogg', 'audio_base64': 'QUJD'}
+    servidor.base = f'http://127.0.0.1:{servidor.server_address[1]}'
+    servidor.destino_redireccion = f'http://localhost:{servidor.server_address[1]}/secreto'
+    threading.Thread(target=servidor.serve_forever, args=(0.05,), daemon=True).start()
+    monkeypatch.setattr(main, 'APPS_SCRIPT_URL', f'{servidor.base}/apps_script')
+    yield servidor
+    servidor.shutdown()
+    servidor.server_close()
+
+
+@pytest.fixture
+def cliente():
+    return main.app.test_client()
+
+
+def _pedir(cliente, audio_url, accept='application/octet-stream'):
+    respuesta = cliente.post('/audio_base64', json={'audio_url': audio_url, 'id_session': 's1'},
+                             headers={'Accept': accept})
+    # Leída y cerrada: así se libera el cupo del bulkhead de la ruta
+    respuesta.get_data()
+    respuesta.close()
+    return respuesta
+
+
+def test_binario_con_apps_script_decodifica_su_respuesta_sin_descargar(cliente, upstream):
+    respuesta = _pedir(cliente, f'{upstream.base}/secreto')
+
+    assert respuesta.status_code == 200
+    assert respuesta.data == b'ABC'
+    assert respuesta.headers['X-Audio-Mime-Type'] == 'audio/ogg'
+    assert upstream.descargas == []
+
+
+def test_binario_con_apps_script_sin_audio_base64_responde_502(cliente, upstream):
+    upstream.respuesta_apps_script = {'success': True}
+
+    respuesta = _pedir(cliente, f'{upstream.base}/secreto')
+
+    assert respuesta.status_code == 502
+    assert upstream.descargas == []
+
+
+def test_json_por_defecto(cliente, upstream):
+    respuesta = _pedir(cliente, f'{upstream.base}/secreto', accept='*/*')
+
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()['audio_base64'] == 'QUJD'
+
+
+@pytest.mark.parametrize('accept', ['application/octet-stream', 'application/json'])
+def test_nativo_sin_hosts_permitidos_no_descarga(cliente, upstream, monkeypatch, accept):
+    monkeypatch.setattr(main, 'AUDIO_BACKEND', 'nativo')
+    monkeypatch.setattr(main, 'AUDIO_HOSTS_PERMITIDOS', [])
+
+    respuesta = _pedir(cliente, f'{upstream.base}/secreto', accept=accept)
+
+    assert respuesta.status_code == 400
+    assert upstream.descargas == []
+
+
+def test_nativo_rechaza_host_permitido_que_resuelve_a_loopback(cliente, upstream, monkeypatch):
+    monkeypatch.setattr(main, 'AUDIO_BACKEND', 'nativo')
+    monkeypatch.setattr(main, 'AUDIO_HOSTS_PERMITIDOS', ['localhost'])
+
+    respuesta = _pedir(cliente, upstream.destino_redireccion)
+
+    assert respuesta.status_code == 400
+    assert 'resuelve a' in respuesta.get_json()['message']
+    assert upstream.descargas == []
+
+
+def test_nativo_valida_el_host_de_cada_redireccion(cliente, upstream, monkeypatch):
+    monkeypatch.setattr(main, 'AUDIO_BACKEND', 'nativo')
+    monkeypatch.setattr(main, 'AUDIO_HOSTS_PERMITIDOS', ['127.0.0.1'])
+    monkeypatch.setattr(main, 'AUDIO_PERMITIR_REDES_PRIVADAS', True)
+
+    respuesta = _pedir(cliente, f'{upstream.base}/redirigir')
+
+    assert respuesta.status_code == 400
+    assert 'localhost' in respuesta.get_json()['message']
+    assert upstream.descargas == ['/redirigir']
+
+
+def test_nativo_descarga_host_permitido(cliente, upstream, monkeypatch):
+    monkeypatch.setattr(main, 'AUDIO_BACKEND', 'nativo')
+    monkeypatch.setattr(main, 'AUDIO_HOSTS_PERMITIDOS', ['127.0.0.1'])
+    monkeypatch.setattr(main, 'AUDIO_PERMITIR_REDES_PRIVADAS', True)
+
+    respuesta = _pedir(cliente, f'{upstream.base}/secreto')
+
+    assert respuesta.status_code == 200
+    assert respuesta.data == b'SECRETO'
+    assert respuesta.headers['X-Audio-Mime-Type'] == 'audio/mpeg'
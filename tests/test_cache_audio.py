@@ -0,0 +1,96 @@
+"""Pruebas de la cache en disco de conversiones de audio"""
+
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import main
+
+EXITO = {'success': True, 'mime_type': 'audio/ogg', 'audio_base64': 'QUJD'}
+FALLO = {'success': False, 'error': 'descarga fallida'}
+
+
+class ManejadorAppsScript(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.llamadas += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(self.server.respuesta).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def apps_script(monkeypatch):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), ManejadorAppsScript)
+    servidor.llamadas = 0
+    servidor.respuesta = EXITO
+    threading.Thread(target=servidor.serve_forever, args=(0.05,), daemon=True).start()
+    monkeypatch.setattr(main, 'APPS_SCRIPT_URL', f'http://127.0.0.1:{servidor.server_address[1]}/exec')
+    yield servidor
+    servidor.shutdown()
+    servidor.server_close()
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = main.CacheAudioDisco(str(tmp_path), 10 * 1024 * 1024, False, ttl=60)
+    monkeypatch.setattr(main, 'cache_audio', cache)
+    return cache
+
+
+def _pedir(cliente):
+    respuesta = cliente.post('/audio_base64', json={'audio_url': 'https://audios.example.com/a.mp3', 'id_session': 's1'})
+    # Cerrarla libera el cupo del bulkhead de la ruta y termina de escribir la cache
+    with respuesta:
+        return respuesta.status_code, json.loads(respuesta.get_data())
+
+
+@pytest.mark.parametrize('passthrough', [True, False])
+def test_no_guarda_respuestas_fallidas(apps_script, cache, monkeypatch, passthrough):
+    monkeypatch.setattr(main, 'APPS_SCRIPT_PASSTHROUGH', passthrough)
+    cliente = main.app.test_client()
+
+    apps_script.respuesta = FALLO
+    assert _pedir(cliente) == (200, FALLO)
+
+    # Recuperado el upstream, la siguiente petición no recibe el fallo desde la cache
+    apps_script.respuesta = EXITO
+    assert _pedir(cliente) == (200, EXITO)
+    assert apps_script.llamadas == 2
+
+    assert _pedir(cliente) == (200, EXITO)
+    assert apps_script.llamadas == 2
+    assert cache.estadisticas()['hits'] == 1
+
+
+def test_entradas_expiran_tras_el_ttl(apps_script, cache):
+    cliente = main.app.test_client()
+    _pedir(cliente)
+    entrada, = [e.path for e in os.scandir(cache.directorio)]
+
+    # Escrita hace más de ttl segundos
+    antiguedad = os.stat(entrada).st_mtime - 61
+    os.utime(entrada, (antiguedad, antiguedad))
+
+    assert _pedir(cliente) == (200, EXITO)
+    assert apps_script.llamadas == 2
+    assert cache.estadisticas()['expiradas'] == 1
+
+
+def test_lru_expulsa_la_menos_usada(tmp_path):
+    cache = main.CacheAudioDisco(str(tmp_path), 10, False)
+    cache.guardar_respuesta('a', b'12345')
+    cache.guardar_respuesta('b', b'12345')
+    os.utime(cache._ruta('a'), (1, os.stat(cache._ruta('a')).st_mtime))
+
+    cache.guardar_respuesta('c', b'12345')
+
+    assert sorted(os.listdir(tmp_path)) == ['b.resp', 'c.resp']
+    assert cache.estadisticas()['evictions'] == 1
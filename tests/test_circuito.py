@@ -0,0 +1,140 @@
+"""Pruebas del circuit breaker de los upstreams"""
+
+import pytest
+import requests
+
+import main
+
+
+class Reloj:
+    """Reemplaza time.monotonic() de main.py por un reloj que avanza a mano"""
+
+    def __init__(self, monkeypatch, inicio=1000.0):
+        self.ahora = inicio
+        monkeypatch.setattr(main.time, 'monotonic', lambda: self.ahora)
+
+    def avanzar(self, segundos):
+        self.ahora += segundos
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    return Reloj(monkeypatch)
+
+
+def _circuito(**kwargs):
+    opciones = dict(ventana=30, min_llamadas=4, umbral_errores=0.5, llamada_lenta=10, umbral_lentas=0.8,
+                    tiempo_abierto=5, sondas=1)
+    opciones.update(kwargs)
+    return main.Circuito('prueba', **opciones)
+
+
+def _llamar(circuito, exito, duracion=0.01):
+    circuito.permitir()
+    circuito.registrar(exito, duracion)
+
+
+def test_cerrado_abierto_semiabierto_cerrado(reloj):
+    circuito = _circuito()
+    for exito in (True, True, False):
+        _llamar(circuito, exito)
+    assert circuito.estado()['estado'] == 'cerrado'
+
+    _llamar(circuito, False)  # 2 de 4 errores
+    assert circuito.estado()['estado'] == 'abierto'
+    with pytest.raises(main.CircuitoAbiertoError):
+        circuito.permitir()
+
+    reloj.avanzar(5)
+    circuito.permitir()  # la sonda pasa
+    assert circuito.estado()['estado'] == 'semiabierto'
+    # Mientras la sonda no responde, el resto sigue fallando rápido
+    with pytest.raises(main.CircuitoAbiertoError):
+        circuito.permitir()
+
+    circuito.registrar(True, 0.01)
+    assert circuito.estado()['estado'] == 'cerrado'
+    assert circuito.estado()['aperturas'] == 1
+
+
+def test_sonda_fallida_vuelve_a_abrir(reloj):
+    circuito = _circuito(min_llamadas=1)
+    _llamar(circuito, False)
+    reloj.avanzar(5)
+
+    _llamar(circuito, False)
+
+    estado = circuito.estado()
+    assert estado['estado'] == 'abierto'
+    assert estado['aperturas'] == 2
+
+
+def test_llamadas_lentas_abren_el_circuito(reloj):
+    circuito = _circuito()
+    for _ in range(4):
+        _llamar(circuito, True, duracion=10)
+
+    assert circuito.estado()['estado'] == 'abierto'
+
+
+def test_liberar_devuelve_la_sonda_sin_resultado(reloj):
+    circuito = _circuito(min_llamadas=1)
+    _llamar(circuito, False)
+    reloj.avanzar(5)
+    circuito.permitir()
+
+    circuito.liberar()
+
+    assert circuito.estado()['estado'] == 'semiabierto'
+    circuito.permitir()  # la sonda liberada se puede volver a usar
+    circuito.registrar(True, 0.01)
+    assert circuito.estado()['estado'] == 'cerrado'
+
+
+def _pool(monkeypatch, enviar):
+    monkeypatch.setattr(main, 'presupuesto_reintentos', main.PresupuestoReintentos(0, 0, 30))
+    pool = main.PoolHTTP('prueba', reintentos=0, circuito=_circuito())
+    monkeypatch.setattr(pool, '_enviar', enviar)
+    return pool
+
+
+def test_errores_locales_no_abren_el_circuito(monkeypatch):
+    def enviar(*args, **kwargs):
+        raise requests.exceptions.InvalidHeader('Header part (987) must be of type str or bytes')
+
+    pool = _pool(monkeypatch, enviar)
+    for _ in range(12):
+        with pytest.raises(requests.exceptions.InvalidHeader):
+            pool.post('http://upstream.invalid/')
+
+    assert pool.circuito.estado()['estado'] == 'cerrado'
+    assert pool.circuito.estado()['llamadas_ventana'] == 0
+
+
+@pytest.mark.parametrize('status_code', [500, 503, 429])
+def test_5xx_y_429_cuentan_como_fallos(monkeypatch, status_code):
+    class Respuesta:
+        def __init__(self):
+            self.status_code = status_code
+            self.headers = {}
+
+        def close(self):
+            pass
+
+    pool = _pool(monkeypatch, lambda *args, **kwargs: Respuesta())
+    for _ in range(4):
+        pool.post('http://upstream.invalid/')
+
+    assert pool.circuito.estado()['estado'] == 'abierto'
+
+
+def test_errores_de_transporte_cuentan_como_fallos(monkeypatch):
+    def enviar(*args, **kwargs):
+        raise requests.exceptions.ReadTimeout('sin respuesta')
+
+    pool = _pool(monkeypatch, enviar)
+    for _ in range(4):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            pool.post('http://upstream.invalid/')
+
+    assert pool.circuito.estado()['estado'] == 'abierto'
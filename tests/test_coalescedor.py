@@ -0,0 +1,81 @@
+"""Pruebas del agrupamiento de llamadas concurrentes idénticas"""
+
+import threading
+import time
+
+import pytest
+
+import main
+
+
+def _seguidores(coalescedor, n, clave='c'):
+    """Lanza n hilos que llaman con la misma clave mientras el líder está en curso"""
+    resultados = []
+    errores = []
+
+    def seguir():
+        try:
+            resultados.append(coalescedor.ejecutar(clave, lambda: pytest.fail('el seguidor no debe ejecutar')))
+        except Exception as e:
+            errores.append(e)
+
+    hilos = [threading.Thread(target=seguir) for _ in range(n)]
+    for hilo in hilos:
+        hilo.start()
+    return hilos, resultados, errores
+
+
+def _esperar_agrupadas(coalescedor, n):
+    for _ in range(500):
+        if coalescedor.estadisticas()['agrupadas'] >= n:
+            return
+        time.sleep(0.01)
+    raise AssertionError('los seguidores no llegaron a agruparse')
+
+
+def test_los_seguidores_reciben_el_resultado_del_lider():
+    coalescedor = main.CoalescedorLlamadas()
+    seguidores = {}
+
+    def lider():
+        seguidores['hilos'], seguidores['resultados'], _ = _seguidores(coalescedor, 5)
+        _esperar_agrupadas(coalescedor, 5)
+        return {'url': 'https://biometria.example.com/sesion'}
+
+    resultado = coalescedor.ejecutar('c', lider)
+    for hilo in seguidores['hilos']:
+        hilo.join(5)
+
+    assert seguidores['resultados'] == [resultado] * 5
+    # Cada uno recibe su propia copia
+    assert all(r is not resultado for r in seguidores['resultados'])
+    assert coalescedor.estadisticas() == {'en_curso': 0, 'ejecutadas': 1, 'agrupadas': 5}
+
+
+def test_los_seguidores_reciben_la_excepcion_del_lider():
+    coalescedor = main.CoalescedorLlamadas()
+    seguidores = {}
+
+    def lider():
+        seguidores['hilos'], _, seguidores['errores'] = _seguidores(coalescedor, 3)
+        _esperar_agrupadas(coalescedor, 3)
+        raise main.requests.exceptions.ReadTimeout('sin respuesta')
+
+    with pytest.raises(main.requests.exceptions.ReadTimeout):
+        coalescedor.ejecutar('c', lider)
+    for hilo in seguidores['hilos']:
+        hilo.join(5)
+
+    assert len(seguidores['errores']) == 3
+    assert all(isinstance(e, main.requests.exceptions.ReadTimeout) for e in seguidores['errores'])
+    # Terminada la llamada, la clave se libera y la siguiente vuelve a ejecutar
+    assert coalescedor.ejecutar('c', lambda: 'nuevo') == 'nuevo'
+    assert coalescedor.estadisticas()['ejecutadas'] == 2
+
+
+def test_claves_distintas_no_se_agrupan():
+    coalescedor = main.CoalescedorLlamadas()
+
+    assert coalescedor.ejecutar('a', lambda: 1) == 1
+    assert coalescedor.ejecutar('b', lambda: 2) == 2
+    assert coalescedor.estadisticas()['agrupadas'] == 0
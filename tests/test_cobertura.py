@@ -0,0 +1,118 @@
+"""Pruebas de las hedged requests (Cobertura) a la API de biometría"""
+
+import time
+import threading
+
+import pytest
+
+import main
+
+
+class RespuestaFalsa:
+    def __init__(self, status_code=200, origen='original'):
+        self.status_code = status_code
+        self.origen = origen
+        self.cerrada = False
+
+    def close(self):
+        self.cerrada = True
+
+
+class Upstream:
+    """La llamada original termina poco después de la cobertura (o a los 2 s si no hay cobertura)"""
+
+    def __init__(self, status_original=200, status_cobertura=200):
+        self.status_original = status_original
+        self.status_cobertura = status_cobertura
+        self.llamadas = []
+        self._cobertura_lista = threading.Event()
+
+    def __call__(self, cobertura=False):
+        self.llamadas.append(cobertura)
+        if cobertura:
+            self._cobertura_lista.set()
+            return RespuestaFalsa(self.status_cobertura, 'cobertura')
+        self._cobertura_lista.wait(2)
+        time.sleep(0.05)
+        return RespuestaFalsa(self.status_original, 'original')
+
+
+def _cobertura(presupuesto_global=None, ratio=1.0, minimo=5):
+    cobertura = main.Cobertura('prueba', True, 0.5, 0.01, 1, main.PresupuestoReintentos(ratio, minimo, 30),
+                               presupuesto_global=presupuesto_global)
+    cobertura._registrar_latencia(0.01)
+    return cobertura
+
+
+def test_inactiva_llama_una_vez_sin_marcar_cobertura():
+    upstream = Upstream()
+    upstream._cobertura_lista.set()
+    cobertura = main.Cobertura('prueba', False, 0.5, 0.01, 1, main.PresupuestoReintentos(1, 5, 30))
+
+    assert cobertura.ejecutar(upstream).origen == 'original'
+    assert upstream.llamadas == [False]
+
+
+def test_sin_muestras_no_cubre():
+    upstream = Upstream()
+    upstream._cobertura_lista.set()
+    cobertura = main.Cobertura('prueba', True, 0.5, 0.01, 20, main.PresupuestoReintentos(1, 5, 30))
+
+    cobertura.ejecutar(upstream)
+    assert upstream.llamadas == [False]
+    assert cobertura.retraso() is None
+
+
+def test_llamada_lenta_se_cubre_y_cuenta_como_reintento_global():
+    presupuesto_global = main.PresupuestoReintentos(0.1, 5, 30)
+    cobertura = _cobertura(presupuesto_global)
+    upstream = Upstream()
+
+    respuesta = cobertura.ejecutar(upstream)
+
+    assert respuesta.origen == 'cobertura'
+    assert upstream.llamadas == [False, True]
+    assert cobertura.estadisticas()['ganadas'] == 1
+    # La cobertura es un reintento, no una llamada original más
+    estadisticas = presupuesto_global.estadisticas()
+    assert estadisticas['reintentos_ventana'] == 1
+    assert estadisticas['llamadas_ventana'] == 0
+
+
+@pytest.mark.parametrize('agotado', ['propio', 'global'])
+def test_sin_presupuesto_se_omite_y_se_espera_la_original(agotado):
+    presupuesto_global = main.PresupuestoReintentos(0, 0 if agotado == 'global' else 5, 30)
+    cobertura = _cobertura(presupuesto_global, ratio=0, minimo=0 if agotado == 'propio' else 5)
+    upstream = Upstream()
+    # Sin cobertura nadie libera a la original: que no espere los 2 s
+    threading.Timer(0.1, upstream._cobertura_lista.set).start()
+
+    assert cobertura.ejecutar(upstream).origen == 'original'
+    assert upstream.llamadas == [False]
+    assert cobertura.estadisticas()['omitidas'] == 1
+
+
+def test_original_con_error_5xx_gana_la_cobertura():
+    cobertura = _cobertura()
+    upstream = Upstream(status_original=503)
+
+    assert cobertura.ejecutar(upstream).origen == 'cobertura'
+
+
+def test_pool_no_registra_la_cobertura_como_llamada(monkeypatch):
+    presupuesto = main.PresupuestoReintentos(0.1, 5, 30)
+    monkeypatch.setattr(main, 'presupuesto_reintentos', presupuesto)
+    pool = main.PoolHTTP('prueba', circuito=main.Circuito('prueba'))
+    monkeypatch.setattr(pool, '_enviar', lambda *args, **kwargs: RespuestaFalsa())
+
+    pool.post('http://upstream.invalid/', destino='prueba')
+    pool.post('http://upstream.invalid/', destino='prueba', cobertura=True)
+
+    assert presupuesto.estadisticas()['llamadas_ventana'] == 1
+
+
+def test_el_executor_alcanza_para_todos_los_hilos_que_consultan(monkeypatch):
+    monkeypatch.setattr(main, 'GUNICORN_THREADS', 8)
+    monkeypatch.setattr(main, 'BATCH_MAX_CONCURRENCIA', 4)
+
+    assert main.Cobertura.hilos_necesarios() == 24
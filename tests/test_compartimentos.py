@@ -0,0 +1,153 @@
+"""Pruebas de los bulkheads (compartimentos) de los upstreams"""
+
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import asgi
+import main
+
+
+class Respuesta:
+    status_code = 200
+    headers = {}
+
+    def __init__(self):
+        self.cerrada = 0
+
+    def close(self):
+        self.cerrada += 1
+
+
+def _pool(monkeypatch, enviar, limite=1):
+    monkeypatch.setattr(main, 'presupuesto_reintentos', main.PresupuestoReintentos(0, 0, 30))
+    compartimento = main.Compartimento('prueba', limite, status_code=503, cola=0, espera=0)
+    pool = main.PoolHTTP('prueba', reintentos=0, circuito=main.Circuito('prueba'), compartimento=compartimento)
+    monkeypatch.setattr(pool, '_enviar', enviar)
+    return pool
+
+
+def _en_curso(pool):
+    return pool.compartimento.estadisticas()['en_curso']
+
+
+def test_sin_stream_libera_el_cupo_al_recibir_la_respuesta(monkeypatch):
+    pool = _pool(monkeypatch, lambda *args, **kwargs: Respuesta())
+
+    pool.post('http://upstream.invalid/')
+    pool.post('http://upstream.invalid/')
+    assert _en_curso(pool) == 0
+
+
+def test_con_stream_el_cupo_se_mantiene_hasta_cerrar_la_respuesta(monkeypatch):
+    pool = _pool(monkeypatch, lambda *args, **kwargs: Respuesta())
+
+    respuesta = pool.post('http://upstream.invalid/', stream=True)
+    assert _en_curso(pool) == 1
+    with pytest.raises(main.CompartimentoLlenoError):
+        pool.post('http://upstream.invalid/', stream=True)
+
+    respuesta.close()
+    respuesta.close()  # cerrar dos veces no libera dos cupos
+    assert _en_curso(pool) == 0
+    assert respuesta.cerrada == 2
+    pool.post('http://upstream.invalid/', stream=True).close()
+
+
+def test_con_stream_un_error_libera_el_cupo(monkeypatch):
+    def enviar(*args, **kwargs):
+        raise main.requests.exceptions.ConnectionError('sin conexión')
+
+    pool = _pool(monkeypatch, enviar)
+    with pytest.raises(main.requests.exceptions.ConnectionError):
+        pool.post('http://upstream.invalid/', stream=True)
+    assert _en_curso(pool) == 0
+
+
+class ManejadorAppsScript(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'success': True, 'audio_base64': 'QUJD' * 1000}).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def apps_script(monkeypatch):
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), ManejadorAppsScript)
+    threading.Thread(target=servidor.serve_forever, args=(0.05,), daemon=True).start()
+    monkeypatch.setattr(main, 'APPS_SCRIPT_URL', f'http://127.0.0.1:{servidor.server_address[1]}/exec')
+    monkeypatch.setattr(main, 'APPS_SCRIPT_PASSTHROUGH', True)
+    monkeypatch.setattr(main, 'AUDIO_BACKEND', 'apps_script')
+    monkeypatch.setattr(main.cache_audio, 'max_bytes', 0)
+    yield servidor
+    servidor.shutdown()
+    servidor.server_close()
+
+
+@pytest.mark.parametrize('leer', [True, False])
+def test_reenvio_directo_libera_el_cupo_de_apps_script_al_cerrar(apps_script, leer):
+    compartimento = main.apps_script_http.compartimento
+    antes = compartimento.estadisticas()['en_curso']
+
+    respuesta = main.app.test_client().post(
+        '/audio_base64', json={'audio_url': 'https://audios.example.com/a.mp3', 'id_session': 's1'}
+    )
+    assert respuesta.status_code == 200
+    # Mientras el body se reenvía, el cupo sigue ocupado
+    assert compartimento.estadisticas()['en_curso'] == antes + 1
+    with respuesta:
+        if leer:
+            assert json.loads(respuesta.get_data())['success'] is True
+
+    assert compartimento.estadisticas()['en_curso'] == antes
+
+
+def test_asgi_ocupa_el_cupo_del_upstream(monkeypatch):
+    pool = _pool(monkeypatch, None)
+    ocupado = []
+
+    async def enviar(url, destino, **kwargs):
+        ocupado.append(_en_curso(pool))
+        return Respuesta()
+
+    monkeypatch.setattr(asgi, '_enviar', enviar)
+    asyncio.run(asgi._post_upstream(pool, 'http://upstream.invalid/'))
+
+    assert ocupado == [1]
+    assert _en_curso(pool) == 0
+
+
+def test_asgi_espera_el_cupo_sin_bloquear_el_event_loop(monkeypatch):
+    pool = _pool(monkeypatch, None)
+    pool.compartimento = main.Compartimento('prueba', 1, status_code=503, cola=1, espera=5)
+
+    async def enviar(url, destino, **kwargs):
+        return Respuesta()
+
+    async def probar():
+        latidos = 0
+
+        async def latir():
+            nonlocal latidos
+            while True:
+                await asyncio.sleep(0.01)
+                latidos += 1
+
+        tarea = asyncio.create_task(latir())
+        threading.Timer(0.2, pool.compartimento.liberar).start()
+        await asgi._post_upstream(pool, 'http://upstream.invalid/')
+        tarea.cancel()
+        return latidos
+
+    monkeypatch.setattr(asgi, '_enviar', enviar)
+    pool.compartimento.adquirir()
+    assert asyncio.run(probar()) >= 5
+    assert _en_curso(pool) == 0
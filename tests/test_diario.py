@@ -0,0 +1,133 @@
+"""Pruebas del diario de transacciones (SQLite con escritura diferida)"""
+
+import sqlite3
+import threading
+
+import pytest
+
+import main
+
+
+def _filas(ruta):
+    with sqlite3.connect(ruta) as conexion:
+        conexion.row_factory = sqlite3.Row
+        return [dict(fila) for fila in conexion.execute('SELECT * FROM transacciones ORDER BY id')]
+
+
+@pytest.fixture
+def ruta(tmp_path):
+    return str(tmp_path / 'diario.db')
+
+
+def test_escribe_los_registros_en_lotes_al_cerrar(ruta):
+    diario = main.DiarioTransacciones(ruta, lote=2, intervalo=0.01)
+    for i in range(5):
+        assert diario.registrar(ts=float(i), tipo='biometria', status=200, numero_documento=str(i))
+    diario.cerrar()
+
+    filas = _filas(ruta)
+    assert [f['numero_documento'] for f in filas] == ['0', '1', '2', '3', '4']
+    assert filas[0]['tipo'] == 'biometria' and filas[0]['url'] is None
+    assert diario.estadisticas()['escritos'] == 5
+
+
+def test_inactivo_sin_ruta():
+    diario = main.DiarioTransacciones('')
+
+    assert not diario.registrar(ts=1.0, tipo='audio', status=200)
+    assert diario.estadisticas()['pendientes'] == 0
+
+
+def test_con_la_cola_llena_descarta_tras_esperar(ruta, monkeypatch):
+    diario = main.DiarioTransacciones(ruta, cola_max=1, espera_max=0.01)
+    # Sin hilo escritor la cola no se vacía
+    monkeypatch.setattr(diario, '_asegurar_hilo', lambda: None)
+
+    assert diario.registrar(ts=1.0, tipo='audio', status=200)
+    assert not diario.registrar(ts=2.0, tipo='audio', status=200)
+    assert diario.estadisticas()['descartados'] == 1
+
+
+def test_registra_las_peticiones_a_biometria(ruta, monkeypatch):
+    diario = main.DiarioTransacciones(ruta, intervalo=0.01)
+    monkeypatch.setattr(main, 'diario', diario)
+    monkeypatch.setattr(main.seguros_api, 'consultar_biometria_facial',
+                        lambda **_: {'url': 'https://biometria.example.com/sesion'})
+
+    respuesta = main.app.test_client().post('/biometria', json={'numeroDocumento': '123456', 'idTransaccion': 't1'})
+    assert respuesta.status_code == 200
+    diario.cerrar()
+
+    fila, = _filas(ruta)
+    assert fila['tipo'] == 'biometria'
+    assert fila['status'] == 200
+    assert fila['id_transaccion'] == 't1'
+    assert fila['numero_documento'] == '123456'
+    assert fila['tipo_documento'] == 'CC'
+    assert fila['url'] == 'biometria.example.com/sesion'
+
+
+def test_registra_el_id_de_transaccion_generado(ruta, monkeypatch):
+    diario = main.DiarioTransacciones(ruta, intervalo=0.01)
+    monkeypatch.setattr(main, 'diario', diario)
+    enviados = []
+
+    def consultar(numero_documento, tipo_documento, id_transaccion):
+        headers, _ = main.seguros_api.preparar_consulta_biometria('token', numero_documento, tipo_documento,
+                                                                  id_transaccion)
+        enviados.append(headers['X-Id_transaction'])
+        return {'url': 'https://biometria.example.com/sesion'}
+
+    monkeypatch.setattr(main.seguros_api, 'consultar_biometria_facial', consultar)
+
+    respuesta = main.app.test_client().post('/biometria', json={'numeroDocumento': '123456'})
+    assert respuesta.status_code == 200
+    diario.cerrar()
+
+    fila, = _filas(ruta)
+    assert fila['id_transaccion'] == enviados[0]
+
+
+def test_registra_cada_item_del_batch(ruta, monkeypatch):
+    diario = main.DiarioTransacciones(ruta, intervalo=0.01)
+    monkeypatch.setattr(main, 'diario', diario)
+    monkeypatch.setattr(main.seguros_api, 'consultar_biometria_facial',
+                        lambda **_: {'error': True, 'message': 'No disponible', 'status_code': 503})
+    monkeypatch.setattr(main.seguros_api.gestor_token, 'obtener', lambda: 'token')
+
+    respuesta = main.app.test_client().post('/biometria/batch', json=[
+        {'numeroDocumento': '1', 'idTransaccion': 't1'},
+        {'tipoDocumento': 'CC'}
+    ])
+    assert respuesta.status_code == 200
+    diario.cerrar()
+
+    filas = sorted(_filas(ruta), key=lambda f: f['status'])
+    assert [f['tipo'] for f in filas] == ['biometria_batch', 'biometria_batch']
+    assert filas[0]['status'] == 400 and filas[0]['numero_documento'] is None
+    assert filas[1]['status'] == 503
+    assert filas[1]['id_transaccion'] == 't1'
+    assert filas[1]['error'] == 'No disponible'
+
+
+def test_registra_los_trabajos_de_audio_al_terminar(ruta, monkeypatch):
+    diario = main.DiarioTransacciones(ruta, intervalo=0.01)
+    monkeypatch.setattr(main, 'diario', diario)
+    terminados = threading.Event()
+
+    def al_terminar(*args):
+        main._registrar_trabajo_en_diario(*args)
+        terminados.set()
+
+    cola = main.ColaTrabajosAudio(lambda audio_url, id_session: ({'audio_base64': 'AAAA'}, 200),
+                                  max_workers=1, max_pendientes=1, max_resultados=1, ttl=60,
+                                  al_terminar=al_terminar)
+    cola.enviar('https://audio.example.com/a.mp3', 's1')
+    assert terminados.wait(5)
+    diario.cerrar()
+
+    fila, = _filas(ruta)
+    assert fila['tipo'] == 'audio_job'
+    assert fila['status'] == 200
+    assert fila['id_session'] == 's1'
+    assert fila['url'] == 'https://audio.example.com/a.mp3'
@@ -0,0 +1,73 @@
+"""Pruebas del token bucket que limita las llamadas al upstream de biometría"""
+
+import pytest
+
+import main
+
+
+class Reloj:
+    """Reemplaza time.time() de main.py por un reloj que avanza a mano"""
+
+    def __init__(self, monkeypatch, inicio=1000.0):
+        self.ahora = inicio
+        monkeypatch.setattr(main.time, 'time', lambda: self.ahora)
+
+    def avanzar(self, segundos):
+        self.ahora += segundos
+
+
+@pytest.fixture
+def reloj(monkeypatch):
+    return Reloj(monkeypatch)
+
+
+def test_rafaga_sin_espera_y_luego_turnos_espaciados(reloj):
+    limitador = main.LimitadorTasa('prueba', tasa=10, rafaga=3, espera_max=5)
+
+    assert [limitador.reservar() for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Sin fichas: cada llamada reserva el turno siguiente, a 1/tasa de la anterior
+    assert limitador.reservar() == pytest.approx(0.1)
+    assert limitador.reservar() == pytest.approx(0.2)
+    assert limitador.estadisticas()['demoradas'] == 2
+
+
+def test_las_fichas_se_recuperan_con_el_tiempo_hasta_la_rafaga(reloj):
+    limitador = main.LimitadorTasa('prueba', tasa=10, rafaga=2, espera_max=5)
+    limitador.reservar()
+    limitador.reservar()
+
+    reloj.avanzar(0.1)
+    assert limitador.reservar() == 0.0
+
+    # Tras mucho tiempo no se acumulan más fichas que la ráfaga
+    reloj.avanzar(60)
+    assert [limitador.reservar() for _ in range(2)] == [0.0, 0.0]
+    assert limitador.reservar() > 0
+
+
+def test_rechaza_si_la_espera_supera_el_maximo(reloj):
+    limitador = main.LimitadorTasa('prueba', tasa=1, rafaga=1, espera_max=1.5)
+    limitador.reservar()
+    limitador.reservar()  # espera 1 s
+
+    with pytest.raises(main.LimiteTasaError) as error:
+        limitador.reservar()  # esperaría 2 s
+    assert error.value.status_code == 429
+    assert limitador.estadisticas()['rechazadas'] == 1
+
+
+def test_frenar_tras_429_pausa_todas_las_llamadas(reloj):
+    limitador = main.LimitadorTasa('prueba', tasa=10, rafaga=5, espera_max=10)
+    limitador.frenar(2)
+
+    assert limitador.reservar() == pytest.approx(2.1)
+
+
+def test_estado_en_archivo_compartido_entre_limitadores(reloj, tmp_path):
+    ruta = str(tmp_path / 'tasa.bin')
+    uno = main.LimitadorTasa('prueba', tasa=10, rafaga=1, estado=main.EstadoTasaArchivo(ruta))
+    otro = main.LimitadorTasa('prueba', tasa=10, rafaga=1, estado=main.EstadoTasaArchivo(ruta))
+
+    assert uno.reservar() == 0.0
+    # Otro proceso (otro descriptor del mismo archivo) ve la ficha ya consumida
+    assert otro.reservar() == pytest.approx(0.1)
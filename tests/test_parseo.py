@@ -0,0 +1,36 @@
+"""Pruebas de la validación de los bodies de las peticiones"""
+
+import main
+
+
+def test_normaliza_a_texto_los_campos_str_o_int():
+    datos, mensaje = main.validar_esquema({'numeroDocumento': 123, 'idTransaccion': 987}, main.ESQUEMA_BIOMETRIA)
+
+    assert mensaje is None
+    assert datos == {'numeroDocumento': '123', 'idTransaccion': '987', 'tipoDocumento': 'CC'}
+
+
+def test_rechaza_tipos_invalidos():
+    for valor in (True, 1.5, ['1'], {'a': 1}):
+        datos, mensaje = main.validar_esquema({'numeroDocumento': valor}, main.ESQUEMA_BIOMETRIA)
+        assert datos is None
+        assert mensaje == 'numeroDocumento tiene un tipo inválido'
+
+
+def test_id_transaccion_numerico_llega_como_texto_al_upstream(monkeypatch):
+    enviados = []
+
+    def consultar(numero_documento, tipo_documento, id_transaccion):
+        headers, _ = main.seguros_api.preparar_consulta_biometria('token', numero_documento, tipo_documento,
+                                                                  id_transaccion)
+        enviados.append(headers)
+        return {'url': 'https://biometria.example.com/sesion'}
+
+    monkeypatch.setattr(main.seguros_api, 'consultar_biometria_facial', consultar)
+
+    respuesta = main.app.test_client().post('/biometria', json={'numeroDocumento': 123, 'idTransaccion': 987})
+
+    assert respuesta.status_code == 200
+    assert respuesta.get_json()['idTransaccion'] == '987'
+    assert all(isinstance(v, str) for v in enviados[0].values())
+    assert enviados[0]['X-Id_transaction'] == '987'
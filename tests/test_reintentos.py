@@ -0,0 +1,61 @@
+"""Pruebas de la política de reintentos de PoolHTTP: solo lo que no llegó al upstream"""
+
+import socket
+import threading
+
+import pytest
+import requests
+
+import main
+
+
+@pytest.fixture
+def servidor_que_corta():
+    """Acepta la conexión, lee la petición y cierra sin responder (RemoteDisconnected)"""
+    servidor = socket.socket()
+    servidor.bind(('127.0.0.1', 0))
+    servidor.listen(4)
+    recibidas = []
+
+    def atender():
+        while True:
+            try:
+                conexion, _ = servidor.accept()
+            except OSError:
+                return
+            recibidas.append(conexion.recv(65536))
+            conexion.close()
+
+    threading.Thread(target=atender, daemon=True).start()
+    yield f'http://127.0.0.1:{servidor.getsockname()[1]}/', recibidas
+    servidor.close()
+
+
+def _puerto_cerrado():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_conexion_rechazada_es_reintentable():
+    with pytest.raises(requests.exceptions.ConnectionError) as error:
+        requests.post(f'http://127.0.0.1:{_puerto_cerrado()}/', timeout=2)
+    assert main.conexion_no_establecida(error.value)
+
+
+def test_desconexion_tras_enviar_no_es_reintentable(servidor_que_corta):
+    url, _ = servidor_que_corta
+    with pytest.raises(requests.exceptions.ConnectionError) as error:
+        requests.post(url, data='x', timeout=2)
+    assert not main.conexion_no_establecida(error.value)
+
+
+def test_pool_no_repite_un_post_que_llego_al_upstream(servidor_que_corta, monkeypatch):
+    url, recibidas = servidor_que_corta
+    monkeypatch.setattr(main, 'presupuesto_reintentos', main.PresupuestoReintentos(1, 5, 30))
+    monkeypatch.setattr(main, 'espera_reintento', lambda intento: 0)
+    pool = main.PoolHTTP('prueba', reintentos=2, circuito=main.Circuito('prueba'))
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        pool.post(url, data='x', timeout=2)
+    assert len(recibidas) == 1
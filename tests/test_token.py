@@ -0,0 +1,96 @@
+"""Pruebas del gestor del token OAuth2 (single-flight y refresco anticipado)"""
+
+import threading
+import time
+
+import main
+
+
+class Emisor:
+    """solicitar_token() falso: cuenta las llamadas y tarda `demora` segundos"""
+
+    def __init__(self, demora=0.0, expires_in=3600):
+        self.demora = demora
+        self.expires_in = expires_in
+        self.fallar = False
+        self.llamadas = 0
+        self.llamada = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.llamadas += 1
+            numero = self.llamadas
+        self.llamada.set()
+        time.sleep(self.demora)
+        if self.fallar:
+            return None
+        return f'token-{numero}', self.expires_in
+
+
+def _en_hilos(n, funcion):
+    """Ejecuta funcion() en n hilos que arrancan a la vez. Devuelve sus resultados"""
+    barrera = threading.Barrier(n)
+    resultados = [None] * n
+
+    def ejecutar(i):
+        barrera.wait()
+        resultados[i] = funcion()
+
+    hilos = [threading.Thread(target=ejecutar, args=(i,)) for i in range(n)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(5)
+    return resultados
+
+
+def test_hilos_concurrentes_piden_un_solo_token():
+    emisor = Emisor(demora=0.1)
+    gestor = main.GestorToken(emisor, refresco_anticipado=300)
+
+    resultados = _en_hilos(20, gestor.obtener)
+
+    assert emisor.llamadas == 1
+    assert resultados == ['token-1'] * 20
+
+
+def test_refrescos_forzados_concurrentes_se_agrupan():
+    emisor = Emisor(demora=0.1)
+    gestor = main.GestorToken(emisor, refresco_anticipado=300)
+    assert gestor.obtener() == 'token-1'
+
+    resultados = _en_hilos(10, gestor.refrescar)
+
+    # Los que esperaban a la renovación en curso reciben su token en lugar de pedir otro
+    assert emisor.llamadas == 2
+    assert resultados == ['token-2'] * 10
+
+
+def test_si_la_renovacion_falla_se_sirve_el_token_vigente():
+    emisor = Emisor()
+    gestor = main.GestorToken(emisor, refresco_anticipado=300)
+    assert gestor.obtener() == 'token-1'
+
+    emisor.fallar = True
+    assert gestor.refrescar() is None
+    assert gestor.obtener() == 'token-1'
+    assert emisor.llamadas == 2
+
+
+def test_renueva_en_segundo_plano_antes_de_expirar():
+    # 61 s menos el minuto de margen: expira en 1 s y se renueva a la mitad
+    emisor = Emisor(expires_in=61)
+    gestor = main.GestorToken(emisor, refresco_anticipado=300, reintento=0.05)
+    assert gestor.obtener() == 'token-1'
+    emisor.llamada.clear()
+    # Que el hilo de refresco no siga renovando durante el resto de las pruebas
+    emisor.expires_in = 3600
+
+    assert emisor.llamada.wait(3)
+    for _ in range(100):
+        if gestor.access_token == 'token-2':
+            break
+        time.sleep(0.01)
+    assert gestor.access_token == 'token-2'
+    assert gestor.token_valido()
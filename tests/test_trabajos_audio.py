@@ -0,0 +1,160 @@
+"""Pruebas de la cola de trabajos de conversión de audio (/audio_base64/jobs)"""
+
+import threading
+import time
+
+import pytest
+
+import main
+
+
+class Conversor:
+    """convertir_audio() falso que espera a `continuar` antes de responder"""
+
+    def __init__(self, resultado=None, status_code=200):
+        self.resultado = resultado or {'success': True, 'audio_base64': 'QUJD'}
+        self.status_code = status_code
+        self.continuar = threading.Event()
+        self.llamadas = 0
+
+    def __call__(self, audio_url, id_session):
+        self.llamadas += 1
+        assert self.continuar.wait(5)
+        if isinstance(self.resultado, Exception):
+            raise self.resultado
+        return dict(self.resultado), self.status_code
+
+
+def _cola(conversor, **kwargs):
+    opciones = dict(max_workers=1, max_pendientes=2, max_resultados=10, ttl=60)
+    opciones.update(kwargs)
+    return main.ColaTrabajosAudio(conversor, **opciones)
+
+
+def _esperar(cola, job_id, estados=('completado', 'error')):
+    for _ in range(500):
+        trabajo = cola.consultar(job_id)
+        if trabajo and trabajo['estado'] in estados:
+            return trabajo
+        time.sleep(0.01)
+    raise AssertionError(f'el trabajo {job_id} no llegó a {estados}')
+
+
+def test_ciclo_de_vida_de_un_trabajo():
+    conversor = Conversor()
+    cola = _cola(conversor)
+
+    trabajo, duplicado = cola.enviar('https://audio.example.com/a.mp3', 's1')
+    assert not duplicado
+    assert trabajo['estado'] == 'pendiente'
+    assert _esperar(cola, trabajo['job_id'], ('procesando',))['estado'] == 'procesando'
+
+    conversor.continuar.set()
+    terminado = _esperar(cola, trabajo['job_id'])
+    assert terminado['estado'] == 'completado'
+    assert terminado['status_code'] == 200
+    assert terminado['resultado'] == conversor.resultado
+    assert cola.estadisticas()['pendientes'] == 0
+
+
+def test_un_trabajo_identico_pendiente_se_reutiliza():
+    conversor = Conversor()
+    cola = _cola(conversor)
+
+    trabajo, _ = cola.enviar('https://audio.example.com/a.mp3', 's1')
+    repetido, duplicado = cola.enviar('https://audio.example.com/a.mp3', 's1')
+    assert duplicado
+    assert repetido['job_id'] == trabajo['job_id']
+
+    conversor.continuar.set()
+    _esperar(cola, trabajo['job_id'])
+    assert conversor.llamadas == 1
+    # Ya terminado, el mismo audio es un trabajo nuevo
+    assert cola.enviar('https://audio.example.com/a.mp3', 's1')[1] is False
+
+
+def test_con_la_cola_llena_rechaza():
+    conversor = Conversor()
+    cola = _cola(conversor, max_pendientes=1)
+
+    cola.enviar('https://audio.example.com/a.mp3', 's1')
+    with pytest.raises(main.ColaLlenaError):
+        cola.enviar('https://audio.example.com/b.mp3', 's1')
+    conversor.continuar.set()
+
+
+@pytest.mark.parametrize('resultado, status_code, esperado', [
+    ({'error': True, 'message': 'Apps Script falló'}, 502, 502),
+    (RuntimeError('fallo inesperado'), 200, 500),
+])
+def test_los_errores_quedan_en_el_trabajo(resultado, status_code, esperado):
+    conversor = Conversor(resultado, status_code)
+    conversor.continuar.set()
+    cola = _cola(conversor)
+
+    trabajo, _ = cola.enviar('https://audio.example.com/a.mp3', 's1')
+    terminado = _esperar(cola, trabajo['job_id'])
+    assert terminado['estado'] == 'error'
+    assert terminado['status_code'] == esperado
+    assert terminado['resultado']['error'] is True
+
+
+def test_los_resultados_expiran_tras_el_ttl(monkeypatch):
+    conversor = Conversor()
+    conversor.continuar.set()
+    cola = _cola(conversor, ttl=60)
+    trabajo, _ = cola.enviar('https://audio.example.com/a.mp3', 's1')
+    _esperar(cola, trabajo['job_id'])
+
+    ahora = time.time()
+    monkeypatch.setattr(main.time, 'time', lambda: ahora + 59)
+    assert cola.consultar(trabajo['job_id']) is not None
+    monkeypatch.setattr(main.time, 'time', lambda: ahora + 61)
+    assert cola.consultar(trabajo['job_id']) is None
+    assert cola.estadisticas()['bytes_resultados'] == 0
+
+
+def test_se_conservan_como_maximo_max_resultados():
+    conversor = Conversor()
+    conversor.continuar.set()
+    cola = _cola(conversor, max_resultados=2)
+
+    ids = []
+    for nombre in ('a', 'b', 'c'):
+        trabajo, _ = cola.enviar(f'https://audio.example.com/{nombre}.mp3', 's1')
+        _esperar(cola, trabajo['job_id'])
+        ids.append(trabajo['job_id'])
+
+    assert cola.consultar(ids[0]) is None
+    assert all(cola.consultar(job_id) for job_id in ids[1:])
+
+
+def test_un_resultado_mayor_que_max_bytes_se_reemplaza_por_413():
+    conversor = Conversor({'success': True, 'audio_base64': 'A' * 1000})
+    conversor.continuar.set()
+    cola = _cola(conversor, max_bytes=100)
+
+    trabajo, _ = cola.enviar('https://audio.example.com/a.mp3', 's1')
+    terminado = _esperar(cola, trabajo['job_id'])
+    assert terminado['estado'] == 'error'
+    assert terminado['status_code'] == 413
+    assert cola.estadisticas()['bytes_resultados'] <= 100
+
+
+def test_endpoints_de_trabajos(monkeypatch):
+    conversor = Conversor()
+    conversor.continuar.set()
+    monkeypatch.setattr(main, 'trabajos_audio', _cola(conversor))
+    cliente = main.app.test_client()
+
+    respuesta = cliente.post('/audio_base64/jobs',
+                             json={'audio_url': 'https://audio.example.com/a.mp3', 'id_session': 's1'})
+    assert respuesta.status_code == 202
+    job_id = respuesta.get_json()['job_id']
+    assert respuesta.headers['Location'] == f'/audio_base64/jobs/{job_id}'
+
+    _esperar(main.trabajos_audio, job_id)
+    consulta = cliente.get(f'/audio_base64/jobs/{job_id}').get_json()
+    assert consulta['estado'] == 'completado'
+    assert consulta['resultado']['audio_base64'] == 'QUJD'
+    assert cliente.get('/audio_base64/jobs/desconocido').status_code == 404